@@ -0,0 +1,78 @@
+# Scaling of analyze_code() on large editor contents.
+#
+#   python benchmarks/bench_analysis.py [--sizes 10000,25000,50000,100000]
+#
+# Generates Python source of the requested line counts and reports the
+# analysis time and cost per line, which should stay flat as input grows.
+# legacy_scan_ms times the string scans the old explain/debug/optimize did
+# (split, per-line startswith, count per bracket) for reference; those ran
+# in C but miscounted brackets in strings and keywords inside identifiers.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+BLOCK = '''def transform_{i}(items, limit=3):
+    """Double every item above the limit (see notes)."""
+    result = []
+    for item in items:
+        for factor in (1, 2):
+            if item > limit:
+                result.append(item * factor)  # keep order [stable]
+    return result
+
+'''
+
+
+def generate(lines):
+    per_block = BLOCK.count('\n')
+    return ''.join(BLOCK.format(i=i) for i in range(lines // per_block + 1))
+
+
+def legacy_scan(code):
+    lines = code.strip().split('\n')
+    functions = [line for line in lines if line.strip().startswith('def ')]
+    classes = [line for line in lines if line.strip().startswith('class ')]
+    ("=" in code and "==" not in code and "print" in code)
+    code.count("(") != code.count(")")
+    code.count("[") != code.count("]")
+    ("for" in code and "append" in code)
+    code.count("for") > 2
+    return functions, classes
+
+
+def best_of(fn, code, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(code)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,25000,50000,100000')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for size in map(int, args.sizes.split(',')):
+        code = generate(size)
+        lines = code.count('\n')
+        analysis_s = best_of(wca.analyze_code, code, args.repeat)
+        legacy_s = best_of(legacy_scan, code, args.repeat)
+        print(json.dumps({
+            'lines': lines,
+            'analyze_ms': round(analysis_s * 1000, 1),
+            'us_per_line': round(analysis_s / lines * 1e6, 3),
+            'legacy_scan_ms': round(legacy_s * 1000, 1),
+        }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Wall time for a grading run: one /run request per snippet vs. /batch.
+#
+#   python benchmarks/bench_batch.py [--snippets 200] [--runs 1,2,4,8]
+#                                    [--executor spawn|pool]
+#
+# `sequential` posts every snippet as its own /run over one keep-alive
+# connection, the way the CI tooling does today; `batch` posts them all in
+# a single /batch request.  Each --runs value is a server with that many
+# execution slots; batch wall time should fall with it until the machine
+# runs out of cores.  The result cache is bypassed so every snippet runs.
+# The scheduler has the server's default run rate, with 127.0.0.1 listed
+# the way a grading host is with --trusted-run-client; without that a
+# batch may hold only --client-run-burst runs.
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+
+def snippet(i):
+    return f"total = 0\nfor value in range({20000 + i}):\n    total += value * value\nprint(total)\n"
+
+
+def post(conn, path, data):
+    conn.request('POST', path, json.dumps(data), {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def run_sequential(conn, snippets):
+    ok = 0
+    for code in snippets:
+        status, body = post(conn, '/run', {'code': code, 'cache': False})
+        ok += status == 200 and not body['output'].startswith('Error')
+    return ok
+
+
+def run_batch(conn, snippets):
+    operations = [{'op': 'run', 'code': code, 'cache': False} for code in snippets]
+    status, body = post(conn, '/batch', {'operations': operations})
+    return sum(item['status'] == 'ok' for item in body['results']) if status == 200 else 0
+
+
+def measure(name, run, snippets, max_runs, executor):
+    runner = wca.InterpreterPool(size=max_runs) if executor == 'pool' else wca.SubprocessRunner()
+    scheduler = wca.ExecutionScheduler(max_running=max_runs, max_queued=len(snippets),
+                                       max_wait=600, trusted_clients=['127.0.0.1'])
+    server = wca.make_server('threaded', ('127.0.0.1', 0), runner=runner, scheduler=scheduler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=600)
+    try:
+        started = time.perf_counter()
+        ok = run(conn, snippets)
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+        runner.close()
+    return {
+        'client': name,
+        'executor': executor,
+        'max_runs': max_runs,
+        'snippets': len(snippets),
+        'ok': ok,
+        'wall_seconds': round(elapsed, 3),
+        'runs_per_second': round(len(snippets) / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snippets', type=int, default=200)
+    parser.add_argument('--runs', default='1,2,4,8')
+    parser.add_argument('--executor', choices=['spawn', 'pool'], default='spawn')
+    args = parser.parse_args()
+
+    snippets = [snippet(i) for i in range(args.snippets)]
+    print(json.dumps({'cpu_count': os.cpu_count()}))
+    for max_runs in map(int, args.runs.split(',')):
+        for name, run in (('sequential', run_sequential), ('batch', run_batch)):
+            print(json.dumps(measure(name, run, snippets, max_runs, args.executor)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Peak memory while reading one /chat request body, old vs. new reader.
+#
+#   python benchmarks/bench_body.py [--sizes 1,4,16]
+#
+# Sizes are payload megabytes of editor code.  Each request is driven
+# through RequestHandler.handle_one_request() against an in-memory socket
+# file and tracemalloc reports the peak allocated while it ran.  The
+# message is a plain greeting so the numbers cover reading and parsing the
+# body, not the code analysis.  `legacy` is the old read_json(): read the
+# whole body, decode it, then parse, keeping all three alive.
+import argparse
+import io
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+
+class LegacyHandler(wca.RequestHandler):
+    def read_json(self):
+        content_length = int(self.headers['Content-Length'])
+        post_data = self.rfile.read(content_length)
+        try:
+            return json.loads(post_data.decode('utf-8'))
+        except ValueError:
+            self.send_error(400, 'Request body must be JSON')
+            return None
+
+
+class SocketFile(io.BufferedReader):
+    # Stands in for the buffered socket file the threaded server reads.
+    def __init__(self, data):
+        super().__init__(io.BytesIO(data))
+
+
+def make_request(megabytes):
+    line = 'total = sum(value * 2 for value in values if value > limit)\n'
+    code = line * (megabytes * 1024 * 1024 // len(line))
+    body = json.dumps({'message': 'hello there', 'code': code}).encode()
+    head = (f'POST /chat HTTP/1.1\r\nHost: bench\r\n'
+            f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n').encode()
+    return head + body, len(body)
+
+
+def peak_for(handler_class, request):
+    handler = handler_class.__new__(handler_class)
+    handler.server = None
+    handler.request = None
+    handler.client_address = ('127.0.0.1', 0)
+    handler.rfile = SocketFile(request)
+    handler.wfile = io.BytesIO()
+    handler.close_connection = True
+    handler.requests_handled = 0
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    handler.handle_one_request()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert handler.wfile.getvalue().startswith(b'HTTP/1.1 200'), handler.wfile.getvalue()[:80]
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1,4,16')
+    args = parser.parse_args()
+
+    for megabytes in map(int, args.sizes.split(',')):
+        request, body_bytes = make_request(megabytes)
+        wca.RequestHandler.max_body_bytes = body_bytes
+        for name, handler_class in (('legacy', LegacyHandler), ('streaming', wca.RequestHandler)):
+            peak = peak_for(handler_class, request)
+            print(json.dumps({
+                'body_bytes': body_bytes,
+                'reader': name,
+                'peak_bytes': peak,
+                'peak_per_body_byte': round(peak / body_bytes, 2),
+            }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# Bytes on the wire and serialization cost of large /run responses.
+#
+#   python benchmarks/bench_compression.py [--sizes 65536,1048576,4194304]
+#                                          [--levels 1,6,9] [--rounds 5]
+#
+# Output is what a typical program prints at length: numbered lines of
+# numbers and words.  `serialize` times send_json writing the response to
+# an in-memory sink, against `before` (json.dumps(...).encode() and one
+# write), with the peak memory each allocates on top of the output string
+# (tracemalloc) and the body size; `gzip-N` is compression level N.
+# `wire` sends the same output through a running server as a cached /run
+# result (so no program runs), with and without Accept-Encoding: gzip,
+# and reports the bytes received and the request time over loopback.
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'result', 'value', 'error', 'done']
+
+
+def program_output(size):
+    lines = []
+    total = i = 0
+    while total < size:
+        line = f'{i:6d} {i * i:12d} {WORDS[i % len(WORDS)]:<8} {hex(i * 2654435761 % 2 ** 32)}\n'
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return ''.join(lines)[:size]
+
+
+class Sink:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+class Server:
+    draining = False
+
+
+def bare_handler(accept_encoding, level):
+    handler = wca.RequestHandler.__new__(wca.RequestHandler)
+    handler.request_version = 'HTTP/1.1'
+    handler.requestline = 'POST /run HTTP/1.1'
+    handler.requests_handled = 0
+    handler.server = Server()
+    handler.headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+    handler.wfile = Sink()
+    handler.bytes_sent = 0
+    handler.compress_level = level
+    return handler
+
+
+def before(data):
+    body = json.dumps(data).encode()
+    Sink().write(body)
+    return len(body)
+
+
+def after(accept_encoding, level):
+    def send(data):
+        handler = bare_handler(accept_encoding, level)
+        handler.send_json(data)
+        return handler.bytes_sent
+    return send
+
+
+def serialize(name, send, data, rounds):
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        size = send(data)
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    send(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'variant': name, 'body_bytes': size, 'ms': round(sorted(times)[len(times) // 2] * 1000, 3),
+            'peak_alloc_bytes': peak}
+
+
+def wire(port, code, accept_encoding, rounds):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    headers = {'Content-Type': 'application/json'}
+    if accept_encoding:
+        headers['Accept-Encoding'] = accept_encoding
+    body = json.dumps({'code': code})
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        conn.request('POST', '/run', body, headers)
+        response = conn.getresponse()
+        received = len(response.read())
+        times.append(time.perf_counter() - started)
+    conn.close()
+    return {'accept_encoding': accept_encoding or None, 'wire_bytes': received,
+            'content_encoding': response.getheader('Content-Encoding'),
+            'ms': round(sorted(times)[len(times) // 2] * 1000, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='65536,1048576,4194304')
+    parser.add_argument('--levels', default='1,6,9')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    levels = [int(level) for level in args.levels.split(',')]
+
+    for size in sizes:
+        data = {'output': program_output(size), 'cached': True}
+        variants = [('before', before), ('identity', after(None, 1))]
+        variants += [(f'gzip-{level}', after('gzip', level)) for level in levels]
+        for name, send in variants:
+            print(json.dumps(dict(serialize(name, send, data, args.rounds), section='serialize',
+                                  output_bytes=size)))
+
+    server = wca.make_server('threaded', ('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for size in sizes:
+            # A cached result with this output, so /run serves it without
+            # starting the program.
+            code = f'# {size} bytes of output\n'
+            wca.run_cache.put(wca.run_cache.key(server.runner, code), program_output(size), '')
+            for accept_encoding in ('', 'gzip'):
+                print(json.dumps(dict(wire(server.server_address[1], code, accept_encoding, args.rounds),
+                                      section='wire', output_bytes=size)))
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.jobs.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Latency of /chat while /run traffic saturates the server.
+#
+#   python benchmarks/bench_concurrency.py [--runners 8] [--chats 200]
+#
+# For each server mode a set of background clients keeps /run busy with a
+# slow program while the foreground client measures /chat round trips.
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+SLOW_PROGRAM = "import time\ntime.sleep(0.5)\nprint('done')"
+
+
+def post(port, path, payload, timeout=60):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def start(mode, max_in_flight, max_runs):
+    # All clients share one address and excess runs are turned away at
+    # once rather than queued, so /run keeps the server saturated.
+    scheduler = wca.ExecutionScheduler(max_running=max_runs, max_queued=0, client_rate=0)
+    server = wca.make_server(mode, ('127.0.0.1', 0), max_in_flight=max_in_flight,
+                             scheduler=scheduler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    if mode == 'async':
+        server._started.wait()
+    return server, server.server_address[1]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def measure(mode, runners, chats, max_in_flight, max_runs):
+    server, port = start(mode, max_in_flight, max_runs)
+    stop = threading.Event()
+    run_statuses = []
+
+    def run_loop():
+        while not stop.is_set():
+            run_statuses.append(post(port, '/run', {'code': SLOW_PROGRAM}))
+
+    threads = [threading.Thread(target=run_loop, daemon=True) for _ in range(runners)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+
+    latencies = []
+    for i in range(chats):
+        started = time.perf_counter()
+        post(port, '/chat', {'message': 'explain this code', 'code': 'def f(x):\n    return x\n'})
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    server.server_close()
+    return {
+        'mode': mode,
+        'chat_p50_ms': round(statistics.median(latencies), 2),
+        'chat_p99_ms': round(percentile(latencies, 99), 2),
+        'runs_completed': run_statuses.count(200),
+        'runs_rejected': run_statuses.count(503),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runners', type=int, default=8)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--max-in-flight', type=int, default=64)
+    parser.add_argument('--max-runs', type=int, default=16)
+    parser.add_argument('--modes', default='single,threaded,async')
+    args = parser.parse_args()
+
+    for mode in args.modes.split(','):
+        # The single-threaded baseline serialises everything behind /run,
+        # so keep its sample small.
+        chats = min(args.chats, 10) if mode == 'single' else args.chats
+        print(json.dumps(measure(mode, args.runners, chats, args.max_in_flight, args.max_runs)))
+
+
+if __name__ == '__main__':
+    main()
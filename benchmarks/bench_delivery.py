@@ -0,0 +1,130 @@
+# /run throughput with code written to a temp file vs. piped over stdin.
+#
+#   python benchmarks/bench_delivery.py [--requests 400] [--concurrency 32]
+#                                       [--tmpdir DIR]
+#
+# Starts the threaded server with the spawn executor and fires /run
+# requests from many clients at once.  `tempfile` is the old delivery
+# (NamedTemporaryFile(delete=False) + unlink per run) and writes to
+# --tmpdir; point that at a disk-backed directory to see the cost on hosts
+# without a tmpfs /tmp.  The file system type of that directory is
+# reported, along with any files the runs left behind.
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+PROGRAM = "total = sum(range(1000))\nprint(total)\n"
+
+
+class TempFileRunner(wca.SubprocessRunner):
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def run(self, code, timeout=10, on_output=None):
+        temp_file = None
+        process = None
+        try:
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False,
+                                             dir=self.directory) as f:
+                f.write(code)
+                temp_file = f.name
+            process = subprocess.Popen([self.python, temp_file],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return wca.pump_output(process, timeout, on_output)
+        finally:
+            if process is not None:
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+                process.stdout.close()
+                process.stderr.close()
+            if temp_file:
+                os.unlink(temp_file)
+
+
+def filesystem_type(path):
+    path = os.path.realpath(path)
+    best, kind = '', 'unknown'
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                mount_point, fs = fields[1], fields[2]
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                        and len(mount_point) > len(best):
+                    best, kind = mount_point, fs
+    except OSError:
+        pass
+    return kind
+
+
+def post_run(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.request('POST', '/run', json.dumps({'code': PROGRAM}),
+                     {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        body = json.loads(response.read())
+        return response.status == 200 and body['output'] == '499500\n'
+    finally:
+        conn.close()
+
+
+def measure(name, runner, requests, concurrency):
+    scheduler = wca.ExecutionScheduler(max_running=concurrency, max_queued=requests,
+                                       max_wait=60, client_rate=0)
+    server = wca.make_server('threaded', ('127.0.0.1', 0), max_in_flight=concurrency * 2,
+                             runner=runner, scheduler=scheduler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    try:
+        post_run(port)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(lambda _: post_run(port), range(requests)))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        'delivery': name,
+        'requests': requests,
+        'concurrency': concurrency,
+        'ok': results.count(True),
+        'runs_per_second': round(requests / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--tmpdir', default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    before = set(os.listdir(args.tmpdir))
+    for name, runner in (('tempfile', TempFileRunner(args.tmpdir)),
+                         ('stdin', wca.SubprocessRunner())):
+        result = measure(name, runner, args.requests, args.concurrency)
+        result['tmpdir_fs'] = filesystem_type(args.tmpdir) if name == 'tempfile' else None
+        print(json.dumps(result))
+    leaked = sorted(set(os.listdir(args.tmpdir)) - before)
+    print(json.dumps({'tmpdir': args.tmpdir, 'files_left_behind': len(leaked)}))
+
+
+if __name__ == '__main__':
+    main()
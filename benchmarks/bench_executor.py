@@ -0,0 +1,70 @@
+# /run latency of the spawn-per-request executor against the warm pool.
+#
+#   python benchmarks/bench_executor.py [--runs 200] [--concurrency 1]
+#
+# Times RequestHandler-independent executor calls for a trivial program, so
+# the numbers show interpreter startup versus a pipe round trip.
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+PROGRAM = "print('hello world')"
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def measure(name, runner, runs, concurrency):
+    def one(_):
+        started = time.perf_counter()
+        stdout, stderr = runner.run(PROGRAM, timeout=10)
+        assert stdout == 'hello world\n', (stdout, stderr)
+        return (time.perf_counter() - started) * 1000
+
+    # Let the pool finish starting its workers before timing.
+    runner.run(PROGRAM, timeout=10)
+    time.sleep(1)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(one, range(runs)))
+    elapsed = time.perf_counter() - started
+    return {
+        'executor': name,
+        'runs': runs,
+        'concurrency': concurrency,
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'runs_per_sec': round(runs / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--pool-size', type=int, default=4)
+    args = parser.parse_args()
+
+    runners = [
+        ('spawn', wca.SubprocessRunner()),
+        ('pool', wca.InterpreterPool(size=max(args.pool_size, args.concurrency))),
+    ]
+    for name, runner in runners:
+        try:
+            print(json.dumps(measure(name, runner, args.runs, args.concurrency)))
+        finally:
+            runner.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# /chat cost per message while editing a large file: full text vs. deltas.
+#
+#   python benchmarks/bench_incremental.py [--sizes 1000,5000,20000,50000]
+#
+# Each round changes one line in the middle of the file and asks to
+# "optimize".  `full` posts the whole editor text as the old client did;
+# `delta` posts only the changed line against the session document.
+# Payloads are measured as JSON bytes; times are server-side work
+# (document update plus generate_response), without HTTP.  The store has
+# its default limits; a size over them prints `"kept": false` for delta.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+from bench_analysis import generate
+
+
+def run_full(lines, rounds):
+    assistant = wca.CodeAssistant()
+    sizes, timings = [], []
+    for i in range(rounds):
+        lines[len(lines) // 2] = f'value = {i}'
+        payload = json.dumps({'message': 'optimize', 'code': '\n'.join(lines)})
+        started = time.perf_counter()
+        data = json.loads(payload)
+        assistant.generate_response(data['message'], data['code'])
+        timings.append(time.perf_counter() - started)
+        sizes.append(len(payload))
+    return sizes, timings
+
+
+def run_delta(lines, rounds):
+    assistant = wca.CodeAssistant()
+    store = wca.DocumentStore()
+    snapshot = store.sync('bench', '\n'.join(lines))
+    if snapshot is None:
+        # Over the store's limits: the server would analyze the full text.
+        return None
+    sizes, timings = [], []
+    middle = len(lines) // 2
+    for i in range(rounds):
+        delta = {'base': snapshot.version, 'start': middle, 'end': middle + 1,
+                 'lines': [f'value = {i}']}
+        payload = json.dumps({'message': 'optimize', 'delta': delta})
+        started = time.perf_counter()
+        data = json.loads(payload)
+        delta = data['delta']
+        snapshot = store.update('bench', delta['base'], delta['start'], delta['end'], delta['lines'])
+        assistant.generate_response(data['message'], snapshot)
+        timings.append(time.perf_counter() - started)
+        sizes.append(len(payload))
+    return sizes, timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,5000,20000,50000')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    for size in map(int, args.sizes.split(',')):
+        lines = generate(size).split('\n')
+        for name, run in (('full', run_full), ('delta', run_delta)):
+            result = run(list(lines), args.rounds)
+            if result is None:
+                print(json.dumps({'lines': len(lines), 'client': name, 'kept': False}))
+                continue
+            sizes, timings = result
+            timings.sort()
+            print(json.dumps({
+                'lines': len(lines),
+                'client': name,
+                'payload_bytes': sizes[-1],
+                'p50_ms': round(timings[len(timings) // 2] * 1000, 3),
+                'max_ms': round(timings[-1] * 1000, 3),
+            }))
+
+
+if __name__ == '__main__':
+    main()
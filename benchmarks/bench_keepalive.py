@@ -0,0 +1,94 @@
+# Connection setup overhead saved by persistent connections.
+#
+#   python benchmarks/bench_keepalive.py [--messages 500]
+#
+# Replays a chat session (page load, then a stream of /chat messages with an
+# occasional /run) once with a new TCP connection per request, the way the
+# HTTP/1.0 server forced, and once over a single persistent connection.
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+CODE = "def add(a, b):\n    return a + b\n\nprint(add(2, 3))\n"
+MESSAGES = ['explain this code', 'debug this', 'optimize it', 'write a sort function', 'help']
+
+
+def session(messages):
+    yield 'GET', '/', None
+    yield 'GET', '/style.css', None
+    yield 'GET', '/script.js', None
+    for i in range(messages):
+        yield 'POST', '/chat', json.dumps({'message': MESSAGES[i % len(MESSAGES)], 'code': CODE})
+        if i % 10 == 9:
+            yield 'POST', '/run', json.dumps({'code': CODE})
+
+
+def replay(port, messages, persistent):
+    connections = 0
+    conn = None
+    started = time.perf_counter()
+    for method, path, body in session(messages):
+        if conn is None or not persistent:
+            if conn is not None:
+                conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.connect()
+            connections += 1
+        conn.request(method, path, body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        if response.will_close and persistent:
+            conn.close()
+            conn = None
+    conn.close()
+    return time.perf_counter() - started, connections
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--modes', default='threaded,async')
+    args = parser.parse_args()
+
+    wca.RequestHandler.max_keepalive_requests = 10 ** 6
+    runner = wca.InterpreterPool(size=2)
+    try:
+        for mode in args.modes.split(','):
+            server = wca.make_server(mode, ('127.0.0.1', 0), runner=runner,
+                                     scheduler=wca.ExecutionScheduler(client_rate=0))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            if mode == 'async':
+                server._started.wait()
+            port = server.server_address[1]
+            replay(port, 20, True)
+
+            per_request, opened = replay(port, args.messages, persistent=False)
+            keepalive, reused = replay(port, args.messages, persistent=True)
+            requests = sum(1 for _ in session(args.messages))
+            print(json.dumps({
+                'mode': mode,
+                'requests': requests,
+                'connection_per_request_s': round(per_request, 3),
+                'connections_opened': opened,
+                'keepalive_s': round(keepalive, 3),
+                'keepalive_connections': reused,
+                'saved_per_request_ms': round((per_request - keepalive) / requests * 1000, 3),
+            }))
+            server.shutdown()
+            server.server_close()
+    finally:
+        runner.close()
+
+
+if __name__ == '__main__':
+    main()
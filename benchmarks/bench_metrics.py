@@ -0,0 +1,109 @@
+# Cost of the /metrics instrumentation on request throughput.
+#
+#   python benchmarks/bench_metrics.py [--clients 8] [--seconds 5] [--rounds 3]
+#
+# Every client sends a mix of GET /script.js, GET /stats and POST /chat over a
+# keep-alive connection for --seconds, once with metrics recording and once
+# with `metrics.enabled = False`; the two alternate for --rounds to even
+# out machine noise.  On a busy machine that difference is within noise,
+# so `record_ns` also times what a request pays on its own: the route
+# label, one counter, one histogram and two byte counters.  `scrape_ms` is
+# the time to render /metrics once the runs have filled the series.
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+CHAT = json.dumps({'message': 'explain this code', 'code': 'print(sum(range(10)))\n'})
+
+
+def client(port, deadline, counts):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    served = 0
+    while time.perf_counter() < deadline:
+        for method, path, body in (('GET', '/script.js', None), ('GET', '/stats', None),
+                                   ('POST', '/chat', CHAT)):
+            conn.request(method, path, body, {'Content-Type': 'application/json'})
+            conn.getresponse().read()
+            served += 1
+    counts.append(served)
+    conn.close()
+
+
+def measure(enabled, clients, seconds):
+    wca.metrics.enabled = enabled
+    server = wca.make_server('threaded', ('127.0.0.1', 0), max_in_flight=clients * 2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    counts = []
+    deadline = time.perf_counter() + seconds
+    threads = [threading.Thread(target=client, args=(server.server_address[1], deadline, counts))
+               for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+    return sum(counts) / elapsed
+
+
+def record_ns(enabled, count=100000):
+    wca.metrics.enabled = enabled
+    handler = wca.RequestHandler.__new__(wca.RequestHandler)
+    handler.path = '/chat'
+    handler.command = 'POST'
+    handler.response_status = 200
+    handler.bytes_received = 120
+    handler.bytes_sent = 900
+    started = time.perf_counter()
+    for _ in range(count):
+        handler.request_started = started
+        handler.record_request()
+    return round((time.perf_counter() - started) / count * 1e9, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    rates = {True: [], False: []}
+    for _ in range(args.rounds):
+        for enabled in (False, True):
+            rates[enabled].append(measure(enabled, args.clients, args.seconds))
+    off = sorted(rates[False])[len(rates[False]) // 2]
+    on = sorted(rates[True])[len(rates[True]) // 2]
+    print(json.dumps({
+        'clients': args.clients,
+        'disabled_rps': round(off, 1),
+        'enabled_rps': round(on, 1),
+        'overhead_percent': round((off - on) / off * 100, 2),
+    }))
+
+    started = time.perf_counter()
+    text = wca.metrics.render()
+    scrape = time.perf_counter() - started
+    print(json.dumps({
+        'record_ns': record_ns(True),
+        'record_disabled_ns': record_ns(False),
+        'scrape_ms': round(scrape * 1000, 3),
+        'series': sum(len(metric.series) for metric in wca.metrics.metrics),
+        'scrape_bytes': len(text),
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# /chat throughput and latency with history written to SQLite.
+#
+#   python benchmarks/bench_persistence.py [--clients 16] [--seconds 5]
+#                                          [--db /tmp/bench.db]
+#
+# Every client has its own session cookie and posts /chat messages over a
+# keep-alive connection for --seconds.  Each message writes three rows
+# (session, question, answer).  `memory` keeps history in memory only;
+# `per-write` commits every row from the request thread, one transaction
+# each; `batched` is SQLiteStore, whose writer thread commits whatever has
+# queued.  Rows per second are counted once everything queued has been
+# committed.
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+MESSAGES = ['explain this code', 'write a function', 'help', 'what does it do', 'debug it']
+CODE = "def total(values):\n    result = 0\n    for value in values:\n        result += value\n    return result\n"
+
+
+class PerWriteStore(wca.SQLiteStore):
+    # Commits each write on the calling thread.
+    def __init__(self, path):
+        super().__init__(path)
+        self._conn = self._connect()
+        self._lock = threading.Lock()
+
+    def _enqueue(self, sql, params):
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.execute(sql, params)
+            self._conn.execute('COMMIT')
+            self.written += 1
+            self.batches += 1
+
+    def close(self):
+        super().close()
+        self._conn.close()
+
+
+def client(port, deadline, latencies):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    cookie = {}
+    i = 0
+    while time.perf_counter() < deadline:
+        body = json.dumps({'message': f'{MESSAGES[i % len(MESSAGES)]} #{i}', 'code': CODE})
+        started = time.perf_counter()
+        conn.request('POST', '/chat', body, dict(cookie, **{'Content-Type': 'application/json'}))
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - started)
+        if response.getheader('Set-Cookie'):
+            cookie = {'Cookie': response.getheader('Set-Cookie').split(';')[0]}
+        i += 1
+    conn.close()
+
+
+def remove(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+
+
+def measure(name, db, clients, seconds):
+    wca.sessions = wca.SessionStore(db=db)
+    server = wca.make_server('threaded', ('127.0.0.1', 0), max_in_flight=clients * 2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    threads = [threading.Thread(target=client, args=(server.server_address[1], deadline, latencies))
+               for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    served = time.perf_counter() - started
+    if db is not None:
+        db.flush()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+    latencies.sort()
+    result = {
+        'store': name,
+        'clients': clients,
+        'requests_per_second': round(len(latencies) / served, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    }
+    if db is not None:
+        stats = db.stats()
+        result.update(rows_per_second=round(stats['written'] / elapsed, 1),
+                      rows_per_commit=round(stats['written'] / max(stats['batches'], 1), 1),
+                      dropped=stats['dropped'])
+        db.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--db', default='/tmp/bench_persistence.db')
+    args = parser.parse_args()
+
+    for name in ('memory', 'per-write', 'batched'):
+        remove(args.db)
+        db = {'memory': None, 'per-write': lambda: PerWriteStore(args.db),
+              'batched': lambda: wca.SQLiteStore(args.db)}[name]
+        print(json.dumps(measure(name, db and db(), args.clients, args.seconds)))
+    remove(args.db)
+
+
+if __name__ == '__main__':
+    main()
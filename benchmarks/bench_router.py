@@ -0,0 +1,100 @@
+# Cost of routing a /chat message to an intent as the intent table grows.
+#
+#   python benchmarks/bench_router.py [--intents 5,50,500] [--messages 2000]
+#
+# `chain` is the old router: one substring test per keyword, in priority
+# order, until one hits.  `index` is IntentRouter.  With the real table
+# (5 intents) both are timed on a mix of chat messages; the larger tables
+# add synthetic intents with made-up keywords below the real ones, so most
+# messages fall through every test of the chain.  A mismatch count
+# compares the two on the real table ("prefix" and the like).
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+TABLE = [
+    ('help', 50, ('help',)),
+    ('explain', 40, ('explain',)),
+    ('debug', 30, ('debug', 'fix')),
+    ('write', 20, ('write', 'create')),
+    ('optimize', 10, ('optimize',)),
+]
+
+MESSAGES = [
+    'can you explain what this function does',
+    'please fix the bug on line 3',
+    'write a function to reverse a string',
+    'how do I optimize this loop',
+    'what is the difference between a list and a tuple in python',
+    'add a prefix to every key in the dictionary',
+    'thanks, that worked great',
+    'I need help debugging this recursion',
+    'create a class for a bank account with deposit and withdraw methods',
+    'why is my code so slow when the input gets large',
+]
+
+
+def chain_router(table, default='general'):
+    def route(message_lower):
+        for intent, _, keywords in table:
+            for keyword in keywords:
+                if keyword in message_lower:
+                    return intent
+        return default
+    return route
+
+
+def synthetic_table(count, rng):
+    table = list(TABLE)
+    for i in range(count - len(TABLE)):
+        keywords = tuple(''.join(rng.choice('bcdfghjklmnpqrstvwxz') for _ in range(7)) + str(i)
+                         for _ in range(3))
+        table.append((f'intent{i}', -i, keywords))
+    return table
+
+
+def per_message_ns(route, messages, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            route(message)
+    return round((time.perf_counter() - started) / (rounds * len(messages)) * 1e9, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--intents', default='5,50,500')
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    messages = [rng.choice(MESSAGES).lower() for _ in range(args.messages)]
+    rounds = 5
+
+    chain = chain_router(TABLE)
+    index = wca.IntentRouter(TABLE, 'general')
+    mismatches = sorted({m for m in MESSAGES if chain(m.lower()) != index.route(m.lower())})
+    print(json.dumps({'real_table_mismatches': mismatches}))
+
+    for count in map(int, args.intents.split(',')):
+        table = synthetic_table(count, rng)
+        chain = chain_router(table)
+        index = wca.IntentRouter(table, 'general')
+        index.route(messages[0])
+        print(json.dumps({
+            'intents': len(table),
+            'keywords': sum(len(keywords) for _, _, keywords in table),
+            'chain_ns': per_message_ns(chain, messages, rounds),
+            'index_ns': per_message_ns(index.route, messages, rounds),
+        }))
+
+
+if __name__ == '__main__':
+    main()
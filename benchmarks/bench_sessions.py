@@ -0,0 +1,77 @@
+# Memory held by /chat history as the number of sessions grows.
+#
+#   python benchmarks/bench_sessions.py [--sessions 1000,10000,50000]
+#                                       [--turns 10] [--max-bytes 8388608]
+#
+# Every session sends --turns messages and gets a reply of a few hundred
+# characters to each.  `unbounded` keeps a plain list of dicts per session
+# with no limit; `store` is SessionStore with the default ring size and a
+# --max-bytes ceiling.  Memory is what tracemalloc sees the structure
+# holding once all sessions are in; `estimate` is the store's own count.
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+
+def conversation(session, turns):
+    for turn in range(turns):
+        yield 'user', f'explain this code please ({session}/{turn})'
+        yield 'assistant', f'**Code Analysis:** session {session} turn {turn}\n' * 8
+
+
+class Unbounded:
+    def __init__(self):
+        self.history = {}
+
+    def append(self, session_id, role, text):
+        self.history.setdefault(session_id, []).append(
+            {'role': role, 'text': text, 'created': time.monotonic()})
+
+
+def measure(name, store, sessions, turns):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    for i in range(sessions):
+        session_id = os.urandom(16).hex()
+        for role, text in conversation(i, turns):
+            store.append(session_id, role, text)
+    elapsed = time.perf_counter() - started
+    held = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    result = {
+        'store': name,
+        'sessions': sessions,
+        'messages': sessions * turns * 2,
+        'held_bytes': held,
+        'append_us': round(elapsed / (sessions * turns * 2) * 1e6, 2),
+    }
+    if isinstance(store, wca.SessionStore):
+        stats = store.stats()
+        result['estimate_bytes'] = stats['bytes']
+        result['sessions_kept'] = stats['sessions']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', default='1000,10000,50000')
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--max-bytes', type=int, default=8 * 1024 * 1024)
+    args = parser.parse_args()
+
+    for sessions in map(int, args.sessions.split(',')):
+        for name, store in (('unbounded', Unbounded()),
+                            ('store', wca.SessionStore(max_bytes=args.max_bytes))):
+            print(json.dumps(measure(name, store, sessions, args.turns)))
+
+
+if __name__ == '__main__':
+    main()
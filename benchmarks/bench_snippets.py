@@ -0,0 +1,91 @@
+# Page weight and /snippets search latency as the snippet library grows.
+#
+#   python benchmarks/bench_snippets.py [--sizes 1000,10000,100000]
+#
+# Libraries are generated across a dozen languages with titles drawn from
+# a small vocabulary, so common words have long posting lists.  `embedded`
+# is what script.js would weigh with the library inlined, as it used to
+# be; `served` is the script as shipped now.  Search times are
+# SnippetStore.search() alone, without HTTP, for a mix of language-only,
+# prefix, multi-word, rare-word and deep-page queries; the slowest first
+# run of a query is reported apart from the repeats.  Memory is what
+# tracemalloc sees while building the store; the build is timed without it.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+LANGUAGES = ['Python', 'JavaScript', 'TypeScript', 'Go', 'Rust', 'Java', 'C', 'C++',
+             'Ruby', 'PHP', 'Kotlin', 'Swift']
+WORDS = ['read', 'write', 'file', 'list', 'sort', 'parse', 'json', 'http', 'request', 'class',
+         'async', 'retry', 'cache', 'thread', 'queue', 'string', 'reverse', 'merge', 'map',
+         'filter', 'date', 'format', 'regex', 'socket', 'test', 'logging', 'config', 'matrix']
+QUERIES = [('Python', ''), ('', 'fi'), ('Go', 'parse json'), ('', 'sort list reverse'),
+           ('Rust', 'thread'), ('', 'helper17'), ('JavaScript', 'http request')]
+
+
+def generate(size, rng):
+    store = wca.SnippetStore()
+    for i in range(size):
+        title = ' '.join(rng.sample(WORDS, 3)).title()
+        code = f"def helper{i}(value):\n    # {title}\n    return {rng.choice(WORDS)}(value)\n"
+        store.add(rng.choice(LANGUAGES), title, code, tags=(rng.choice(WORDS),))
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    served = len(wca.RequestHandler.get_js().encode())
+    for size in map(int, args.sizes.split(',')):
+        tracemalloc.start()
+        store = generate(size, random.Random(size))
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del store
+        started = time.perf_counter()
+        store = generate(size, random.Random(size))
+        build = time.perf_counter() - started
+
+        library = {}
+        for snippet in store.snippets:
+            library.setdefault(snippet.language, {})[snippet.title + str(snippet.id)] = snippet.code
+        embedded = served + len(json.dumps(library).encode())
+
+        cold = []
+        for language, query in QUERIES:
+            started = time.perf_counter()
+            store.search(language, query, 1)
+            cold.append(time.perf_counter() - started)
+        timings = []
+        for _ in range(args.rounds):
+            for language, query in QUERIES:
+                for page in (1, 5):
+                    started = time.perf_counter()
+                    store.search(language, query, page)
+                    timings.append(time.perf_counter() - started)
+        timings.sort()
+        print(json.dumps({
+            'snippets': size,
+            'script_bytes_embedded': embedded,
+            'script_bytes_served': served,
+            'build_seconds': round(build, 3),
+            'store_bytes': memory,
+            'first_search_max_us': round(max(cold) * 1e6, 1),
+            'search_p50_us': round(timings[len(timings) // 2] * 1e6, 1),
+            'search_p99_us': round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+        }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# Requests/sec for the static assets, before and after the startup cache.
+#
+#   python benchmarks/bench_static.py [--requests 2000] [--concurrency 4]
+#
+# "before" uses a handler that rebuilds and encodes each asset per request
+# like the original do_GET; "after" is the current RequestHandler, fetched
+# with and without gzip and with a conditional GET.
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+PATHS = ['/', '/style.css', '/script.js']
+
+
+class RebuildingHandler(wca.RequestHandler):
+    # The original handler spoke HTTP/1.0 and sent no Content-Length, so
+    # the end of the response was the end of the connection.
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        if self.path == '/':
+            self.send_response(200)
+            self.send_header('Content-type', 'text/html')
+            self.end_headers()
+            self.wfile.write(self.get_html().encode())
+        elif self.path == '/style.css':
+            self.send_response(200)
+            self.send_header('Content-type', 'text/css')
+            self.end_headers()
+            self.wfile.write(self.get_css().encode())
+        elif self.path == '/script.js':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/javascript')
+            self.end_headers()
+            self.wfile.write(self.get_js().encode())
+
+
+def start(handler_class):
+    server = wca.BoundedThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fetch(port, path, headers):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        return response.status, len(response.read())
+    finally:
+        conn.close()
+
+
+def measure(label, port, path, headers, requests, concurrency):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda _: fetch(port, path, headers), range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        'variant': label,
+        'path': path,
+        'status': results[0][0],
+        'body_bytes': results[0][1],
+        'requests_per_sec': round(requests / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    before = start(RebuildingHandler)
+    after = start(wca.RequestHandler)
+    try:
+        for path in PATHS:
+            etag = wca.static_assets[path].variants['gzip'][1]
+            variants = [
+                ('before', before, {}),
+                ('after', after, {}),
+                ('after+gzip', after, {'Accept-Encoding': 'gzip'}),
+                ('after+304', after, {'Accept-Encoding': 'gzip', 'If-None-Match': etag}),
+            ]
+            for label, server, headers in variants:
+                result = measure(label, server.server_address[1], path, headers,
+                                 args.requests, args.concurrency)
+                print(json.dumps(result))
+    finally:
+        for server in (before, after):
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
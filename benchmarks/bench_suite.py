@@ -0,0 +1,366 @@
+# Load generator for regression checks between versions.
+#
+#   python benchmarks/bench_suite.py [--mix browse,chat,run,mixed]
+#                                    [--concurrency 1,8,32] [--seconds 10]
+#                                    [--mode threaded|async|single]
+#                                    [--executor spawn|pool] [--fresh 0.5]
+#                                    [--output bench_suite.json]
+#                                    [--baseline old.json] [--tolerance 10]
+#
+# Starts the server in-process on a free local port and, for every mix and
+# concurrency level, runs that many keep-alive clients for --seconds after
+# --warmup seconds that are not counted.  Mixes:
+#
+#   browse  GET / and the static assets, as a page load does
+#   chat    /chat, evenly over every intent of generate_response plus a
+#           follow-up that resolves through the session history
+#   run     /run with a handful of short programs
+#   mixed   the blend seen in production: mostly chat, some runs, and a
+#           page load now and then
+#
+# --fresh is the fraction of /chat and /run requests sent with code no
+# earlier request used (and `cache: false` for /run), so that the response
+# and run caches see misses as well as hits.  Results are printed as JSON
+# lines and written, with the git revision, Python version and CPU count,
+# to --output.  With --baseline, requests/s and p99 are compared against
+# an earlier output file; a change worse than --tolerance percent is
+# printed as a regression and the exit status is 1.
+#
+# Clients run in this process, so they share its CPU and GIL with the
+# server; compare results from the same machine only.  `rss` is this
+# process, sampled every 100ms: it covers the server but not the programs
+# /run starts.
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import web_coding_assistant as wca
+
+wca.RequestHandler.log_message = lambda *args: None
+
+CODE = [
+    "def total(values):\n    result = 0\n    for value in values:\n        result += value\n    return result\n",
+    "class Stack:\n    def __init__(self):\n        self.items = []\n\n    def push(self, item):\n"
+    "        self.items.append(item)\n",
+    "import os\n\nfor name in sorted(os.listdir('.')):\n    print(name)\n",
+]
+
+CHAT_MESSAGES = {
+    'help': 'help me write a function',
+    'explain': 'explain this code',
+    'debug': 'can you fix this',
+    'write': 'write a function to sort a list',
+    'optimize': 'optimize this loop',
+    'general': 'what do you think about python',
+    'follow_up': 'do that again',
+}
+
+# Shared by every client and run so that fresh code is never repeated.
+fresh_ids = itertools.count()
+
+PROGRAMS = [
+    "print(sum(range(1000)))\n",
+    "words = 'the quick brown fox'.split()\nprint(sorted(words))\n",
+    "import json\nprint(json.dumps({'a': [1, 2, 3]}))\n",
+]
+
+
+class Client:
+    # One keep-alive connection with its own session cookie.
+    def __init__(self, port, seed, fresh):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        self.rng = random.Random(seed)
+        self.fresh = fresh
+        self.cookie = {}
+
+    def request(self, method, path, body=None):
+        headers = dict(self.cookie)
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            return 0
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = {'Cookie': cookie.split(';')[0]}
+        return response.status
+
+    def code(self, samples):
+        code = self.rng.choice(samples)
+        if self.rng.random() < self.fresh:
+            return code + f'# {next(fresh_ids)}\n', True
+        return code, False
+
+    def page(self):
+        return self.request('GET', '/')
+
+    def static(self):
+        return self.request('GET', self.rng.choice(('/style.css', '/script.js')))
+
+    def chat(self, intent):
+        code, _ = self.code(CODE)
+        if intent == 'follow_up':
+            self.request('POST', '/chat', {'message': CHAT_MESSAGES['explain'], 'code': code})
+        return self.request('POST', '/chat', {'message': CHAT_MESSAGES[intent], 'code': code})
+
+    def run(self):
+        code, fresh = self.code(PROGRAMS)
+        return self.request('POST', '/run', {'code': code, 'cache': not fresh})
+
+
+def chat_op(intent):
+    return lambda client: client.chat(intent)
+
+
+OPS = {
+    'page': Client.page,
+    'static': Client.static,
+    'run': Client.run,
+}
+OPS.update((f'chat_{intent}', chat_op(intent)) for intent in CHAT_MESSAGES)
+
+# Operation weights per mix.
+MIXES = {
+    'browse': {'page': 1, 'static': 2},
+    'chat': {f'chat_{intent}': 1 for intent in CHAT_MESSAGES},
+    'run': {'run': 1},
+    'mixed': dict({'page': 2, 'static': 4, 'run': 20},
+                  **{f'chat_{intent}': 10 for intent in CHAT_MESSAGES}),
+}
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        if wca.resource is None:
+            return 0
+        # Peak rather than current where /proc is missing.
+        rss = wca.resource.getrusage(wca.resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, interval=0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.start_bytes = self.peak_bytes = rss_bytes()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, rss_bytes())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        end = rss_bytes()
+        return {'start_bytes': self.start_bytes, 'peak_bytes': max(self.peak_bytes, end),
+                'end_bytes': end}
+
+
+def client_loop(client, ops, weights, warmup_until, deadline, samples):
+    while True:
+        name = client.rng.choices(ops, weights)[0]
+        started = time.perf_counter()
+        if started >= deadline:
+            break
+        status = OPS[name](client)
+        finished = time.perf_counter()
+        if started >= warmup_until:
+            samples.append((name, finished - started, status))
+    client.conn.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return round(sorted_values[index] * 1000, 3)
+
+
+def latency_summary(latencies):
+    latencies.sort()
+    return {
+        'p50_ms': percentile(latencies, 0.5),
+        'p90_ms': percentile(latencies, 0.9),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': percentile(latencies, 1.0),
+    }
+
+
+def measure(server, mix, concurrency, args):
+    ops = list(MIXES[mix])
+    weights = [MIXES[mix][name] for name in ops]
+    samples = []
+    port = server.server_address[1]
+    clients = [Client(port, args.seed + i, args.fresh) for i in range(concurrency)]
+    sampler = RSSSampler()
+    sampler.start()
+    warmup_until = time.perf_counter() + args.warmup
+    deadline = warmup_until + args.seconds
+    threads = [threading.Thread(target=client_loop,
+                                args=(client, ops, weights, warmup_until, deadline, samples))
+               for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - warmup_until
+    rss = sampler.stop()
+
+    statuses = {}
+    by_op = {}
+    for name, latency, status in samples:
+        statuses[status] = statuses.get(status, 0) + 1
+        by_op.setdefault(name, []).append(latency)
+    errors = sum(count for status, count in statuses.items() if not 200 <= status < 300)
+    result = {
+        'mix': mix,
+        'concurrency': concurrency,
+        'requests': len(samples),
+        'errors': errors,
+        'requests_per_second': round(len(samples) / elapsed, 1),
+    }
+    result.update(latency_summary([latency for _, latency, _ in samples]))
+    result['statuses'] = {str(status): count for status, count in sorted(statuses.items())}
+    result['operations'] = {name: dict(count=len(latencies), **latency_summary(latencies))
+                            for name, latencies in sorted(by_op.items())}
+    result['rss'] = rss
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, options, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        report = json.load(f)
+    baseline = {(r['mix'], r['concurrency']): r for r in report['results']}
+    for option in ('mode', 'executor', 'max_runs', 'fresh', 'seconds'):
+        if report['options'].get(option) != options[option]:
+            print(json.dumps({'warning': f'baseline was run with a different --{option.replace("_", "-")}',
+                              'before': report['options'].get(option), 'after': options[option]}))
+    regressions = 0
+    for result in results:
+        before = baseline.get((result['mix'], result['concurrency']))
+        if before is None:
+            continue
+        # Positive change is always worse: fewer requests/s, or higher p99.
+        changes = {
+            'requests_per_second': (before['requests_per_second'] - result['requests_per_second'])
+                                   / before['requests_per_second'] * 100,
+            'p99_ms': (result['p99_ms'] - before['p99_ms']) / before['p99_ms'] * 100,
+        }
+        for metric, change in changes.items():
+            regressed = change > tolerance
+            regressions += regressed
+            print(json.dumps({'compare': metric, 'mix': result['mix'],
+                              'concurrency': result['concurrency'], 'before': before[metric],
+                              'after': result[metric], 'worse_percent': round(change, 1),
+                              'regression': regressed}))
+    return regressions
+
+
+def check_intents():
+    # Each chat_<intent> operation must reach the path it is named after;
+    # follow_up only counts if it resolves through the history.
+    assistant = wca.CodeAssistant()
+    history = [wca.Message('user', CHAT_MESSAGES['explain'], time.time())]
+    for intent, message in CHAT_MESSAGES.items():
+        routed = assistant.classify_intent(message.lower())
+        if intent == 'follow_up':
+            assert routed == 'general', routed
+            routed = assistant.follow_up_intent(message.lower(), history)
+            intent = 'explain'
+        assert routed == intent, f'{message!r} routed to {routed}, not {intent}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mix', default='browse,chat,run,mixed')
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--mode', choices=['threaded', 'async', 'single'], default='threaded')
+    parser.add_argument('--executor', choices=['spawn', 'pool'], default='spawn')
+    parser.add_argument('--max-runs', type=int, default=16)
+    parser.add_argument('--fresh', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_suite.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=10)
+    args = parser.parse_args()
+
+    mixes = args.mix.split(',')
+    for mix in mixes:
+        if mix not in MIXES:
+            parser.error(f'unknown mix {mix!r}; choose from {", ".join(MIXES)}')
+    levels = [int(level) for level in args.concurrency.split(',')]
+    check_intents()
+
+    runner = wca.InterpreterPool(size=args.max_runs) if args.executor == 'pool' else wca.SubprocessRunner()
+    # Every client connects from 127.0.0.1, so the per-client rate limit
+    # would turn most runs into 429s.
+    scheduler = wca.ExecutionScheduler(max_running=args.max_runs, max_queued=max(levels) * 2,
+                                       max_wait=60, client_rate=0)
+    server = wca.make_server(args.mode, ('127.0.0.1', 0), max_in_flight=max(max(levels) * 2, 64),
+                             runner=runner, scheduler=scheduler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if args.mode == 'async':
+        server._started.wait()
+
+    results = []
+    try:
+        for mix in mixes:
+            for level in levels:
+                result = measure(server, mix, level, args)
+                print(json.dumps({key: value for key, value in result.items()
+                                  if key != 'operations'}))
+                results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.jobs.close()
+        runner.close()
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'options': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    if args.baseline and compare(results, vars(args), args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
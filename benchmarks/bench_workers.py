@@ -0,0 +1,128 @@
+# /chat throughput as the number of server processes grows.
+#
+#   python benchmarks/bench_workers.py [--workers 1,2,4] [--clients 16]
+#                                      [--seconds 10] [--port 8765]
+#
+# For each --workers count the server is started as its own process tree
+# (the supervisor and its workers), and --clients client processes post
+# /chat over keep-alive connections for --seconds after a second of
+# warm-up.  Every message carries code no earlier one did, so each answer
+# is analysed rather than served from the response cache.  The clients
+# are processes so that they do not share one GIL; they do share the
+# machine's cores with the server, so speedup flattens well before
+# `cpu_count` workers.  `per_worker` shows how evenly the kernel spread
+# requests, counted from /stats of each worker.
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web_coding_assistant.py')
+
+CODE = "def total(values):\n    result = 0\n    for value in values:\n        result += value\n    return result\n"
+
+
+def client(port, index, warmup_until, deadline):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    served = errors = i = 0
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        body = json.dumps({'message': 'explain this code', 'code': f'{CODE}# {index}-{i}\n'})
+        i += 1
+        try:
+            conn.request('POST', '/chat', body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            ok = False
+        if now >= warmup_until:
+            served += ok
+            errors += not ok
+    conn.close()
+    return served, errors
+
+
+def wait_until_serving(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/stats')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+
+def worker_requests(port, workers):
+    # Distinct workers answering /stats, each with its own request count;
+    # a new connection per request lets the kernel pick the worker.
+    seen = {}
+    for _ in range(workers * 20):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/stats')
+        stats = json.loads(conn.getresponse().read())
+        conn.close()
+        seen[stats['process']['worker']] = stats['response_cache'].get('misses')
+        if len(seen) == workers:
+            break
+    return seen
+
+
+def measure(workers, args):
+    log = open(os.devnull, 'w')
+    server = subprocess.Popen([sys.executable, SERVER, '--host', '127.0.0.1', '--port', str(args.port),
+                               '--workers', str(workers), '--client-run-rate', '0'],
+                              stdout=log, stderr=log)
+    try:
+        wait_until_serving(args.port)
+        warmup_until = time.time() + 1
+        deadline = warmup_until + args.seconds
+        with multiprocessing.Pool(args.clients) as pool:
+            results = pool.starmap(client, [(args.port, i, warmup_until, deadline)
+                                            for i in range(args.clients)])
+        per_worker = worker_requests(args.port, workers)
+    finally:
+        server.terminate()
+        server.wait()
+        log.close()
+    served = sum(result[0] for result in results)
+    return {
+        'workers': workers,
+        'clients': args.clients,
+        'requests_per_second': round(served / args.seconds, 1),
+        'errors': sum(result[1] for result in results),
+        'per_worker': {str(worker): count for worker, count in sorted(per_worker.items(),
+                                                                      key=lambda item: str(item[0]))},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    print(json.dumps({'cpu_count': os.cpu_count()}))
+    baseline = None
+    for workers in map(int, args.workers.split(',')):
+        result = measure(workers, args)
+        baseline = baseline or result['requests_per_second']
+        result['speedup'] = round(result['requests_per_second'] / baseline, 2) if baseline else None
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,1546 @@
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import bisect
+import codecs
+import cProfile
+import functools
+import gzip
+import hashlib
+import http.cookies
+import io
+import itertools
 import json
+import math
 import urllib.parse
 import os
+import pstats
+import queue
+import re
+import select
+import socketserver
+import selectors
+import signal
+import socket
+import struct
 import subprocess
-import tempfile
+import sys
 import threading
 import time
+import zlib
 
-class CodeAssistant:
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+class LRUCache:
+    # Thread-safe LRU map with an optional per-entry TTL.  Counters are kept
+    # so the hit rate can be watched through /stats.  With max_bytes set,
+    # entries are also evicted to keep the sum of sizeof(value) under it.
+    def __init__(self, maxsize=1024, ttl=None, max_bytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires, size = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.bytes -= size
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._entries[key] = (value, expires, size)
+            self.bytes += size
+            while len(self._entries) > self.maxsize or (
+                    self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+            if self.max_bytes is not None:
+                stats['bytes'] = self.bytes
+                stats['max_bytes'] = self.max_bytes
+            return stats
+
+
+def code_digest(code):
+    return hashlib.blake2b(code.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            series = list(self.series.items())
+        for labels, value in series:
+            yield f'{self.name}{format_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    # One list per label set: a count per bucket (the last one is +Inf)
+    # followed by the sum.  Buckets are made cumulative when rendered.
+    def __init__(self, registry, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        if not self.registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.series.get(labels)
+            if counts is None:
+                counts = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = [(labels, counts[:]) for labels, counts in self.series.items()]
+        names = self.labelnames + ('le',)
+        for labels, counts in series:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield f'{self.name}_bucket{format_labels(names, labels + (bound,))} {total}'
+            yield f'{self.name}_sum{format_labels(self.labelnames, labels)} {counts[-1]}'
+            yield f'{self.name}_count{format_labels(self.labelnames, labels)} {total}'
+
+
+class MetricsRegistry:
+    # Counters and histograms rendered in the Prometheus text format.
+    # Recording takes one uncontended lock per metric; `enabled = False`
+    # turns every record into a no-op.
     def __init__(self):
-        self.conversation_history = []
-        self.code_snippets = {
-            "Python": {
-                "Function": "def function_name(param1, param2):\n    '''Description'''\n    return result",
-                "Class": "class ClassName:\n    def __init__(self, param):\n        self.param = param\n    \n    def method(self):\n        pass",
-                "Try-Except": "try:\n    # Code here\n    pass\nexcept Exception as e:\n    print(f'Error: {e}')",
-                "File Reading": "with open('filename.txt', 'r') as file:\n    content = file.read()",
-                "API Request": "import requests\nresponse = requests.get('https://api.example.com/data')\ndata = response.json()"
-            },
-            "JavaScript": {
-                "Function": "function functionName(param1, param2) {\n    return result;\n}",
-                "Arrow Function": "const functionName = (param1, param2) => {\n    return result;\n};",
-                "Class": "class ClassName {\n    constructor(param) {\n        this.param = param;\n    }\n    \n    method() {\n        return this.param;\n    }\n}",
-                "Async Function": "async function fetchData() {\n    try {\n        const response = await fetch('url');\n        const data = await response.json();\n        return data;\n    } catch (error) {\n        console.error('Error:', error);\n    }\n}"
+        self.enabled = True
+        self.metrics = []
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(self, name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(self, name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, gauges=()):
+        # `gauges` are extra (name, help, value) samples read at scrape time.
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for name, help, value in gauges:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        lines.append('')
+        return '\n'.join(lines)
+
+
+metrics = MetricsRegistry()
+http_requests = metrics.counter(
+    'http_requests_total', 'Requests answered, by route, method and status.',
+    ('route', 'method', 'status'))
+http_request_seconds = metrics.histogram(
+    'http_request_duration_seconds', 'Time from the request line to the end of the response.',
+    ('route', 'method'))
+http_request_bytes = metrics.counter(
+    'http_request_body_bytes_total', 'Request body bytes read.', ('route',))
+http_response_bytes = metrics.counter(
+    'http_response_body_bytes_total', 'Response body bytes written.', ('route',))
+assistant_seconds = metrics.histogram(
+    'assistant_response_seconds', 'Time to answer a /chat message, by intent.', ('intent',))
+runner_startup_seconds = metrics.histogram(
+    'runner_startup_seconds', 'Time from run() until the program was handed to an interpreter.',
+    ('executor',))
+runner_execution_seconds = metrics.histogram(
+    'runner_execution_seconds', 'Time run() took, by executor and outcome.', ('executor', 'outcome'))
+
+
+def metered(run):
+    # Wraps a runner's run() to record its duration and outcome.
+    @functools.wraps(run)
+    def wrapper(self, code, *args, **kwargs):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = run(self, code, *args, **kwargs)
+            outcome = 'ok'
+            return result
+        except subprocess.TimeoutExpired:
+            outcome = 'timeout'
+            raise
+        except RunCancelled:
+            outcome = 'cancelled'
+            raise
+        except OutputLimitExceeded:
+            outcome = 'truncated'
+            raise
+        except ResourceLimitExceeded:
+            outcome = 'limit'
+            raise
+        finally:
+            runner_execution_seconds.observe(time.perf_counter() - started,
+                                             (type(self).__name__, outcome))
+            if profiler.active:
+                profiler.lap('execute')
+    return wrapper
+
+
+class RequestProfile:
+    # Wall-clock phases of one profiled request.  Each lap charges the time
+    # since the previous one to the named phase.
+    def __init__(self, session, started):
+        self.session = session
+        self.last = started
+        self.phases = {}
+        self.profile = None
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+
+class ProfileSession:
+    def __init__(self, mode, requests, seconds, interval):
+        self.mode = mode
+        self.requests = requests
+        self.seconds = seconds
+        self.interval = interval
+        self.started = time.monotonic()
+        self.claimed = 0
+        self.profiled = 0
+        self.untraced = 0
+        self.stats = None
+        self.stacks = {}
+        self.threads = set()
+        self.routes = {}
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.timer = None
+
+    def add(self, request, route):
+        self.profiled += 1
+        totals = self.routes.setdefault(route, {'requests': 0, 'phases': {}})
+        totals['requests'] += 1
+        for phase, seconds in request.phases.items():
+            totals['phases'][phase] = totals['phases'].get(phase, 0) + seconds
+
+    def sample(self):
+        # Stacks of the threads serving profiled requests, root first, in
+        # the collapsed format flame graph tools read.
+        labels = {}
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for thread in list(self.threads):
+                frame = frames.get(thread)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = (f'{code.co_name} '
+                                                f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    stack.append(label)
+                    frame = frame.f_back
+                if stack:
+                    key = ';'.join(reversed(stack))
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def summary(self):
+        routes = {}
+        for route, totals in sorted(self.routes.items()):
+            wall = sum(totals['phases'].values())
+            routes[route] = {
+                'requests': totals['requests'],
+                'mean_ms': round(wall / totals['requests'] * 1000, 3),
+                'phases': {phase: {'mean_ms': round(seconds / totals['requests'] * 1000, 3),
+                                   'share': round(seconds / wall, 3) if wall else 0}
+                           for phase, seconds in sorted(totals['phases'].items(),
+                                                        key=lambda item: -item[1])},
             }
+        result = {
+            'mode': self.mode,
+            'requests': self.profiled,
+            'seconds': round(time.monotonic() - self.started, 3),
+            'routes': routes,
         }
+        if self.mode == 'cprofile':
+            result['untraced'] = self.untraced
+        if self.stats is not None:
+            top = sorted(self.stats.stats.items(), key=lambda item: -item[1][3])[:20]
+            result['functions'] = [
+                {'function': f'{name} ({os.path.basename(filename)}:{line})', 'calls': calls,
+                 'total_ms': round(total * 1000, 3), 'cumulative_ms': round(cumulative * 1000, 3)}
+                for (filename, line, name), (_, calls, total, cumulative, _) in top]
+        return result
+
+
+class Profiler:
+    # Profiles requests on demand: the next `requests` requests, or every
+    # request for `seconds`, whichever ends first.  `cprofile` traces every
+    # call on the threads serving them and writes a .pstats file;
+    # `sample` reads their stacks every `interval` seconds and writes
+    # collapsed stacks for a flame graph.  Both record per-phase wall time
+    # by route.  While nothing is being profiled the request path only
+    # tests `active`.
+    MODES = ('cprofile', 'sample')
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.active = False
+        self.session = None
+        self.last = None
+        self._sequence = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self, mode='cprofile', requests=None, seconds=None, interval=0.005):
+        if mode not in self.MODES:
+            raise ValueError(f'mode must be one of {", ".join(self.MODES)}')
+        if requests is None and seconds is None:
+            seconds = 30
+        for name, value in (('requests', requests), ('seconds', seconds), ('interval', interval)):
+            if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool)
+                                      or value <= 0):
+                raise ValueError(f'{name} must be a positive number')
+        with self._lock:
+            if self.session is not None:
+                return False
+            session = self.session = ProfileSession(mode, requests, seconds, interval)
+            if mode == 'sample':
+                session.sampler = threading.Thread(target=session.sample, daemon=True,
+                                                   name='profile-sampler')
+                session.sampler.start()
+            if seconds is not None:
+                session.timer = threading.Timer(seconds, self.stop, (session,))
+                session.timer.daemon = True
+                session.timer.start()
+            self.active = True
+        return True
+
+    def begin(self, started):
+        with self._lock:
+            session = self.session
+            if session is None or (session.requests is not None
+                                   and session.claimed >= session.requests):
+                return None
+            session.claimed += 1
+            if session.mode == 'sample':
+                session.threads.add(threading.get_ident())
+        request = RequestProfile(session, started)
+        request.lap('headers')
+        if session.mode == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # From Python 3.12 only one profiler can be active per
+                # process; while another request holds it this one gets
+                # phase timings only.
+                profile = None
+                with self._lock:
+                    session.untraced += 1
+            request.profile = profile
+        self._local.request = request
+        return request
+
+    def lap(self, phase):
+        request = getattr(self._local, 'request', None)
+        if request is not None:
+            request.lap(phase)
+
+    def finish(self, request, route):
+        try:
+            if request.profile is not None:
+                request.profile.disable()
+            request.lap('other')
+        finally:
+            self._local.request = None
+        session = request.session
+        stats = pstats.Stats(request.profile) if request.profile is not None else None
+        with self._lock:
+            session.threads.discard(threading.get_ident())
+            if session is not self.session:
+                return
+            session.add(request, route)
+            if stats is not None:
+                if session.stats is None:
+                    session.stats = stats
+                else:
+                    session.stats.add(stats)
+            done = session.requests is not None and session.profiled >= session.requests
+        if done:
+            self.stop(session)
+
+    def stop(self, session=None):
+        # Ends the running session (or `session`, if it is still the one
+        # running) and writes its files.  Returns the summary, or None.
+        with self._lock:
+            if self.session is None or (session is not None and session is not self.session):
+                return None
+            session = self.session
+            self.session = None
+            self.active = False
+        session.stopped.set()
+        if session.timer is not None:
+            session.timer.cancel()
+        if session.sampler is not None:
+            session.sampler.join()
+        summary = session.summary()
+        summary['files'] = self.write(session, summary)
+        self.last = summary
+        return summary
+
+    def write(self, session, summary):
+        if self.directory is None:
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory,
+                            time.strftime('profile-%Y%m%d-%H%M%S')
+                            + f'-{os.getpid()}-{next(self._sequence)}')
+        files = [base + '.json']
+        with open(files[0], 'w') as f:
+            json.dump(summary, f, indent=2)
+        if session.stats is not None:
+            files.append(base + '.pstats')
+            session.stats.dump_stats(files[-1])
+        if session.stacks:
+            files.append(base + '.collapsed')
+            with open(files[-1], 'w') as f:
+                for stack, count in sorted(session.stacks.items()):
+                    f.write(f'{stack} {count}\n')
+        return files
+
+    def describe(self):
+        with self._lock:
+            session = self.session
+            if session is None:
+                return {'active': False, 'last': self.last}
+            elapsed = time.monotonic() - session.started
+            return {
+                'active': True,
+                'mode': session.mode,
+                'profiled': session.profiled,
+                'requests_left': None if session.requests is None
+                                 else session.requests - session.claimed,
+                'seconds_left': None if session.seconds is None
+                                else round(max(session.seconds - elapsed, 0), 3),
+                'last': self.last,
+            }
+
+    def toggle(self):
+        # SIGUSR1: start with the defaults, or stop and write what is there.
+        if self.active:
+            summary = self.stop()
+            if summary is not None:
+                print(f"Profile of {summary['requests']} requests written to "
+                      f"{', '.join(summary['files']) or 'nowhere (no --profile-dir)'}", file=sys.stderr)
+        elif self.start():
+            print('Profiling requests for 30 seconds (SIGUSR1 again to stop)', file=sys.stderr)
+
+
+profiler = Profiler()
+
+
+# One lexer pass over the editor contents.  Only tokens the checks care
+# about are matched; the leading lookahead lets the regex engine skip
+# everything else without trying each alternative.
+# Strings and comments are consumed whole so brackets and keywords inside
+# them are ignored.  Unterminated strings run to the end of their line (or
+# of the file, for triple quotes) instead of failing.
+CODE_TOKEN_RE = re.compile(r"""
+    (?=[\'"`#\\\n()\[\]{}=!<>:+\-*/%&|^@acdefiw])
+    (?:
+        (?P<newline>\n[ \t]*)
+      | (?P<open>[(\[{])
+      | (?P<close>[)\]}])
+      | (?P<keyword>\b(?:def|class|for|while|if|elif|append)\b)
+      | (?P<colon>:(?!=))
+      | (?P<op>===?|!==?|\*\*=|//=|>>=|<<=|[-+*/%&|^@:<>]=|=>|=)
+      | (?P<string>
+            '''[^'\\]*(?:(?:\\[\s\S]|'(?!''))[^'\\]*)*(?:'''|\Z)
+          | \"\"\"[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*(?:\"\"\"|\Z)
+          | '[^'\\\n]*(?:\\[\s\S][^'\\\n]*)*'?
+          | "[^"\\\n]*(?:\\[\s\S][^"\\\n]*)*"?
+          | `[^`\\]*(?:\\[\s\S][^`\\]*)*`?
+        )
+      | (?P<comment>\#[^\n]*)
+      | (?P<continuation>\\\r?\n)
+    )
+""", re.VERBOSE)
+
+BRACKET_PAIRS = {')': '(', ']': '[', '}': '{'}
+
+
+class CodeAnalysis:
+    # Structured result of analyze_code(), shared by explain_code,
+    # debug_code and optimize_code.
+    def __init__(self):
+        self.line_count = 0
+        self.functions = []
+        self.classes = []
+        self.bracket_balance = {'(': 0, '[': 0, '{': 0}
+        self.loop_count = 0
+        self.max_loop_depth = 0
+        self.append_in_loop = []
+        self.assign_in_condition = []
+        # True if the code stops inside a bracket or a multi-line string,
+        # i.e. whatever follows it continues the same statement.
+        self.ends_open = False
+
+
+def analyze_code(code):
+    analysis = CodeAnalysis()
+    stripped = code.strip()
+    analysis.line_count = stripped.count('\n') + 1 if stripped else 0
+    
+    balance = analysis.bracket_balance
+    lineno = 1
+    line_start = len(code) - len(code.lstrip(' \t'))
+    indent = line_start
+    # Indentation of the loops enclosing the current line.  Lines inside
+    # ( or [ continue the statement above them and never close a loop.
+    loops = []
+    paren_depth = 0
+    condition_depth = None
+    
+    for match in CODE_TOKEN_RE.finditer(code):
+        kind = match.lastgroup
+        if kind == 'newline':
+            lineno += 1
+            if paren_depth:
+                continue
+            condition_depth = None
+            following = code[match.end():match.end() + 1]
+            if following in ('', '\n', '\r', '#'):
+                continue
+            line_start = match.end()
+            indent = line_start - match.start() - 1
+            while loops and loops[-1] >= indent:
+                loops.pop()
+        elif kind == 'open':
+            char = match.group()
+            balance[char] += 1
+            if char != '{':
+                paren_depth += 1
+        elif kind == 'close':
+            balance[BRACKET_PAIRS[match.group()]] -= 1
+            if match.group() != '}' and paren_depth:
+                paren_depth -= 1
+                if condition_depth is not None and paren_depth < condition_depth:
+                    condition_depth = None
+        elif kind == 'op':
+            if condition_depth == paren_depth and match.group() == '=':
+                analysis.assign_in_condition.append(lineno)
+        elif kind == 'colon':
+            if condition_depth == paren_depth == 0:
+                condition_depth = None
+        elif kind == 'keyword':
+            word = match.group()
+            start = match.start()
+            if word == 'append':
+                if loops and code[start - 1:start] == '.':
+                    analysis.append_in_loop.append(lineno)
+                continue
+            if code[line_start:start] not in ('', 'async '):
+                continue
+            if word in ('for', 'while'):
+                analysis.loop_count += 1
+                loops.append(indent)
+                analysis.max_loop_depth = max(analysis.max_loop_depth, len(loops))
+            if word in ('if', 'elif', 'while'):
+                # `if (...)` puts the condition inside the parentheses.
+                rest = code[match.end():match.end() + 8].lstrip(' \t')
+                condition_depth = paren_depth + 1 if rest.startswith('(') else paren_depth
+            elif word in ('def', 'class'):
+                line_end = code.find('\n', start)
+                text = code[line_start:line_end if line_end != -1 else len(code)].strip()
+                target = analysis.functions if word == 'def' else analysis.classes
+                target.append(text)
+        elif kind in ('string', 'continuation'):
+            text = match.group()
+            lineno += text.count('\n')
+            if match.end() == len(code) and text[:1] in '\'"`':
+                quote = text[:3] if text[:3] in ("'''", '"""') else text[0]
+                if quote != "'" and quote != '"':
+                    analysis.ends_open = len(text) < 2 * len(quote) or not text.endswith(quote)
+    
+    analysis.ends_open = analysis.ends_open or paren_depth > 0 or balance['{'] > 0
+    return analysis
+
+
+# Editor contents are kept per session so /chat can receive line deltas
+# instead of the whole file.  A document is split into top-level blocks,
+# each with its own CodeAnalysis; an edit re-analyzes the blocks it touches
+# plus one neighbour on either side, whose boundaries it may have moved.
+BLOCK_START_RE = re.compile(r'(?:async[ \t]+def|def|class)\b|@')
+BLOCK_MAX_LINES = 50
+# A block left open (unclosed bracket or string) is joined with the next
+# one; after this many joins the rest of the region is taken in one go.
+BLOCK_MAX_JOINS = 8
+
+
+class DocumentConflict(Exception):
+    pass
+
+
+class DocumentBlock:
+    __slots__ = ('lines', 'analysis')
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.analysis = analyze_code('\n'.join(lines))
+
+
+def split_blocks(lines):
+    # Definitions always start a block; other column-0 statements only once
+    # the current block is long enough, so plain scripts still split up.
+    groups = []
+    start = 0
+    for index in range(1, len(lines)):
+        line = lines[index]
+        if not line or not (line[0].isalpha() or line[0] in '_@'):
+            continue
+        if index - start >= BLOCK_MAX_LINES or BLOCK_START_RE.match(line):
+            groups.append(lines[start:index])
+            start = index
+    groups.append(lines[start:])
+    return groups
+
+
+def build_blocks(lines):
+    groups = split_blocks(lines)
+    blocks = []
+    index = 0
+    while index < len(groups):
+        block_lines = groups[index]
+        index += 1
+        block = DocumentBlock(block_lines)
+        joins = 0
+        while block.analysis.ends_open and index < len(groups):
+            joins += 1
+            if joins > BLOCK_MAX_JOINS:
+                block_lines = block_lines + [line for group in groups[index:] for line in group]
+                index = len(groups)
+            else:
+                block_lines = block_lines + groups[index]
+                index += 1
+            block = DocumentBlock(block_lines)
+        blocks.append(block)
+    return blocks
+
+
+class BlockFindings:
+    # Read-only view of one CodeAnalysis list (functions, append_in_loop, ...)
+    # across a document's blocks, with line numbers made document-relative.
+    # Only the items actually read are built, so showing the first few of
+    # them does not cost a pass over the whole document.
+    __slots__ = ('blocks', 'offsets', 'name', 'count')
+
+    def __init__(self, blocks, offsets, name, count):
+        self.blocks = blocks
+        self.offsets = offsets
+        self.name = name
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        numbered = self.name in LINE_FINDINGS
+        for block, offset in zip(self.blocks, self.offsets):
+            for item in getattr(block.analysis, self.name):
+                yield item + offset if numbered else item
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) and not index.start and index.step is None \
+                and index.stop is not None and index.stop >= 0:
+            return list(itertools.islice(self, index.stop))
+        return list(self)[index]
+
+
+FINDINGS = ('functions', 'classes', 'append_in_loop', 'assign_in_condition')
+LINE_FINDINGS = ('append_in_loop', 'assign_in_condition')
+
+
+def leading_blank_lines(lines):
+    count = 0
+    while not lines[count].strip():
+        count += 1
+    return count
+
+
+class DocumentSnapshot:
+    # What CodeAssistant sees of a document: one version's analysis, keyed
+    # by document and version for the response cache.
+    __slots__ = ('key', 'version', 'analysis')
+
+    def __init__(self, token, version, analysis):
+        self.key = (token, version)
+        self.version = version
+        self.analysis = analysis
+
+
+class Document:
+    # Totals across blocks are kept up to date as blocks are replaced, so
+    # an edit costs the blocks it re-analyzes, not the whole document.
+    def __init__(self, text):
+        self.token = os.urandom(8).hex()
+        self.version = 1
+        self.blocks = []
+        self.offsets = [0]
+        self.balance = {'(': 0, '[': 0, '{': 0}
+        self.loop_count = 0
+        self.loop_depths = {}
+        self.counts = dict.fromkeys(FINDINGS, 0)
+        # Characters of all lines, newlines included.
+        self.chars = 0
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._replace(0, 0, build_blocks(text.split('\n')))
+
+    @property
+    def line_count(self):
+        return self.offsets[-1]
+
+    def _account(self, blocks, sign):
+        for block in blocks:
+            analysis = block.analysis
+            for char, count in analysis.bracket_balance.items():
+                self.balance[char] += sign * count
+            self.loop_count += sign * analysis.loop_count
+            depth = analysis.max_loop_depth
+            self.loop_depths[depth] = self.loop_depths.get(depth, 0) + sign
+            for name in FINDINGS:
+                self.counts[name] += sign * len(getattr(analysis, name))
+
+    def _replace(self, first, stop, new_blocks):
+        offsets = self.offsets
+        old_lines = offsets[stop] - offsets[first]
+        self._account(self.blocks[first:stop], -1)
+        self._account(new_blocks, 1)
+        self.chars += (sum(len(line) + 1 for block in new_blocks for line in block.lines)
+                       - sum(len(line) + 1 for block in self.blocks[first:stop] for line in block.lines))
+        self.blocks[first:stop] = new_blocks
+        position = offsets[first]
+        starts = []
+        for block in new_blocks:
+            starts.append(position)
+            position += len(block.lines)
+        shift = position - offsets[first] - old_lines
+        tail = [offset + shift for offset in offsets[stop:]] if shift else offsets[stop:]
+        offsets[first:] = starts + tail
+
+    def snapshot(self):
+        with self._lock:
+            return self._take_snapshot()
+
+    def _take_snapshot(self):
+        if self._snapshot is not None:
+            return self._snapshot
+        # Copies, so later edits do not show through the snapshot.
+        blocks = list(self.blocks)
+        offsets = self.offsets[:-1]
+        analysis = CodeAnalysis()
+        analysis.bracket_balance = dict(self.balance)
+        analysis.loop_count = self.loop_count
+        analysis.max_loop_depth = max((depth for depth, count in self.loop_depths.items() if count), default=0)
+        for name in FINDINGS:
+            setattr(analysis, name, BlockFindings(blocks, offsets, name, self.counts[name]))
+        analysis.ends_open = blocks[-1].analysis.ends_open
+        # line_count spans the first to the last non-blank line.
+        first = next((i for i, block in enumerate(blocks) if block.analysis.line_count), None)
+        if first is not None:
+            last = next(i for i in range(len(blocks) - 1, first - 1, -1) if blocks[i].analysis.line_count)
+            first_line = offsets[first] + leading_blank_lines(blocks[first].lines)
+            last_line = (offsets[last] + leading_blank_lines(blocks[last].lines)
+                         + blocks[last].analysis.line_count - 1)
+            analysis.line_count = last_line - first_line + 1
+        self._snapshot = DocumentSnapshot(self.token, self.version, analysis)
+        return self._snapshot
+
+    def apply(self, base_version, start, end, lines):
+        # Replaces lines [start, end) with `lines`.  Clients number lines the
+        # way str.split('\n') does, so offsets agree whatever the encoding.
+        if not all(isinstance(n, int) and not isinstance(n, bool) for n in (base_version, start, end)):
+            raise ValueError('base, start and end must be integers')
+        if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+            raise ValueError('lines must be a list of strings')
+
+        with self._lock:
+            if base_version != self.version:
+                raise DocumentConflict(f'document is at version {self.version}, not {base_version}')
+            blocks = self.blocks
+            offsets = self.offsets
+            if not 0 <= start <= end <= offsets[-1]:
+                raise ValueError('edit range is outside the document')
+
+            last_block = len(blocks) - 1
+            first = max(min(bisect.bisect_right(offsets, start) - 1, last_block) - 1, 0)
+            stop = min(bisect.bisect_right(offsets, max(end - 1, start)) + 1, last_block + 1)
+            region = [line for block in blocks[first:stop] for line in block.lines]
+            base = offsets[first]
+            region[start - base:end - base] = lines
+
+            # An edit that opens a bracket or string swallows the blocks
+            # after the region until it is closed again.
+            joins = 0
+            while True:
+                new_blocks = build_blocks(region) if region else []
+                if not new_blocks or not new_blocks[-1].analysis.ends_open or stop > last_block:
+                    break
+                joins += 1
+                following = stop + 1 if joins <= BLOCK_MAX_JOINS else last_block + 1
+                region = region + [line for block in blocks[stop:following] for line in block.lines]
+                stop = following
+
+            if not new_blocks and stop - first == len(blocks):
+                new_blocks = [DocumentBlock([''])]
+            self._replace(first, stop, new_blocks)
+            self.version += 1
+            self._snapshot = None
+            return self._take_snapshot()
+
+
+class DocumentStore:
+    # Session id -> Document.  A document dropped from here only costs the
+    # client one full resend after a 409.  Blocks and their analysis take
+    # about a hundred bytes per line on top of the text, which is what
+    # max_bytes is charged.  Documents over max_chars or max_lines are not
+    # kept at all: sync() returns None and the text is analyzed as a
+    # whole each time, and an edit past the limits drops the document.
+    # The defaults keep anything that fits in a default request body; at
+    # the limits a document is charged about 17 MB, so the largest still
+    # take no more than a quarter of the default max_bytes each.
+    def __init__(self, maxsize=256, ttl=1800, max_bytes=64 * 1024 * 1024,
+                 max_chars=4 * 1024 * 1024, max_lines=100000):
+        self.documents = LRUCache(maxsize, ttl, max_bytes=max_bytes,
+                                  sizeof=lambda document: document.chars + 128 * document.line_count)
+        self.max_chars = max_chars
+        self.max_lines = max_lines
+        self.too_large = 0
+
+    def sync(self, session_id, text):
+        if len(text) > self.max_chars or text.count('\n') >= self.max_lines:
+            self.documents.discard(session_id)
+            self.too_large += 1
+            return None
+        document = Document(text)
+        self.documents.put(session_id, document)
+        return document.snapshot()
+
+    def update(self, session_id, base_version, start, end, lines):
+        document = self.documents.get(session_id)
+        if document is None:
+            raise DocumentConflict('no document for this session')
+        # An edit that alone is over the limits is turned away unanalyzed.
+        if isinstance(lines, list) and (len(lines) > self.max_lines or sum(
+                len(line) for line in lines if isinstance(line, str)) > self.max_chars):
+            self.documents.discard(session_id)
+            self.too_large += 1
+            raise DocumentConflict('document is too large to keep; send the full text')
+        snapshot = document.apply(base_version, start, end, lines)
+        if document.chars > self.max_chars or document.line_count > self.max_lines:
+            self.documents.discard(session_id)
+            self.too_large += 1
+            raise DocumentConflict('document is too large to keep; send the full text')
+        # Charged again at its new size.
+        self.documents.put(session_id, document)
+        return snapshot
+
+    def stats(self):
+        return dict(self.documents.stats(), too_large=self.too_large)
+
+
+class SQLiteStore:
+    # Chat messages and /run results on disk, so a restart keeps them.
+    # Request threads only queue writes.  A writer thread commits whatever
+    # has queued, waiting up to `flush_interval` for a batch to fill to
+    # `batch_size`.  In WAL mode with synchronous=NORMAL a commit appends to
+    # the log without an fsync.  If more than `max_pending` writes are
+    # waiting, new ones are dropped and counted instead of stalling
+    # requests.  Rows older than `retention` seconds are pruned.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY, created REAL NOT NULL, last_seen REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, role TEXT NOT NULL,
+            text TEXT NOT NULL, created REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, created);
+        CREATE INDEX IF NOT EXISTS messages_created ON messages (created);
+        CREATE TABLE IF NOT EXISTS runs (
+            key BLOB PRIMARY KEY, stdout TEXT NOT NULL, stderr TEXT NOT NULL, created REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS runs_created ON runs (created);
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, description TEXT NOT NULL, cancel INTEGER NOT NULL DEFAULT 0,
+            updated REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated);
+    """
+    SESSION_SQL = ('INSERT INTO sessions VALUES (?, ?, ?) '
+                   'ON CONFLICT (id) DO UPDATE SET last_seen = excluded.last_seen')
+    MESSAGE_SQL = 'INSERT INTO messages (session_id, role, text, created) VALUES (?, ?, ?, ?)'
+    RUN_SQL = 'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)'
+    JOB_SQL = ('INSERT INTO jobs (id, description, updated) VALUES (?, ?, ?) '
+               'ON CONFLICT (id) DO UPDATE SET description = excluded.description, '
+               'updated = excluded.updated')
+    PRUNE_INTERVAL = 600
+
+    def __init__(self, path, batch_size=512, flush_interval=0.05, max_pending=65536,
+                 retention=7 * 24 * 3600):
+        if sqlite3 is None:
+            raise RuntimeError('persistence needs the sqlite3 module')
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+        # Reads are rare (a session or result missing from memory), so one
+        # connection behind a lock is enough; WAL lets it read while the
+        # writer commits.
+        self._reader = self._connect()
+        self._reader.executescript(self.SCHEMA)
+        self._reader_lock = threading.Lock()
+        self._pending = queue.Queue(max_pending)
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.failed = 0
+        self._writer = threading.Thread(target=self._write_loop, name='sqlite-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    def add_message(self, session_id, role, text, created):
+        self._enqueue(self.SESSION_SQL, (session_id, created, created))
+        self._enqueue(self.MESSAGE_SQL, (session_id, role, text, created))
+
+    def put_run(self, key, stdout, stderr, created):
+        self._enqueue(self.RUN_SQL, (key, stdout, stderr, created))
+
+    def recent_messages(self, session_id, limit):
+        # (role, text, created) rows, oldest first.
+        with self._reader_lock:
+            rows = self._reader.execute(
+                'SELECT role, text, created FROM messages WHERE session_id = ? '
+                'ORDER BY created DESC, id DESC LIMIT ?', (session_id, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+    def get_run(self, key, max_age=None):
+        since = time.time() - max_age if max_age is not None else 0
+        with self._reader_lock:
+            return self._reader.execute(
+                'SELECT stdout, stderr FROM runs WHERE key = ? AND created >= ?',
+                (key, since)).fetchone()
+
+    # Job records are written as they happen rather than queued: another
+    # server process may be asked about the job in the next request.
+    def put_job(self, job_id, description):
+        with self._reader_lock:
+            self._reader.execute(self.JOB_SQL, (job_id, json.dumps(description), time.time()))
+
+    def get_job(self, job_id, max_age=None):
+        since = time.time() - max_age if max_age is not None else 0
+        with self._reader_lock:
+            row = self._reader.execute('SELECT description FROM jobs WHERE id = ? AND updated >= ?',
+                                       (job_id, since)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def cancel_job(self, job_id, max_age=None):
+        since = time.time() - max_age if max_age is not None else 0
+        with self._reader_lock:
+            return self._reader.execute('UPDATE jobs SET cancel = 1 WHERE id = ? AND updated >= ?',
+                                        (job_id, since)).rowcount > 0
+
+    def cancelled_jobs(self, job_ids):
+        with self._reader_lock:
+            return [row[0] for row in self._reader.execute(
+                f'SELECT id FROM jobs WHERE cancel = 1 AND id IN ({",".join("?" * len(job_ids))})',
+                job_ids)]
+
+    def _enqueue(self, sql, params):
+        try:
+            self._pending.put_nowait((sql, params))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        # Waits until everything queued so far has been committed.
+        self._pending.join()
+
+    def close(self):
+        self._pending.put(None)
+        self._writer.join()
+        self._reader.close()
+
+    def _write_loop(self):
+        conn = self._connect()
+        pruned = time.monotonic()
+        stop = False
+        while not stop:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                stop = True
+            if batch:
+                self._commit(conn, batch)
+            if time.monotonic() - pruned > self.PRUNE_INTERVAL:
+                self._commit(conn, self._prune_statements())
+                pruned = time.monotonic()
+            for _ in range(len(batch) + stop):
+                self._pending.task_done()
+        conn.close()
+
+    def _commit(self, conn, batch):
+        # One transaction per batch, one executemany per statement, and one
+        # upsert per session however many of its messages are in the batch.
+        grouped = {}
+        seen = {}
+        for sql, params in batch:
+            if sql == self.SESSION_SQL:
+                seen[params[0]] = params
+            else:
+                grouped.setdefault(sql, []).append(params)
+        grouped[self.SESSION_SQL] = list(seen.values())
+        try:
+            conn.execute('BEGIN')
+            for sql, rows in grouped.items():
+                if rows:
+                    conn.executemany(sql, rows)
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self.failed += len(batch)
+            sys.stderr.write(f'SQLite write of {len(batch)} rows failed: {e}\n')
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    def _prune_statements(self):
+        cutoff = (time.time() - self.retention,)
+        return [('DELETE FROM messages WHERE created < ?', cutoff),
+                ('DELETE FROM runs WHERE created < ?', cutoff),
+                ('DELETE FROM jobs WHERE updated < ?', cutoff),
+                ('DELETE FROM sessions WHERE last_seen < ?', cutoff)]
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'pending': self._pending.qsize(),
+            'written': self.written,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+class Message:
+    __slots__ = ('role', 'text', 'created')
+
+    def __init__(self, role, text, created):
+        self.role = role
+        self.text = text
+        self.created = created
+
+    def size(self):
+        # Object, timestamp and text, as sys.getsizeof() counts them.
+        return 80 + sys.getsizeof(self.text)
+
+
+class Session:
+    __slots__ = ('messages', 'bytes', 'last_seen')
+    # The session object, its deque and its table entry.
+    OVERHEAD = 1024
+
+    def __init__(self, max_messages, now):
+        self.messages = deque(maxlen=max_messages)
+        self.bytes = self.OVERHEAD
+        self.last_seen = now
+
+
+class SessionStore:
+    # Recent /chat messages per session: the last `max_messages` of each,
+    # with text cut to `max_text_chars`.  Sessions idle for `idle_ttl`
+    # seconds are dropped, and once all sessions together pass `max_bytes`
+    # the least recently active ones go first.  Sessions are kept in
+    # activity order, so both evictions only look at the front.  With a
+    # SQLiteStore as `db` every message is also written to disk, and a
+    # session that is not in memory is reloaded from there.  With `shared`
+    # set, other server processes write to the same database, so history
+    # is always read back from it; messages still being queued for the
+    # writer (at most its flush interval) are not seen yet.
+    def __init__(self, max_messages=20, idle_ttl=1800, max_bytes=32 * 1024 * 1024,
+                 max_text_chars=2000, db=None, shared=False):
+        self.db = db
+        self.shared = shared and db is not None
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.max_text_chars = max_text_chars
+        self.bytes = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.idle_evictions = 0
+        self.memory_evictions = 0
+
+    def append(self, session_id, role, text):
+        if self.max_messages <= 0:
+            return
+        now = time.monotonic()
+        message = Message(role, text[:self.max_text_chars], now)
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(self.max_messages, now)
+                self.bytes += session.bytes
+            else:
+                self._sessions.move_to_end(session_id)
+                session.last_seen = now
+            self._add(session, message)
+            self._evict(now, session_id)
+        if self.db is not None:
+            self.db.add_message(session_id, role, message.text, time.time())
+
+    def history(self, session_id):
+        # Oldest first.  Messages are never modified, so sharing them is safe.
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if (session is not None and not self.shared
+                    and session.last_seen + self.idle_ttl > time.monotonic()):
+                return list(session.messages)
+        if self.db is None or self.max_messages <= 0:
+            return []
+        rows = self.db.recent_messages(session_id, self.max_messages)
+        if not rows:
+            return []
+        now = time.monotonic()
+        with self._lock:
+            stale = self._sessions.pop(session_id, None)
+            if stale is not None:
+                self.bytes -= stale.bytes
+            session = self._sessions[session_id] = Session(self.max_messages, now)
+            self.bytes += session.bytes
+            for role, text, _ in rows:
+                self._add(session, Message(role, text, now))
+            self._evict(now, session_id)
+            return list(session.messages)
+
+    def _add(self, session, message):
+        messages = session.messages
+        if len(messages) == messages.maxlen:
+            dropped = messages.popleft().size()
+            session.bytes -= dropped
+            self.bytes -= dropped
+        size = message.size()
+        messages.append(message)
+        session.bytes += size
+        self.bytes += size
+
+    def _evict(self, now, keep):
+        sessions = self._sessions
+        while sessions:
+            session_id, session = next(iter(sessions.items()))
+            if session.last_seen + self.idle_ttl <= now:
+                self.idle_evictions += 1
+            elif self.bytes > self.max_bytes and session_id != keep:
+                self.memory_evictions += 1
+            else:
+                return
+            del sessions[session_id]
+            self.bytes -= session.bytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'max_messages': self.max_messages,
+                'idle_evictions': self.idle_evictions,
+                'memory_evictions': self.memory_evictions,
+            }
+
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+# Longest first; a suffix is only removed if three letters remain.
+STEM_SUFFIXES = ('ings', 'ing', 'ions', 'ion', 'ers', 'er', 'ed', 'es', 's', 'e')
+
+
+def stem(word):
+    # Just enough to fold "fixes", "fixed" and "fixing" into "fix".
+    # Irregular forms ("wrote", "debugging") are listed in the tables.
+    for suffix in STEM_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+class IntentRouter:
+    # Matches a message against a table of (intent, priority, keywords)
+    # rows in one pass over its words.  Keywords match whole words, in
+    # any of their inflected forms, so "fix" matches "fixing" but not
+    # "prefix".  A keyword may be several words long.  The highest priority
+    # match wins, and the earliest match breaks ties.  Every form is
+    # expanded when the table is built, so routing costs one dict lookup
+    # per word however many intents there are.
+    def __init__(self, table, default=None):
+        self.default = default
+        # Word -> [(following words, priority, intent)]
+        self.index = {}
+        for intent, priority, keywords in table:
+            for keyword in keywords:
+                words = WORD_RE.findall(keyword.lower())
+                rest = tuple(words[1:])
+                root = stem(words[0])
+                forms = {words[0], root}
+                forms.update(root + suffix for suffix in STEM_SUFFIXES)
+                for form in forms:
+                    if stem(form) == root or form == words[0]:
+                        self.index.setdefault(form, []).append((rest, priority, intent))
+
+    def route(self, text):
+        # `text` is expected in lower case.  Later words of a multi-word
+        # keyword must match exactly.
+        index = self.index
+        best = None
+        words = WORD_RE.findall(text)
+        for position, word in enumerate(words):
+            candidates = index.get(word)
+            if candidates is None:
+                continue
+            for rest, priority, intent in candidates:
+                if rest and tuple(words[position + 1:position + 1 + len(rest)]) != rest:
+                    continue
+                if best is None or priority > best[0]:
+                    best = (priority, intent)
+        return best[1] if best is not None else self.default
+
+
+class Snippet:
+    __slots__ = ('id', 'language', 'title', 'code')
+
+    def __init__(self, snippet_id, language, title, code):
+        self.id = snippet_id
+        self.language = language
+        self.title = title
+        self.code = code
+
+
+class SnippetStore:
+    # Code snippets searched by language and keywords.  Every prefix of a
+    # word in a title or tag is indexed, so the search box can match as the
+    # user types.  Identifiers in the code are indexed as whole words.
+    # Posting lists hold ascending ids.  A query walks the shortest list
+    # and keeps the ids found in sets of the others, so results page in the
+    # order snippets were added.  The sets and the matches of recent
+    # queries are cached, so paging through results or repeating a search
+    # costs a slice.
+    def __init__(self, library=None, per_page=20):
+        self.per_page = per_page
+        self.snippets = []
+        self.index = {}
+        # Lower-case language -> (display name, ids)
+        self.languages = {}
+        self._sets = LRUCache(256, max_bytes=64 * 1024 * 1024, sizeof=sys.getsizeof)
+        self._matches = LRUCache(1024, max_bytes=16 * 1024 * 1024, sizeof=sys.getsizeof)
+        for language, titles in (library or {}).items():
+            for title, code in titles.items():
+                self.add(language, title, code)
+
+    def add(self, language, title, code, tags=()):
+        snippet = Snippet(len(self.snippets), language, title, code)
+        self.snippets.append(snippet)
+        self.languages.setdefault(language.lower(), (language, []))[1].append(snippet.id)
+        words = set(WORD_RE.findall(code.lower()))
+        for word in WORD_RE.findall(' '.join((title, *tags)).lower()):
+            words.update(word[:end] for end in range(1, len(word) + 1))
+        for word in words:
+            self.index.setdefault(word, []).append(snippet.id)
+        self._sets.clear()
+        self._matches.clear()
+        return snippet
+
+    def load(self, path):
+        # A JSON list of {"language", "title", "code", "tags"} objects.
+        with open(path, encoding='utf-8') as f:
+            for item in json.load(f):
+                self.add(item['language'], item['title'], item['code'], item.get('tags', ()))
+
+    def search(self, language='', query='', page=1):
+        words = tuple(sorted(set(WORD_RE.findall(query.lower()))))
+        key = (language.lower(), words, bool(query.strip()))
+        ids = self._matches.get(key)
+        if ids is None:
+            ids = self._match(*key)
+            self._matches.put(key, ids)
+        pages = max(1, math.ceil(len(ids) / self.per_page))
+        page = min(max(page, 1), pages)
+        first = (page - 1) * self.per_page
+        return {
+            'language': language,
+            'query': query,
+            'page': page,
+            'pages': pages,
+            'total': len(ids),
+            'languages': [name for name, _ in self.languages.values()],
+            'snippets': [{'id': snippet.id, 'language': snippet.language,
+                          'title': snippet.title, 'code': snippet.code}
+                         for snippet in map(self.snippets.__getitem__, ids[first:first + self.per_page])],
+        }
+
+    def _match(self, language, words, has_query):
+        postings = []
+        if language:
+            entry = self.languages.get(language)
+            postings.append((('language', language), entry[1] if entry is not None else []))
+        if has_query and not words:
+            postings.append((None, []))
+        for word in words:
+            postings.append((word, self.index.get(word, [])))
+        if not postings:
+            return range(len(self.snippets))
+        postings.sort(key=lambda posting: len(posting[1]))
+        ids = postings[0][1]
+        for key, other in postings[1:]:
+            if not ids:
+                break
+            ids = list(filter(self._set(key, other).__contains__, ids))
+        return ids
+
+    def _set(self, key, ids):
+        found = self._sets.get(key)
+        if found is None:
+            found = frozenset(ids)
+            self._sets.put(key, found)
+        return found
+
+    def stats(self):
+        return {'snippets': len(self.snippets), 'languages': len(self.languages),
+                'index_words': len(self.index)}
+
+
+def format_lines(linenos, limit=5):
+    shown = ", ".join(str(n) for n in linenos[:limit])
+    more = f" and {len(linenos) - limit} more" if len(linenos) > limit else ""
+    return f"line{'s' if len(linenos) > 1 else ''} {shown}{more}"
+
+
+class CodeAssistant:
+    # Answers for these intents depend only on the editor contents, so they
+    # are cached by code hash regardless of how the question was worded.
+    CODE_INTENTS = ('explain', 'debug', 'optimize')
+    INTENTS = IntentRouter((
+        ('help', 50, ('help',)),
+        ('explain', 40, ('explain', 'explanation')),
+        ('debug', 30, ('debug', 'debugging', 'debugged', 'debugger', 'fix')),
+        ('write', 20, ('write', 'writing', 'written', 'wrote', 'create')),
+        ('optimize', 10, ('optimize', 'optimise', 'optimization', 'optimisation')),
+    ), default='general')
+    HELP_TOPICS = IntentRouter((
+        ('function', 20, ('function',)),
+        ('debug', 10, ('debug', 'debugging')),
+    ))
+    SNIPPET_TOPICS = IntentRouter((
+        ('sort', 20, ('sort',)),
+        ('file', 10, ('file',)),
+    ))
+    # "do that again", "now this one": a short message that only points
+    # back at an earlier request repeats it on the current code.  Every
+    # word must come from FOLLOW_UP_WORDS and one of them must ask for a
+    # repeat, so "what is this" or "tell me more about classes" are not
+    # taken for one.
+    FOLLOW_UP_MAX_WORDS = 3
+    FOLLOW_UP_REPEATS = frozenset(('again', 'more', 'now', 'same'))
+    FOLLOW_UP_WORDS = FOLLOW_UP_REPEATS | frozenset(
+        ('do', 'it', 'that', 'this', 'one', 'the', 'please', 'once', 'with', 'on', 'code'))
+
+    def __init__(self, cache_size=1024, cache_ttl=300):
+        self.response_cache = LRUCache(cache_size, cache_ttl)
+        # explain/debug/optimize on the same code share one analysis.
+        self.analysis_cache = LRUCache(64)
         
-    def generate_response(self, message, current_code=""):
+    def generate_response(self, message, current_code="", history=()):
+        # `history` is the session's earlier messages, oldest first.
+        started = time.perf_counter()
         message_lower = message.lower()
+        intent = self.classify_intent(message_lower)
+        if intent == "general" and history:
+            intent = self.follow_up_intent(message_lower, history)
+        
+        key = self.cache_key(intent, message_lower, current_code)
+        if key is not None:
+            response = self.response_cache.get(key)
+            if response is not None:
+                assistant_seconds.observe(time.perf_counter() - started, (intent,))
+                return response
         
-        if "help" in message_lower:
-            return self.get_help_response(message_lower, current_code)
-        elif "explain" in message_lower:
-            return self.explain_code(current_code)
-        elif "debug" in message_lower or "fix" in message_lower:
-            return self.debug_code(current_code)
-        elif "write" in message_lower or "create" in message_lower:
-            return self.suggest_code(message)
-        elif "optimize" in message_lower:
-            return self.optimize_code(current_code)
+        if intent == "help":
+            response = self.get_help_response(message_lower, current_code)
+        elif intent == "explain":
+            response = self.explain_code(current_code)
+        elif intent == "debug":
+            response = self.debug_code(current_code)
+        elif intent == "write":
+            response = self.suggest_code(message)
+        elif intent == "optimize":
+            response = self.optimize_code(current_code)
         else:
-            return self.general_response(message)
+            response = self.general_response(message)
+        
+        if key is not None:
+            self.response_cache.put(key, response)
+        assistant_seconds.observe(time.perf_counter() - started, (intent,))
+        return response
+    
+    def classify_intent(self, message_lower):
+        return self.INTENTS.route(message_lower)
+    
+    def is_follow_up(self, message_lower):
+        words = WORD_RE.findall(message_lower)
+        return (0 < len(words) <= self.FOLLOW_UP_MAX_WORDS
+                and self.FOLLOW_UP_WORDS.issuperset(words)
+                and not self.FOLLOW_UP_REPEATS.isdisjoint(words))
+
+    def follow_up_intent(self, message_lower, history):
+        if not self.is_follow_up(message_lower):
+            return "general"
+        for previous in reversed(history):
+            if previous.role == 'user':
+                intent = self.classify_intent(previous.text.lower())
+                if intent in self.CODE_INTENTS:
+                    return intent
+        return "general"
+    
+    def cache_key(self, intent, message_lower, code):
+        if intent in self.CODE_INTENTS:
+            return (intent, self.code_key(code))
+        if intent == "general":
+            # Echoes the message back; cheaper to build than to cache.
+            return None
+        normalized = " ".join(message_lower.split())
+        if intent == "help":
+            return (intent, normalized, self.code_key(code))
+        return (intent, normalized)
+    
+    def code_key(self, code):
+        if isinstance(code, DocumentSnapshot):
+            return code.key
+        return code_digest(code)
     
     def get_help_response(self, message, code):
-        if "function" in message:
+        topic = self.HELP_TOPICS.route(message)
+        if topic == "function":
             return """Here's how to write good functions:
 
 1. **Single Responsibility**: Each function should do one thing well
@@ -56,7 +1553,7 @@ def calculate_area(length: float, width: float) -> float:
     '''Calculate rectangle area'''
     return length * width
 ```"""
-        elif "debug" in message:
+        elif topic == "debug":
             return self.debug_code(code)
         else:
             return """I can help with:
@@ -68,46 +1565,62 @@ def calculate_area(length: float, width: float) -> float:
 
 Try asking: 'write a function to sort a list' or 'explain this code'"""
 
+    def analyze(self, code):
+        # `code` is the editor text, or a snapshot of the session document.
+        if isinstance(code, DocumentSnapshot):
+            return code.analysis
+        key = code_digest(code)
+        analysis = self.analysis_cache.get(key)
+        if analysis is None:
+            analysis = analyze_code(code)
+            self.analysis_cache.put(key, analysis)
+        return analysis
+
     def explain_code(self, code):
-        if not code.strip():
+        analysis = self.analyze(code)
+        if not analysis.line_count:
             return "Please paste code in the editor for me to explain!"
         
-        lines = code.strip().split('\n')
-        functions = [line for line in lines if line.strip().startswith('def ')]
-        classes = [line for line in lines if line.strip().startswith('class ')]
+        functions = analysis.functions
+        classes = analysis.classes
         
         response = f"**Code Analysis:**\n\n"
-        response += f"• {len(lines)} lines of code\n"
+        response += f"• {analysis.line_count} lines of code\n"
         response += f"• {len(functions)} functions\n"
         response += f"• {len(classes)} classes\n\n"
         
         if functions:
             response += "**Functions found:**\n"
             for func in functions[:3]:
-                response += f"• {func.strip()}\n"
+                response += f"• {func}\n"
                 
         if classes:
             response += "\n**Classes found:**\n"
             for cls in classes[:3]:
-                response += f"• {cls.strip()}\n"
+                response += f"• {cls}\n"
                 
         return response
 
     def debug_code(self, code):
-        if not code.strip():
+        analysis = self.analyze(code)
+        if not analysis.line_count:
             return "Please paste your code so I can help debug it!"
             
+        balance = analysis.bracket_balance
         issues = []
         
-        if "=" in code and "==" not in code and "print" in code:
-            issues.append("• Check if you meant to use == for comparison")
+        if analysis.assign_in_condition:
+            issues.append(f"• Check if you meant to use == for comparison ({format_lines(analysis.assign_in_condition)})")
             
-        if code.count("(") != code.count(")"):
+        if balance['(']:
             issues.append("• Unmatched parentheses")
             
-        if code.count("[") != code.count("]"):
+        if balance['[']:
             issues.append("• Unmatched brackets")
             
+        if balance['{']:
+            issues.append("• Unmatched braces")
+            
         response = "**Debugging Tips:**\n\n"
         
         if issues:
@@ -126,16 +1639,17 @@ Try asking: 'write a function to sort a list' or 'explain this code'"""
         return response
 
     def optimize_code(self, code):
-        if not code.strip():
+        analysis = self.analyze(code)
+        if not analysis.line_count:
             return "Please paste code for optimization suggestions!"
             
         suggestions = []
         
-        if "for" in code and "append" in code:
-            suggestions.append("• Consider list comprehensions instead of loops with append")
+        if analysis.append_in_loop:
+            suggestions.append(f"• Consider list comprehensions instead of loops with append ({format_lines(analysis.append_in_loop)})")
             
-        if code.count("for") > 2:
-            suggestions.append("• Multiple nested loops - consider algorithmic improvements")
+        if analysis.max_loop_depth > 1:
+            suggestions.append(f"• Multiple nested loops (depth {analysis.max_loop_depth}) - consider algorithmic improvements")
             
         response = "**Optimization Suggestions:**\n\n"
         
@@ -154,7 +1668,8 @@ Try asking: 'write a function to sort a list' or 'explain this code'"""
         return response
 
     def suggest_code(self, message):
-        if "sort" in message.lower():
+        topic = self.SNIPPET_TOPICS.route(message.lower())
+        if topic == "sort":
             return """**Sorting in Python:**
 
 ```python
@@ -169,7 +1684,7 @@ sorted_numbers = sorted(numbers)
 students = [('Alice', 85), ('Bob', 75)]
 students.sort(key=lambda x: x[1])  # Sort by grade
 ```"""
-        elif "file" in message.lower():
+        elif topic == "file":
             return """**File Operations:**
 
 ```python
@@ -177,110 +1692,1913 @@ students.sort(key=lambda x: x[1])  # Sort by grade
 with open('file.txt', 'r') as f:
     content = f.read()
 
-# Writing
-with open('output.txt', 'w') as f:
-    f.write('Hello World')
+# Writing
+with open('output.txt', 'w') as f:
+    f.write('Hello World')
+
+# Appending
+with open('log.txt', 'a') as f:
+    f.write('New entry\\n')
+```"""
+        else:
+            return "Could you be more specific? For example: 'write a function to reverse a string' or 'create a class for a calculator'"
+
+    def general_response(self, message):
+        return f"""I understand you're asking about: "{message}"
+
+I can help with:
+- Writing code examples
+- Explaining programming concepts
+- Debugging errors
+- Code optimization
+
+Could you provide more details or specific code?"""
+
+assistant = CodeAssistant()
+documents = DocumentStore()
+sessions = SessionStore()
+
+SNIPPET_LIBRARY = {
+    "Python": {
+        "Function": "def function_name(param1, param2):\n    '''Description'''\n    return result",
+        "Class": "class ClassName:\n    def __init__(self, param):\n        self.param = param\n    \n    def method(self):\n        pass",
+        "Try-Except": "try:\n    # Code here\n    pass\nexcept Exception as e:\n    print(f'Error: {e}')",
+        "File Reading": "with open('filename.txt', 'r') as file:\n    content = file.read()",
+        "API Request": "import requests\nresponse = requests.get('https://api.example.com/data')\ndata = response.json()"
+    },
+    "JavaScript": {
+        "Function": "function functionName(param1, param2) {\n    return result;\n}",
+        "Arrow Function": "const functionName = (param1, param2) => {\n    return result;\n};",
+        "Class": "class ClassName {\n    constructor(param) {\n        this.param = param;\n    }\n    \n    method() {\n        return this.param;\n    }\n}",
+        "Async Function": "async function fetchData() {\n    try {\n        const response = await fetch('url');\n        const data = await response.json();\n        return data;\n    } catch (error) {\n        console.error('Error:', error);\n    }\n}"
+    }
+}
+
+snippets = SnippetStore(SNIPPET_LIBRARY)
+
+class ResourceLimitExceeded(Exception):
+    # A runner stopped the program for going over one of its limits.
+    # Runners that measure resource usage attach it as `usage`.
+    usage = None
+
+
+class OutputLimitExceeded(ResourceLimitExceeded):
+    def __init__(self, limit):
+        super().__init__(f'Output truncated after {limit} bytes')
+        self.limit = limit
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    # Set from another thread to stop a run.  Runners wait on fileno()
+    # next to the program's pipes, so cancel() wakes them at once.
+    def __init__(self):
+        self._read, self._write = os.pipe()
+        self._lock = threading.Lock()
+        self.cancelled = False
+        self.closed = False
+
+    def fileno(self):
+        return self._read
+
+    def cancel(self):
+        # The flag goes up before the wakeup so a woken runner sees it.
+        with self._lock:
+            wake = not self.cancelled and not self.closed
+            self.cancelled = True
+            if wake:
+                os.write(self._write, b'x')
+
+    def check(self):
+        if self.cancelled:
+            raise RunCancelled('Run cancelled')
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self.closed = True
+                os.close(self._read)
+                os.close(self._write)
+
+
+class RunOutput(tuple):
+    # (stdout, stderr) as returned by a runner, plus resource usage when
+    # the runner measures it.
+    def __new__(cls, stdout, stderr, usage=None):
+        output = super().__new__(cls, (stdout, stderr))
+        output.usage = usage
+        return output
+
+
+class TokenBucket:
+    # Refills at `rate` tokens per second up to `capacity`.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        # Takes `amount` tokens even if that leaves the bucket in debt and
+        # returns how long the caller should wait before going ahead.
+        self._refill()
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def take(self, amount):
+        # Takes `amount` tokens if they are there; otherwise takes nothing
+        # and returns how long until they will be.
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0
+        return (amount - self.tokens) / self.rate
+
+
+class ExecutionRejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class ExecutionScheduler:
+    # Admission control in front of the runner: at most `max_running`
+    # programs at once, up to `max_queued` more waiting in FIFO order for at
+    # most `max_wait` seconds, and a token bucket per client address.  A
+    # finished run hands its slot straight to the oldest waiter.  Addresses
+    # in `trusted_clients` (a CI host posting large /batch runs, say) have
+    # no token bucket, but wait for slots like everyone else.
+    def __init__(self, max_running=16, max_queued=32, max_wait=5.0,
+                 client_rate=1.0, client_burst=5, max_clients=4096, trusted_clients=()):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.trusted_clients = frozenset(trusted_clients)
+        self.max_clients = max_clients
+        self.running = 0
+        self._waiters = deque()
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        # Recent queue waits and an average run time for Retry-After.
+        self._waits = deque(maxlen=1024)
+        self._run_seconds = 1.0
+        self.admitted = 0
+        self.rate_limited = 0
+        self.queue_full = 0
+        self.timed_out = 0
+
+    def acquire(self, client, charge=True):
+        # Returns a ticket for release(), or raises ExecutionRejected.
+        # charge=False skips the client's rate limit for a run that was
+        # already charged through charge().
+        arrived = time.monotonic()
+        with self._lock:
+            bucket = self._charge(client) if charge else None
+            if self.running < self.max_running and not self._waiters:
+                self.running += 1
+                return self._admit(arrived, arrived)
+            if len(self._waiters) >= self.max_queued:
+                self.queue_full += 1
+                self._refund(bucket)
+                raise ExecutionRejected(503, 'Server is busy running other code, please try again',
+                                        self._retry_after())
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        waiter.wait(self.max_wait)
+        with self._lock:
+            # release() sets the event under the lock, so this is final.
+            if waiter.is_set():
+                return self._admit(arrived, time.monotonic())
+            self._waiters.remove(waiter)
+            self.timed_out += 1
+            self._refund(bucket)
+            raise ExecutionRejected(503, 'Server is busy running other code, please try again',
+                                    self._retry_after())
+
+    def charge(self, client, amount=1):
+        # Applies the client's rate limit to `amount` runs at once, all or
+        # nothing, without taking a slot.
+        with self._lock:
+            self._charge(client, amount)
+
+    def refund(self, client):
+        # Gives back the token of a charged run that never got a slot.
+        with self._lock:
+            self._refund(self._buckets.get(client) if self.client_rate > 0 else None)
+
+    def release(self, ticket):
+        with self._lock:
+            self._run_seconds = 0.9 * self._run_seconds + 0.1 * (time.monotonic() - ticket)
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self.running -= 1
+
+    def _admit(self, arrived, now):
+        self.admitted += 1
+        self._waits.append(now - arrived)
+        return now
+
+    def _charge(self, client, amount=1):
+        bucket = self._bucket(client)
+        if bucket is not None:
+            delay = bucket.take(amount)
+            if delay:
+                self.rate_limited += 1
+                raise ExecutionRejected(429, 'Too many runs from this client, please wait a moment', delay)
+        return bucket
+
+    def limits_rate(self, client):
+        return self.client_rate > 0 and client not in self.trusted_clients
+
+    def _bucket(self, client):
+        if not self.limits_rate(client):
+            return None
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.client_rate, self.client_burst)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        return bucket
+
+    def _refund(self, bucket):
+        # Turned away for lack of capacity, not for the client's own rate.
+        if bucket is not None:
+            bucket.tokens = min(bucket.capacity, bucket.tokens + 1)
+
+    def _retry_after(self):
+        return self._run_seconds * (len(self._waiters) + 1) / self.max_running
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                'running': self.running,
+                'queued': len(self._waiters),
+                'max_running': self.max_running,
+                'max_queued': self.max_queued,
+                'admitted': self.admitted,
+                'rate_limited': self.rate_limited,
+                'queue_full': self.queue_full,
+                'timed_out': self.timed_out,
+                'wait_ms_p50': round(waits[len(waits) // 2] * 1000, 3) if waits else 0.0,
+                'wait_ms_p99': round(waits[int(len(waits) * 0.99)] * 1000, 3) if waits else 0.0,
+                'wait_ms_max': round(waits[-1] * 1000, 3) if waits else 0.0,
+                'run_ms_avg': round(self._run_seconds * 1000, 3),
+            }
+
+
+def new_output_decoder():
+    return io.IncrementalNewlineDecoder(
+        codecs.getincrementaldecoder('utf-8')(errors='replace'), translate=True)
+
+def pump_output(process, timeout, on_output=None, wait=True, exit_fd=None, cancel=None):
+    # Reads the child's stdout and stderr as data arrives and hands decoded
+    # text to on_output(stream, text).  Without a callback the output is
+    # collected and returned like communicate() would.  With wait=False
+    # the caller reaps the process itself.  If `exit_fd` (a pidfd) is given,
+    # reading stops once the child has exited and its pipes are drained,
+    # even if a process it started still holds them open.  A CancelToken
+    # passed as `cancel` stops the pump with RunCancelled.
+    deadline = time.monotonic() + timeout
+    collected = {'stdout': [], 'stderr': []}
+    if on_output is None:
+        on_output = lambda stream, text: collected[stream].append(text)
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, ('stdout', new_output_decoder()))
+        selector.register(process.stderr, selectors.EVENT_READ, ('stderr', new_output_decoder()))
+        if exit_fd is not None:
+            selector.register(exit_fd, selectors.EVENT_READ, None)
+        if cancel is not None:
+            cancel.check()
+            selector.register(cancel, selectors.EVENT_READ, 'cancel')
+        open_streams = 2
+        exited = False
+        while open_streams:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            events = selector.select(0 if exited else remaining)
+            if exited and not events:
+                for key in list(selector.get_map().values()):
+                    stream, decoder = key.data
+                    text = decoder.decode(b'', final=True)
+                    if text:
+                        on_output(stream, text)
+                break
+            for key, _ in events:
+                if key.data is None:
+                    selector.unregister(exit_fd)
+                    exited = True
+                    continue
+                if key.data == 'cancel':
+                    cancel.check()
+                    continue
+                stream, decoder = key.data
+                chunk = os.read(key.fd, 65536)
+                if chunk:
+                    text = decoder.decode(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+                    open_streams -= 1
+                    text = decoder.decode(b'', final=True)
+                if text:
+                    on_output(stream, text)
+    if wait:
+        process.wait(timeout=max(deadline - time.monotonic(), 0))
+    return ''.join(collected['stdout']), ''.join(collected['stderr'])
+
+
+# Bootstrap for spawned interpreters.  The program arrives on stdin, which
+# is then at EOF for it, and runs as 'main.py' the way pool workers run it,
+# so nothing touches the disk and tracebacks read the same either way.
+# traceback and linecache are imported only on error: together they cost
+# about as much as the rest of interpreter startup.  RUN_RLIMITS carries
+# the sandbox's rlimits as "resource:soft:hard" triples; they are set here,
+# before the program runs, because a preexec_fn is not safe to run in the
+# forked child of a threaded server.
+SPAWN_LOADER_SOURCE = r'''
+import os, sys
+limits = os.environ.pop('RUN_RLIMITS', '')
+if limits:
+    import resource
+    for limit in limits.split():
+        limit, soft, hard = map(int, limit.split(':'))
+        resource.setrlimit(limit, (soft, hard))
+source = sys.stdin.buffer.read().decode('utf-8', 'surrogatepass')
+sys.argv = ['main.py']
+
+def report(error, tb):
+    import linecache, traceback
+    linecache.cache['main.py'] = (len(source), None, source.splitlines(True), 'main.py')
+    traceback.print_exception(type(error), error, tb)
+    sys.exit(1)
+
+try:
+    code = compile(source, 'main.py', 'exec')
+except SyntaxError as e:
+    report(e, None)
+try:
+    exec(code, {'__name__': '__main__', '__builtins__': __builtins__})
+except SystemExit:
+    raise
+except BaseException as e:
+    report(e, e.__traceback__.tb_next)
+'''
+
+class ChildProcesses:
+    # Every interpreter the runners have started and not yet reaped, so a
+    # shutdown that runs out of time can kill the programs requests are
+    # still waiting on.  Sandboxed programs are killed with their whole
+    # process group.  The lock is held while killing so a group cannot be
+    # reaped, and its id reused, in between.
+    def __init__(self):
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def add(self, process, group=False):
+        with self._lock:
+            self._processes[process] = group
+
+    def discard(self, process):
+        with self._lock:
+            self._processes.pop(process, None)
+
+    def kill_all(self):
+        with self._lock:
+            for process, group in self._processes.items():
+                try:
+                    if group:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    elif process.poll() is None:
+                        process.kill()
+                except (ProcessLookupError, PermissionError):
+                    pass
+            return len(self._processes)
+
+
+children = ChildProcesses()
+
+# Set to N in worker N of a --workers server.
+worker_id = None
+
+
+class SubprocessRunner:
+    # Runs every submission in a freshly spawned interpreter.
+    def __init__(self, python='python3'):
+        self.python = python
+
+    def spawn(self, code, streaming, limits=(), **options):
+        # Piped stdout is block buffered; streaming callers want to see
+        # output as soon as the program prints it.
+        started = time.perf_counter()
+        env = dict(os.environ, PYTHONUNBUFFERED='1') if streaming else None
+        if limits:
+            env = dict(env or os.environ, RUN_RLIMITS=' '.join(
+                f'{limit}:{soft}:{hard}' for limit, (soft, hard) in limits))
+        process = subprocess.Popen(
+            [self.python, '-c', SPAWN_LOADER_SOURCE],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            **options
+        )
+        children.add(process, group=options.get('start_new_session', False))
+        # The loader reads all of stdin before running anything, so this
+        # cannot deadlock on a full pipe.  If the interpreter died on
+        # startup its stderr says why.
+        try:
+            process.stdin.write(code.encode('utf-8', 'surrogatepass'))
+        except BrokenPipeError:
+            pass
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        runner_startup_seconds.observe(time.perf_counter() - started, (type(self).__name__,))
+        if profiler.active:
+            profiler.lap('spawn')
+        return process
+
+    @metered
+    def run(self, code, timeout=10, on_output=None, cancel=None):
+        process = None
+        try:
+            process = self.spawn(code, on_output is not None)
+            return pump_output(process, timeout, on_output, cancel=cancel)
+        finally:
+            if process is not None:
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+                children.discard(process)
+                process.stdout.close()
+                process.stderr.close()
+
+    def close(self):
+        pass
+
+
+class SandboxRunner(SubprocessRunner):
+    # Spawns every submission like SubprocessRunner, but in a session of its
+    # own and under rlimits for CPU seconds, address space, open files and
+    # processes, which the loader sets before the program runs.  The
+    # kernel counts RLIMIT_NPROC over all processes of the user (and does
+    # not apply it to root), so run the server under a dedicated account.
+    # Output past max_output_bytes, a timeout or the end of the run kill
+    # the whole process group, and the CPU time and peak RSS of the
+    # program are reported with the result.
+    def __init__(self, python='python3', cpu_seconds=5, memory_bytes=512 * 1024 * 1024,
+                 max_open_files=64, max_processes=64, max_output_bytes=1024 * 1024):
+        if resource is None:
+            raise RuntimeError('the sandbox executor needs the resource module')
+        super().__init__(python)
+        self.cpu_seconds = cpu_seconds
+        self.max_output_bytes = max_output_bytes
+        self.limits = []
+        for limit, value, hard in ((resource.RLIMIT_CPU, cpu_seconds, cpu_seconds + 1),
+                                   (resource.RLIMIT_AS, memory_bytes, memory_bytes),
+                                   (resource.RLIMIT_NOFILE, max_open_files, max_open_files),
+                                   (resource.RLIMIT_NPROC, max_processes, max_processes),
+                                   (resource.RLIMIT_CORE, 0, 0)):
+            # An unprivileged server cannot raise its own hard limits.
+            current = resource.getrlimit(limit)[1]
+            if current != resource.RLIM_INFINITY:
+                value, hard = min(value, current), min(hard, current)
+            self.limits.append((limit, (value, hard)))
+
+    @metered
+    def run(self, code, timeout=10, on_output=None, cancel=None):
+        collected = {'stdout': [], 'stderr': []}
+        deliver = on_output or (lambda stream, text: collected[stream].append(text))
+        remaining = self.max_output_bytes
+        
+        def capped(stream, text):
+            nonlocal remaining
+            data = text.encode('utf-8')
+            if len(data) > remaining:
+                text = data[:remaining].decode('utf-8', 'ignore')
+                if text:
+                    deliver(stream, text)
+                raise OutputLimitExceeded(self.max_output_bytes)
+            remaining -= len(data)
+            deliver(stream, text)
+        
+        process = None
+        usage = None
+        started = time.monotonic()
+        try:
+            process = self.spawn(code, on_output is not None, self.limits, start_new_session=True)
+            
+            # A pidfd lets the pump stop when the program exits instead of
+            # when the last process holding its pipes does.
+            exit_fd = os.pidfd_open(process.pid) if hasattr(os, 'pidfd_open') else None
+            try:
+                pump_output(process, timeout, capped, wait=False, exit_fd=exit_fd, cancel=cancel)
+            finally:
+                if exit_fd is not None:
+                    os.close(exit_fd)
+            self.wait_exit(process, started + timeout, timeout, cancel)
+        except (ResourceLimitExceeded, subprocess.TimeoutExpired) as e:
+            if process is not None:
+                usage = self.reap(process, started)
+            e.usage = usage
+            raise
+        finally:
+            if process is not None and usage is None:
+                usage = self.reap(process, started)
+        
+        if process.returncode == -signal.SIGXCPU or (
+                process.returncode == -signal.SIGKILL and usage['cpu_seconds'] >= self.cpu_seconds):
+            error = ResourceLimitExceeded(f'CPU time limit exceeded ({self.cpu_seconds} s)')
+            error.usage = usage
+            raise error
+        return RunOutput(''.join(collected['stdout']), ''.join(collected['stderr']), usage)
+
+    @staticmethod
+    def wait_exit(process, deadline, timeout, cancel=None):
+        # Waits for the program to exit without reaping it: while its
+        # zombie holds the process group id, killpg() cannot hit a group
+        # that reused the number.
+        delay = 0.001
+        while not os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT):
+            if time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            if cancel is not None:
+                cancel.check()
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    @staticmethod
+    def reap(process, started):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        children.discard(process)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        process.stdout.close()
+        process.stderr.close()
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+        return {
+            'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3),
+            'max_rss_bytes': max_rss,
+            'wall_seconds': round(time.monotonic() - started, 3),
+        }
+
+
+# Bootstrap for pool workers.  Requests and replies are length-prefixed JSON
+# frames on the worker's original stdin/stdout; fds 0-2 are then pointed at
+# /dev/null.  The worker itself never runs submitted code: it forks a child
+# per request, so every run starts from the same freshly imported state and
+# nothing a program changes (builtins, modules, threads) outlives it.  The
+# child's stdout and stderr are pipes the worker forwards as
+# {'stream', 'data'} frames, followed by a final {'done'} once it exits.
+POOL_WORKER_SOURCE = r'''
+import atexit, codecs, io, json, linecache, os, select, struct, sys, traceback
+
+def run(code, stream, protocol, send):
+    out_read, out_write = os.pipe()
+    err_read, err_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Like a spawned run, the child waits for its threads and runs its
+        # atexit handlers, but skips interpreter finalization, which would
+        # cost more than the run.  The protocol pipes stay open but lead to
+        # /dev/null.
+        status = 0
+        try:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in protocol:
+                os.dup2(devnull, fd)
+            os.close(devnull)
+            os.close(out_read)
+            os.close(err_read)
+            os.dup2(out_write, 1)
+            os.dup2(err_write, 2)
+            os.close(out_write)
+            os.close(err_write)
+            sys.stdout = sys.__stdout__ = os.fdopen(1, 'w', buffering=1 if stream else -1)
+            sys.stderr = sys.__stderr__ = os.fdopen(2, 'w', buffering=1)
+            sys.argv = ['main.py']
+            linecache.cache['main.py'] = (len(code), None, code.splitlines(True), 'main.py')
+            try:
+                exec(compile(code, 'main.py', 'exec'), {'__name__': '__main__', '__builtins__': __builtins__})
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    status = e.code
+                elif e.code is not None:
+                    print(e.code, file=sys.stderr)
+                    status = 1
+            except SyntaxError as e:
+                traceback.print_exception(type(e), e, None)
+                status = 1
+            except BaseException as e:
+                traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+                status = 1
+            if 'threading' in sys.modules:
+                threading = sys.modules['threading']
+                for thread in threading.enumerate():
+                    if thread is not threading.main_thread() and not thread.daemon:
+                        thread.join()
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+    os.close(out_write)
+    os.close(err_write)
+    streams = {out_read: 'stdout', err_read: 'stderr'}
+    decoders = {fd: codecs.getincrementaldecoder('utf-8')('replace') for fd in streams}
+    while streams:
+        for fd in select.select(list(streams), [], [])[0]:
+            chunk = os.read(fd, 65536)
+            text = decoders[fd].decode(chunk, final=not chunk)
+            if text:
+                send({'stream': streams[fd], 'data': text})
+            if not chunk:
+                os.close(fd)
+                del streams[fd]
+    status = os.waitpid(pid, 0)[1]
+    if os.WIFSIGNALED(status):
+        send({'stream': 'stderr',
+              'data': f'Process exited unexpectedly with code {-os.WTERMSIG(status)}\n'})
+
+def main():
+    requests = os.fdopen(os.dup(0), 'rb')
+    replies = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+    def send(frame):
+        payload = json.dumps(frame).encode()
+        replies.write(struct.pack('>I', len(payload)) + payload)
+        replies.flush()
+
+    send({})
+    while True:
+        header = requests.read(4)
+        if len(header) < 4:
+            return
+        request = json.loads(requests.read(struct.unpack('>I', header)[0]))
+        run(request['code'], request['stream'], (requests.fileno(), replies.fileno()), send)
+        send({'done': True})
+
+main()
+'''
+
+class PoolWorker:
+    # The worker and the program it has forked share a process group of
+    # their own, so killing the worker on timeout takes the program along.
+    def __init__(self, python):
+        self.process = subprocess.Popen(
+            [python, '-c', POOL_WORKER_SOURCE],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            start_new_session=True,
+        )
+        children.add(self.process, group=True)
+        self.runs = 0
+        self.ready = False
+        self._buffer = bytearray()
+
+    def wait_ready(self, deadline, cancel=None):
+        # Workers announce themselves with an empty frame once the
+        # interpreter is up; consume it before the first request.
+        if not self.ready:
+            if self.receive(deadline, cancel) is None:
+                return None
+            self.ready = True
+        return True
+
+    def send(self, code, stream=False):
+        payload = json.dumps({'code': code, 'stream': stream}).encode()
+        self.process.stdin.write(struct.pack('>I', len(payload)) + payload)
+        self.process.stdin.flush()
+        self.runs += 1
+
+    def receive(self, deadline, cancel=None):
+        fd = self.process.stdout.fileno()
+        waiting = [fd] if cancel is None else [fd, cancel]
+        buffer = self._buffer
+        while True:
+            if len(buffer) >= 4:
+                end = 4 + struct.unpack('>I', buffer[:4])[0]
+                if len(buffer) >= end:
+                    frame = json.loads(bytes(buffer[4:end]))
+                    del buffer[:end]
+                    return frame
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired('pool worker', 0)
+            ready, _, _ = select.select(waiting, [], [], remaining)
+            if cancel is not None:
+                cancel.check()
+            if fd not in ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return None
+            buffer += chunk
+
+    def kill(self):
+        # Until it is reaped the worker's pid, and so its group id, cannot
+        # be reused.
+        if self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+        self.process.wait()
+        children.discard(self.process)
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+class InterpreterPool:
+    # Keeps `size` interpreters started and idle so a run only pays for a
+    # fork and a pipe round trip.  Workers are replaced after `max_runs_per_worker` runs,
+    # on timeout, and whenever they crash.  If every worker is busy and no
+    # replacement is on its way, a fresh one is started on demand.
+    def __init__(self, size=4, max_runs_per_worker=50, python='python3'):
+        self.size = size
+        self.max_runs_per_worker = max_runs_per_worker
+        self.python = python
+        self._idle = []
+        self._starting = 0
+        self._available = threading.Condition()
+        self._closed = False
+        for i in range(size):
+            worker = PoolWorker(python)
+            # Stagger retirement so the initial workers are not all
+            # replaced at the same moment.
+            worker.runs = i * max_runs_per_worker // size
+            self._idle.append(worker)
+
+    @metered
+    def run(self, code, timeout=10, on_output=None, cancel=None):
+        streaming = on_output is not None
+        collected = {'stdout': [], 'stderr': []}
+        if not streaming:
+            on_output = lambda stream, text: collected[stream].append(text)
+        started = time.perf_counter()
+        worker = self._checkout()
+        deadline = time.monotonic() + timeout
+        try:
+            frame = worker.wait_ready(deadline, cancel)
+            if frame is not None:
+                worker.send(code, stream=streaming)
+                runner_startup_seconds.observe(time.perf_counter() - started, (type(self).__name__,))
+                if profiler.active:
+                    profiler.lap('spawn')
+                frame = worker.receive(deadline, cancel)
+                while frame is not None and 'done' not in frame:
+                    on_output(frame['stream'], frame['data'])
+                    frame = worker.receive(deadline, cancel)
+        except subprocess.TimeoutExpired:
+            self._discard(worker)
+            raise subprocess.TimeoutExpired('pool worker', timeout)
+        except (BrokenPipeError, OSError):
+            frame = None
+        except BaseException:
+            # The callback gave up or the run was cancelled mid-run; the
+            # worker is still busy.
+            self._discard(worker)
+            raise
+        if frame is None:
+            self._discard(worker)
+            returncode = worker.process.returncode
+            if returncode != 0:
+                on_output('stderr', f'Process exited unexpectedly with code {returncode}\n')
+        else:
+            self._checkin(worker)
+        return ''.join(collected['stdout']), ''.join(collected['stderr'])
+
+    def _discard(self, worker):
+        worker.kill()
+        self._replenish()
+
+    def _checkout(self):
+        with self._available:
+            # A replacement that is already starting will be ready sooner
+            # than an interpreter started from scratch.
+            while not self._idle and self._starting:
+                self._available.wait()
+            if self._idle:
+                return self._idle.pop()
+        return PoolWorker(self.python)
+
+    def _checkin(self, worker):
+        if worker.runs < self.max_runs_per_worker:
+            with self._available:
+                if not self._closed and len(self._idle) < self.size:
+                    self._idle.append(worker)
+                    self._available.notify()
+                    return
+        worker.kill()
+        self._replenish()
+
+    def _replenish(self):
+        # Start replacements off the request path.
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    def _fill(self):
+        while True:
+            with self._available:
+                if self._closed or len(self._idle) + self._starting >= self.size:
+                    return
+                self._starting += 1
+            worker = None
+            try:
+                worker = PoolWorker(self.python)
+                if worker.wait_ready(time.monotonic() + 30) is None:
+                    worker.kill()
+                    worker = None
+            except (OSError, subprocess.TimeoutExpired):
+                if worker is not None:
+                    worker.kill()
+                worker = None
+            with self._available:
+                self._starting -= 1
+                if worker is not None and not self._closed:
+                    self._idle.append(worker)
+                    worker = None
+                self._available.notify()
+            if worker is not None:
+                worker.kill()
+                return
+
+    def close(self):
+        with self._available:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._available.notify_all()
+        for worker in idle:
+            worker.kill()
+
+
+@functools.lru_cache(maxsize=None)
+def interpreter_version(python):
+    try:
+        return subprocess.run([python, '-c', 'import sys; print(sys.version)'],
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class RunCache:
+    # Output of programs that ran to completion, keyed by a hash of the code
+    # and the executor and interpreter version that ran it.  Programs that
+    # look non-deterministic (clock, randomness, environment, I/O, input)
+    # are never cached, and callers can opt out per request.
+    NONDETERMINISTIC_RE = re.compile(
+        r'\b(?:random|secrets|uuid|time|datetime|os|sys|subprocess|socket|threading|'
+        r'multiprocessing|asyncio|urllib|requests|http|input|open)\b')
+
+    def __init__(self, maxsize=256, ttl=600, max_bytes=16 * 1024 * 1024, db=None):
+        self.results = LRUCache(maxsize, ttl, max_bytes=max_bytes,
+                                sizeof=lambda output: len(output[0]) + len(output[1]) + 64)
+        self.uncacheable = 0
+        # A SQLiteStore also keeps results across restarts and past the
+        # memory limit; the TTL applies to both.
+        self.db = db
+
+    def key(self, runner, code):
+        if self.results.maxsize <= 0 or not code.strip():
+            return None
+        version = interpreter_version(getattr(runner, 'python', 'python3'))
+        if version is None or self.NONDETERMINISTIC_RE.search(code):
+            self.uncacheable += 1
+            return None
+        return (type(runner).__name__, version, code_digest(code))
+
+    def get(self, key):
+        output = self.results.get(key)
+        if output is None and self.db is not None:
+            output = self.db.get_run(self.db_key(key), self.results.ttl or None)
+            if output is not None:
+                self.results.put(key, output)
+        return output
+
+    def put(self, key, stdout, stderr):
+        self.results.put(key, (stdout, stderr))
+        if self.db is not None:
+            self.db.put_run(self.db_key(key), stdout, stderr, time.time())
+
+    @staticmethod
+    def db_key(key):
+        executor, version, digest = key
+        return f'{executor}\0{version}\0'.encode() + digest
+
+    def stats(self):
+        stats = self.results.stats()
+        stats['uncacheable'] = self.uncacheable
+        return stats
+
+
+run_cache = RunCache()
+
+
+class Job:
+    def __init__(self, code, client):
+        self.id = os.urandom(16).hex()
+        self.code = code
+        self.client = client
+        self.status = 'queued'
+        self.stdout = []
+        self.stderr = []
+        self.output_bytes = 0
+        self.message = None
+        self.usage = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # Monotonic time after which a finished job may be dropped.
+        self.expires = None
+        self.cancel_token = None
+
+
+class JobManager:
+    # Runs submitted programs on `workers` background threads so no
+    # request waits for them, which allows a much longer `timeout` than
+    # /run.  Each run still takes a scheduler slot, so jobs count against
+    # the same execution cap.  The table holds at most `max_jobs` jobs;
+    # finished ones are kept for `ttl` seconds, and the oldest finished job
+    # makes room for a new one when the table is full.  With a SQLiteStore
+    # as `db`, each change of status is recorded there so that server
+    # processes sharing the database can answer for each other's jobs;
+    # output is only seen that way once the job has finished.
+    def __init__(self, runner, scheduler=None, workers=4, max_jobs=256, ttl=300,
+                 timeout=60, max_output_bytes=1024 * 1024, db=None):
+        self.runner = runner
+        self.db = db
+        self.scheduler = scheduler
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stopped = threading.Event()
+        self.submitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.expired = 0
+        if db is not None:
+            threading.Thread(target=self._watch_cancels, name='job-cancels', daemon=True).start()
+
+    def submit(self, code, client):
+        # Returns the queued Job, or raises ExecutionRejected.
+        if self.scheduler is not None:
+            self.scheduler.charge(client)
+        job = Job(code, client)
+        with self._lock:
+            if self._closed or not self._make_room():
+                self.rejected += 1
+                raise ExecutionRejected(503, 'Too many jobs in progress, please try again later',
+                                        self.timeout / 4)
+            self._jobs[job.id] = job
+            self.submitted += 1
+        self._store(job)
+        self.executor.submit(self._work, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.expires is not None and job.expires <= time.monotonic():
+                del self._jobs[job_id]
+                self.expired += 1
+                return None
+            return job
+
+    def lookup(self, job_id):
+        # The job's description, or None if it is unknown or expired.
+        job = self.get(job_id)
+        if job is not None:
+            return self.describe(job)
+        if self.db is not None:
+            return self.db.get_job(job_id, self.ttl)
+        return None
+
+    def cancel(self, job_id):
+        # Returns the job's description, or None.  A job run by another
+        # process is flagged in the database for that process to cancel.
+        job = self.get(job_id)
+        if job is None:
+            if self.db is not None and self.db.cancel_job(job_id, self.ttl):
+                return self.db.get_job(job_id)
+            return None
+        with self._lock:
+            queued = job.status == 'queued'
+            if queued:
+                self._finish(job, 'cancelled', 'Job cancelled', None)
+            elif job.status == 'running':
+                # The runner kills the program and _work records the outcome.
+                job.cancel_token.cancel()
+        if queued:
+            self._store(job)
+        return self.describe(job)
+
+    def _store(self, job):
+        if self.db is not None:
+            self.db.put_job(job.id, self.describe(job))
+
+    def _watch_cancels(self):
+        while not self._stopped.wait(0.5):
+            with self._lock:
+                active = [job.id for job in self._jobs.values()
+                          if job.status in ('queued', 'running')]
+            if active:
+                for job_id in self.db.cancelled_jobs(active):
+                    self.cancel(job_id)
+
+    def describe(self, job):
+        with self._lock:
+            # Keep one piece per stream so repeated polls do not re-join.
+            stdout = job.stdout[:] = [''.join(job.stdout)]
+            stderr = job.stderr[:] = [''.join(job.stderr)]
+            data = {
+                'id': job.id,
+                'status': job.status,
+                'created': round(job.created, 3),
+                'started': job.started and round(job.started, 3),
+                'finished': job.finished and round(job.finished, 3),
+                'stdout': stdout[0],
+                'stderr': stderr[0],
+            }
+            if job.finished is not None:
+                data['output'] = job.message or RequestHandler.format_output(stdout[0], stderr[0])
+            if job.usage is not None:
+                data['usage'] = job.usage
+            return data
+
+    def _make_room(self):
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.expires is not None and job.expires <= now:
+                del self._jobs[job_id]
+                self.expired += 1
+        if len(self._jobs) < self.max_jobs:
+            return True
+        for job_id, job in self._jobs.items():
+            if job.expires is not None:
+                del self._jobs[job_id]
+                return True
+        return False
+
+    def _work(self, job):
+        scheduler = self.scheduler
+        ticket = None
+        # The job has been accepted, so a full run queue only means waiting
+        # longer; a cancelled job stops waiting.
+        while scheduler is not None and ticket is None and job.status == 'queued':
+            try:
+                ticket = scheduler.acquire(job.client, charge=False)
+            except ExecutionRejected as e:
+                time.sleep(min(e.retry_after, 1))
+        with self._lock:
+            if job.status != 'queued':
+                if ticket is not None:
+                    scheduler.release(ticket)
+                return
+            job.status = 'running'
+            job.started = time.time()
+            job.cancel_token = token = CancelToken()
+        self._store(job)
+
+        def collect(stream, text):
+            size = len(text.encode('utf-8'))
+            with self._lock:
+                if job.output_bytes + size > self.max_output_bytes:
+                    raise OutputLimitExceeded(self.max_output_bytes)
+                job.output_bytes += size
+                getattr(job, stream).append(text)
+
+        status, message, usage = 'done', None, None
+        try:
+            result = self.runner.run(job.code, timeout=self.timeout, on_output=collect, cancel=token)
+            usage = getattr(result, 'usage', None)
+        except RunCancelled:
+            status, message = 'cancelled', 'Job cancelled'
+        except OutputLimitExceeded as e:
+            status, message, usage = 'truncated', str(e), e.usage
+        except ResourceLimitExceeded as e:
+            status, message, usage = 'limit', str(e), e.usage
+        except subprocess.TimeoutExpired as e:
+            status, message, usage = 'timeout', 'Code execution timed out', getattr(e, 'usage', None)
+        except Exception as e:
+            status, message = 'error', f'Error: {str(e)}'
+        finally:
+            token.close()
+            if ticket is not None:
+                scheduler.release(ticket)
+        with self._lock:
+            self._finish(job, status, message, usage)
+        self._store(job)
+
+    def _finish(self, job, status, message, usage):
+        job.status = status
+        job.message = message
+        job.usage = usage
+        job.finished = time.time()
+        job.expires = time.monotonic() + self.ttl
+        job.code = None
+        if status == 'cancelled':
+            self.cancelled += 1
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+            return {
+                'jobs': len(statuses),
+                'max_jobs': self.max_jobs,
+                'queued': statuses.count('queued'),
+                'running': statuses.count('running'),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'cancelled': self.cancelled,
+                'expired': self.expired,
+            }
+
+    def close(self):
+        self._stopped.set()
+        cancelled = []
+        with self._lock:
+            self._closed = True
+            for job in self._jobs.values():
+                if job.status == 'queued':
+                    self._finish(job, 'cancelled', 'Server shutting down', None)
+                    cancelled.append(job)
+                elif job.status == 'running':
+                    job.cancel_token.cancel()
+        for job in cancelled:
+            self._store(job)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Persistent connections are closed after `timeout` idle seconds or
+    # once they have served `max_keepalive_requests` requests.
+    timeout = 5
+    max_keepalive_requests = 100
+    # Headers and body go out in separate writes; with Nagle enabled the
+    # body of every reused-connection response waits for a delayed ACK.
+    disable_nagle_algorithm = True
+    # Limits for /run/stream: total output forwarded and bytes per second.
+    stream_max_bytes = 1024 * 1024
+    stream_max_rate = 256 * 1024
+    # Request bodies above max_body_bytes get a 413 without being read;
+    # smaller ones are read and decoded body_chunk_bytes at a time.
+    max_body_bytes = 4 * 1024 * 1024
+    body_chunk_bytes = 64 * 1024
+    # Assets carry an ETag, so browsers can revalidate cheaply with a 304.
+    static_cache_control = 'no-cache'
+    # Operations accepted in one /batch request.
+    max_batch_items = 1000
+    # JSON responses of at least compress_min_bytes are gzipped for
+    # clients that accept it (0 disables).  Large /run output is mostly
+    # repetitive text; level 1 gets most of the reduction at a fraction
+    # of the time the higher levels take.
+    compress_min_bytes = 1024
+    compress_level = 1
+    # Fields of a JSON request body that must be strings when present.
+    TEXT_FIELDS = ('code', 'message', 'language')
+    ROUTES = frozenset(('/stats', '/metrics', '/snippets', '/chat', '/run', '/run/stream',
+                        '/batch', '/jobs', '/admin/profile', '/admin/profile/stop'))
 
-# Appending
-with open('log.txt', 'a') as f:
-    f.write('New entry\\n')
-```"""
-        else:
-            return "Could you be more specific? For example: 'write a function to reverse a string' or 'create a class for a calculator'"
+    def handle(self):
+        # BaseHTTPRequestHandler.handle, except that the server is told
+        # when the connection sits between requests so a drain can close it.
+        self.requests_handled = 0
+        # Waiting for its first request counts as idle too.
+        self.idle = True
+        self.server.track(self)
+        try:
+            self.close_connection = True
+            self.handle_one_request()
+            while not self.close_connection and self.server.mark_idle(self):
+                self.handle_one_request()
+        finally:
+            self.server.untrack(self)
 
-    def general_response(self, message):
-        return f"""I understand you're asking about: "{message}"
+    def handle_one_request(self):
+        self.request_started = None
+        self.response_status = None
+        self.profile = None
+        self.slot = None
+        try:
+            super().handle_one_request()
+        finally:
+            if self.slot is not None:
+                self.slot.release()
+            if self.profile is not None:
+                profiler.finish(self.profile, self.route_label())
+        if self.request_started is not None and self.response_status is not None:
+            self.record_request()
 
-I can help with:
-- Writing code examples
-- Explaining programming concepts
-- Debugging errors
-- Code optimization
+    def parse_request(self):
+        # Timing starts once the request line is in, so idle keep-alive
+        # time is not counted.
+        self.request_started = time.perf_counter()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.idle = False
+        if not super().parse_request():
+            return False
+        # A request slot is only taken once the request is in, so neither
+        # idle nor slow clients hold one: a POST takes it when its body has
+        # been read (read_body or discard_body), anything else now.
+        if self.command != 'POST':
+            self.take_slot()
+        if profiler.active and not self.path.startswith('/admin/'):
+            self.profile = profiler.begin(self.request_started)
+        return True
 
-Could you provide more details or specific code?"""
+    def take_slot(self):
+        if self.slot is None:
+            self.slot = getattr(self.server, 'in_flight', None)
+            if self.slot is not None:
+                self.slot.acquire()
 
-assistant = CodeAssistant()
+    def record_request(self):
+        route = self.route_label()
+        method = self.command or 'unknown'
+        http_requests.inc((route, method, self.response_status))
+        http_request_seconds.observe(time.perf_counter() - self.request_started, (route, method))
+        if self.bytes_received:
+            http_request_bytes.inc((route,), self.bytes_received)
+        if self.bytes_sent:
+            http_response_bytes.inc((route,), self.bytes_sent)
+
+    def route_label(self):
+        # Label values must come from a fixed set, not from raw paths.
+        path = (self.path or '').partition('?')[0]
+        if path in static_assets or path in self.ROUTES:
+            return path
+        if path.startswith('/jobs/'):
+            return '/jobs/:id/cancel' if path.endswith('/cancel') else '/jobs/:id'
+        return 'other'
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+        self.requests_handled += 1
+        if self.requests_handled >= self.max_keepalive_requests or getattr(self.server, 'draining', False):
+            self.send_header('Connection', 'close')
 
-class RequestHandler(BaseHTTPRequestHandler):
     def do_GET(self):
-        if self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(self.get_html().encode())
-        elif self.path == '/style.css':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/css')
-            self.end_headers()
-            self.wfile.write(self.get_css().encode())
-        elif self.path == '/script.js':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/javascript')
-            self.end_headers()
-            self.wfile.write(self.get_js().encode())
+        # Routed on the path alone, so a query string (a cache-buster, say)
+        # does not turn a route into a 404.
+        url = urllib.parse.urlsplit(self.path)
+        path, query = url.path, url.query
+        asset = static_assets.get(path)
+        if asset is not None:
+            self.send_static(asset)
+        elif path == '/stats':
+            self.send_json(self.collect_stats())
+        elif path == '/metrics':
+            self.send_metrics()
+        elif path == '/admin/profile':
+            if self.admin_allowed():
+                self.send_json(profiler.describe())
+        elif path == '/snippets':
+            params = urllib.parse.parse_qs(query)
+            try:
+                page = int(params.get('page', ['1'])[0])
+            except ValueError:
+                self.send_json({'error': 'page must be a number'}, status=400)
+                return
+            self.send_json(snippets.search(params.get('lang', [''])[0], params.get('q', [''])[0], page))
+        elif path.startswith('/jobs/'):
+            job = self.server.jobs.lookup(path[len('/jobs/'):])
+            if job is None:
+                self.send_json({'error': 'Unknown or expired job'}, status=404)
+                return
+            self.send_json(job)
         else:
-            self.send_response(404)
+            self.send_empty(404)
+            
+    def collect_stats(self):
+        scheduler = getattr(self.server, 'scheduler', None)
+        jobs = getattr(self.server, 'jobs', None)
+        return {
+            'scheduler': scheduler.stats() if scheduler is not None else None,
+            'jobs': jobs.stats() if jobs is not None else None,
+            'response_cache': assistant.response_cache.stats(),
+            'documents': documents.stats(),
+            'sessions': sessions.stats(),
+            'snippets': snippets.stats(),
+            'persistence': sessions.db.stats() if sessions.db is not None else None,
+            'run_cache': run_cache.stats(),
+            'process': {'pid': os.getpid(), 'worker': worker_id},
+        }
+            
+    def send_metrics(self):
+        # /stats numbers are exported as gauges next to the metrics.
+        gauges = []
+        for section, values in self.collect_stats().items():
+            for name, value in (values or {}).items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges.append((f'{section}_{name}', f'{name} from /stats {section}.', value))
+        body = metrics.render(gauges).encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.bytes_sent += len(body)
+
+    def send_static(self, asset):
+        encoding = asset.negotiate(self.headers.get('Accept-Encoding', ''))
+        body, etag = asset.variants[encoding]
+        
+        if asset.matches(self.headers.get('If-None-Match')):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', self.static_cache_control)
+            self.send_header('Vary', 'Accept-Encoding')
             self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-type', asset.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', self.static_cache_control)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+        self.bytes_sent += len(body)
             
     def do_POST(self):
         if self.path == '/chat':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json()
+            if data is None:
+                return
             
             message = data.get('message', '')
             code = data.get('code', '')
+            result = {}
+            headers = []
+            session_id = self.session_id()
+            if session_id is None:
+                session_id = os.urandom(16).hex()
+                headers.append(('Set-Cookie', f'sid={session_id}; Path=/; HttpOnly; SameSite=Strict'))
             
-            response = assistant.generate_response(message, code)
+            # Clients that keep a session document send `sync` with the full
+            # text once, then only `delta`s against the version they hold.
+            if data.get('sync') or 'delta' in data:
+                try:
+                    if 'delta' in data:
+                        delta = data['delta']
+                        code = documents.update(session_id, delta['base'], delta['start'],
+                                                delta['end'], delta['lines'])
+                    else:
+                        code = documents.sync(session_id, code) or code
+                except DocumentConflict as e:
+                    self.send_json({'error': str(e), 'resync': True}, status=409, headers=headers)
+                    return
+                except (KeyError, TypeError, ValueError) as e:
+                    self.send_json({'error': f'Invalid document delta: {e}'}, status=400, headers=headers)
+                    return
+                if not isinstance(code, str):
+                    result['version'] = code.version
             
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'response': response}).encode())
+            response = assistant.generate_response(message, code, sessions.history(session_id))
+            if profiler.active:
+                profiler.lap('analysis')
+            sessions.append(session_id, 'user', message)
+            sessions.append(session_id, 'assistant', response)
+            result['response'] = response
+            if profiler.active:
+                profiler.lap('history')
             
-        elif self.path == '/run':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            self.send_json(result, headers=headers)
+            
+        elif self.path in ('/run', '/run/stream'):
+            data = self.read_json()
+            if data is None:
+                return
             
             code = data.get('code', '')
-            output = self.run_code(code)
+            # Cached results are replayed without taking a run slot.
+            cache_key = run_cache.key(self.server.runner, code) if data.get('cache', True) else None
+            cached = run_cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                self.send_cached_run(*cached)
+                return
             
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'output': output}).encode())
+            if not self.acquire_run_slot():
+                return
+            if profiler.active:
+                profiler.lap('queue')
             
-    def run_code(self, code):
-        if not code.strip():
-            return "No code to run"
+            try:
+                if self.path == '/run/stream':
+                    self.stream_code(code, cache_key)
+                    return
+                output, usage = self.run_code(code, cache_key)
+            finally:
+                self.release_run_slot()
             
-        try:
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-                f.write(code)
-                temp_file = f.name
-                
-            process = subprocess.Popen(
-                ['python3', temp_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
+            result = {'output': output}
+            if usage is not None:
+                result['usage'] = usage
+            self.send_json(result)
+            
+        elif self.path == '/jobs':
+            data = self.read_json()
+            if data is None:
+                return
             
-            stdout, stderr = process.communicate(timeout=10)
+            code = data.get('code', '')
+            if not code.strip():
+                self.send_json({'error': 'No code to run'}, status=400)
+                return
+            try:
+                job = self.server.jobs.submit(code, self.client_address[0])
+            except ExecutionRejected as e:
+                self.send_json({'error': e.message}, status=e.status,
+                               headers=[('Retry-After', str(e.retry_after))])
+                return
+            self.send_json(self.server.jobs.describe(job), status=202,
+                           headers=[('Location', f'/jobs/{job.id}')])
             
-            os.unlink(temp_file)
+        elif self.path == '/batch':
+            data = self.read_json()
+            if data is None:
+                return
             
-            if stderr:
-                return f"Error:\n{stderr}"
-            return stdout if stdout else "Code executed successfully (no output)"
+            operations = data.get('operations')
+            if not isinstance(operations, list):
+                self.send_json({'error': 'Expected a list of operations'}, status=400)
+                return
+            if len(operations) > self.max_batch_items:
+                self.send_json({'error': f'At most {self.max_batch_items} operations per batch'},
+                               status=413)
+                return
+            # Every run in the batch is charged to the client's run rate, up
+            # front and all or nothing; each then takes a slot of its own.
+            # Large grading batches need a --trusted-run-client address.
+            scheduler = getattr(self.server, 'scheduler', None)
+            runs = sum(isinstance(op, dict) and op.get('op') == 'run' for op in operations)
+            if scheduler is not None and runs:
+                if scheduler.limits_rate(self.client_address[0]) and runs > scheduler.client_burst:
+                    self.send_json({'error': f'At most {scheduler.client_burst} runs per batch'},
+                                   status=413)
+                    return
+                try:
+                    scheduler.charge(self.client_address[0], runs)
+                except ExecutionRejected as e:
+                    self.send_json({'error': e.message}, status=e.status,
+                                   headers=[('Retry-After', str(e.retry_after))])
+                    return
+            self.send_json({'results': self.run_batch(operations)})
             
-        except subprocess.TimeoutExpired:
-            return "Code execution timed out"
+        elif self.path == '/admin/profile':
+            data = self.read_json()
+            if data is None or not self.admin_allowed():
+                return
+            try:
+                started = profiler.start(data.get('mode', 'cprofile'), data.get('requests'),
+                                         data.get('seconds'), data.get('interval', 0.005))
+            except (AttributeError, ValueError) as e:
+                self.send_json({'error': str(e)}, status=400)
+                return
+            if not started:
+                self.send_json({'error': 'A profile is already running'}, status=409)
+                return
+            self.send_json(profiler.describe(), status=202)
+            
+        elif self.path == '/admin/profile/stop':
+            if not self.discard_body() or not self.admin_allowed():
+                return
+            summary = profiler.stop()
+            if summary is None:
+                self.send_json({'error': 'No profile is running'}, status=409)
+                return
+            self.send_json(summary)
+            
+        elif self.path.startswith('/jobs/') and self.path.endswith('/cancel'):
+            if not self.discard_body():
+                return
+            job = self.server.jobs.cancel(self.path[len('/jobs/'):-len('/cancel')])
+            if job is None:
+                self.send_json({'error': 'Unknown or expired job'}, status=404)
+                return
+            self.send_json(job)
+            
+        else:
+            if self.discard_body():
+                self.send_empty(404)
+            
+    def handle_expect_100(self):
+        # Refuse an oversized body before the client starts sending it.
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = 0
+        if length > self.max_body_bytes:
+            self.send_error(413, f'Request body exceeds {self.max_body_bytes} bytes')
+            return False
+        return super().handle_expect_100()
+
+    def content_length(self):
+        # The declared body size, or None once 400/411/413 has been sent.
+        # Error responses close the connection, so an unread body is never
+        # taken for the next request.
+        value = self.headers.get('Content-Length')
+        if value is None:
+            self.send_error(411, 'Content-Length required')
+            return None
+        try:
+            length = int(value)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400, 'Invalid Content-Length')
+            return None
+        if length > self.max_body_bytes:
+            self.send_error(413, f'Request body exceeds {self.max_body_bytes} bytes')
+            return None
+        return length
+
+    def read_body(self, length):
+        # Decode as the body arrives so at most one chunk of raw bytes is
+        # alive next to the text.  A short body is left for the parser to
+        # reject.
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        pieces = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, self.body_chunk_bytes))
+            if not chunk:
+                self.close_connection = True
+                break
+            length -= len(chunk)
+            self.bytes_received += len(chunk)
+            pieces.append(decoder.decode(chunk))
+        pieces.append(decoder.decode(b'', final=True))
+        self.take_slot()
+        return ''.join(pieces)
+
+    def discard_body(self):
+        # Skip a body nobody will read so the next request on this
+        # connection starts at a request line.  Returns False if an error
+        # response was sent instead.
+        length = self.content_length() if 'Content-Length' in self.headers else 0
+        if length is None:
+            return False
+        while length > 0:
+            chunk = self.rfile.read(min(length, self.body_chunk_bytes))
+            if not chunk:
+                self.close_connection = True
+                break
+            length -= len(chunk)
+            self.bytes_received += len(chunk)
+        self.take_slot()
+        return True
+
+    def read_json(self):
+        length = self.content_length()
+        if length is None:
+            return None
+        try:
+            body = self.read_body(length)
+            if profiler.active:
+                profiler.lap('read_body')
+            data = json.loads(body)
+            if profiler.active:
+                profiler.lap('decode')
+        except ValueError:
+            self.send_error(400, 'Request body must be JSON')
+            return None
+        # Every route takes an object, and the fields they share are text.
+        if not isinstance(data, dict):
+            self.send_error(400, 'Request body must be a JSON object')
+            return None
+        for field in self.TEXT_FIELDS:
+            if field in data and not isinstance(data[field], str):
+                self.send_error(400, f'"{field}" must be a string')
+                return None
+        return data
+
+    def session_id(self):
+        cookies = http.cookies.SimpleCookie()
+        try:
+            cookies.load(self.headers.get('Cookie', ''))
+        except http.cookies.CookieError:
+            return None
+        morsel = cookies.get('sid')
+        return morsel.value if morsel is not None and morsel.value else None
+
+    def send_json(self, data, status=200, headers=()):
+        if profiler.active:
+            profiler.lap('handler')
+        chunks = json_chunks(data)
+        size = sum(map(len, chunks))
+        compress = 0 < self.compress_min_bytes <= size
+        encoding = 'identity'
+        if compress and choose_encoding(self.headers.get('Accept-Encoding', ''), ('gzip',)) == 'gzip':
+            encoding = 'gzip'
+            # wbits 31: a gzip header and trailer around the deflate stream.
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 31)
+            body = [compressor.compress(piece) for piece in self.ascii_pieces(chunks)]
+            body.append(compressor.flush())
+            size = sum(map(len, body))
+        else:
+            body = self.ascii_pieces(chunks)
+        if profiler.active:
+            profiler.lap('encode')
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(size))
+        if compress:
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        for piece in body:
+            if piece:
+                self.wfile.write(piece)
+        self.bytes_sent += size
+        if profiler.active:
+            profiler.lap('write')
+
+    def ascii_pieces(self, chunks):
+        # JSON text is ASCII, so its length is its size in bytes; each chunk
+        # is encoded body_chunk_bytes at a time rather than whole.
+        step = self.body_chunk_bytes
+        for chunk in chunks:
+            for start in range(0, len(chunk), step):
+                yield chunk[start:start + step].encode('ascii')
+
+    def admin_allowed(self):
+        # The admin endpoints exist only with --profile-dir, and only for
+        # clients on this machine.
+        if profiler.directory is None:
+            self.send_empty(404)
+            return False
+        if self.client_address[0] not in ('127.0.0.1', '::1'):
+            self.send_json({'error': 'Admin endpoints are only served to localhost'}, status=403)
+            return False
+        return True
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def acquire_run_slot(self):
+        # Executions are capped separately from the connection limit so a
+        # burst of slow /run calls cannot take every worker away from
+        # /chat and the static assets.
+        self.run_ticket = None
+        scheduler = getattr(self.server, 'scheduler', None)
+        if scheduler is None:
+            return True
+        try:
+            self.run_ticket = scheduler.acquire(self.client_address[0])
+        except ExecutionRejected as e:
+            self.send_json({'output': e.message}, status=e.status,
+                           headers=[('Retry-After', str(e.retry_after))])
+            return False
+        return True
+
+    def release_run_slot(self):
+        if self.run_ticket is not None:
+            self.server.scheduler.release(self.run_ticket)
+
+    def run_code(self, code, cache_key=None):
+        # Returns the text to show and the resource usage, if the runner
+        # measured any.
+        if not code.strip():
+            return "No code to run", None
+            
+        try:
+            result = self.server.runner.run(code, timeout=10)
+            stdout, stderr = result
+            if cache_key is not None:
+                run_cache.put(cache_key, stdout, stderr)
+            return self.format_output(stdout, stderr), getattr(result, 'usage', None)
+            
+        except subprocess.TimeoutExpired as e:
+            return "Code execution timed out", getattr(e, 'usage', None)
+        except ResourceLimitExceeded as e:
+            return str(e), e.usage
+        except Exception as e:
+            return f"Error: {str(e)}", None
+
+    def run_batch(self, operations):
+        # Runs go to the server's batch pool, one scheduler slot each, while
+        # chat answers are worked out here; results keep the request order.
+        results = [None] * len(operations)
+        pending = []
+        for i, op in enumerate(operations):
+            if not isinstance(op, dict):
+                results[i] = {'status': 'error', 'error': 'Operation must be an object'}
+            elif op.get('op') == 'run':
+                timeout = op.get('timeout', 10)
+                if (not isinstance(timeout, (int, float)) or isinstance(timeout, bool)
+                        or not 0 < timeout <= 10):
+                    results[i] = {'status': 'error', 'error': 'timeout must be between 0 and 10 seconds'}
+                    self.refund_run()
+                    continue
+                pending.append((i, self.server.batch_workers.submit(
+                    self.run_batch_item, str(op.get('code', '')), timeout, op.get('cache', True))))
+            elif op.get('op') == 'chat':
+                response = assistant.generate_response(str(op.get('message', '')),
+                                                       str(op.get('code', '')))
+                results[i] = {'status': 'ok', 'response': response}
+            else:
+                results[i] = {'status': 'error', 'error': f"Unknown operation {op.get('op')!r}"}
+        for i, future in pending:
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                results[i] = {'status': 'error', 'error': f'Error: {str(e)}'}
+        return results
+
+    def refund_run(self):
+        # For a batch run charged up front that did not need the runner.
+        scheduler = getattr(self.server, 'scheduler', None)
+        if scheduler is not None:
+            scheduler.refund(self.client_address[0])
+
+    def run_batch_item(self, code, timeout, use_cache):
+        if not code.strip():
+            self.refund_run()
+            return {'status': 'empty', 'output': 'No code to run'}
+        cache_key = run_cache.key(self.server.runner, code) if use_cache else None
+        cached = run_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            self.refund_run()
+            return {'status': 'ok', 'output': self.format_output(*cached), 'cached': True}
+        
+        scheduler = getattr(self.server, 'scheduler', None)
+        ticket = None
+        if scheduler is not None:
+            try:
+                ticket = scheduler.acquire(self.client_address[0], charge=False)
+            except ExecutionRejected as e:
+                self.refund_run()
+                return {'status': 'rejected', 'error': e.message, 'retry_after': e.retry_after}
+        
+        usage = None
+        try:
+            result = self.server.runner.run(code, timeout=timeout)
+            stdout, stderr = result
+            if cache_key is not None:
+                run_cache.put(cache_key, stdout, stderr)
+            item = {'status': 'ok', 'output': self.format_output(stdout, stderr)}
+            usage = getattr(result, 'usage', None)
+        except subprocess.TimeoutExpired as e:
+            item = {'status': 'timeout', 'error': 'Code execution timed out'}
+            usage = getattr(e, 'usage', None)
+        except ResourceLimitExceeded as e:
+            item = {'status': 'limit', 'error': str(e)}
+            usage = e.usage
+        except Exception as e:
+            item = {'status': 'error', 'error': f'Error: {str(e)}'}
+        finally:
+            if ticket is not None:
+                scheduler.release(ticket)
+        if usage is not None:
+            item['usage'] = usage
+        return item
+
+    @staticmethod
+    def format_output(stdout, stderr):
+        if stderr:
+            return f"Error:\n{stderr}"
+        return stdout if stdout else "Code executed successfully (no output)"
+
+    def send_cached_run(self, stdout, stderr):
+        if self.path == '/run':
+            self.send_json({'output': self.format_output(stdout, stderr), 'cached': True})
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.begin_stream()
+        for stream, text in (('stdout', stdout), ('stderr', stderr)):
+            if text:
+                self.send_event(stream, text)
+        self.send_event('done', {'status': 'ok', 'cached': True})
+        self.end_stream()
+
+    def stream_code(self, code, cache_key=None):
+        # Server-Sent Events: one `stdout`/`stderr` event per chunk of
+        # output, then a final `done` event carrying the outcome.
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.begin_stream()
+        
+        if not code.strip():
+            self.send_event('done', {'status': 'empty', 'message': 'No code to run'})
+            self.end_stream()
+            return
+        
+        limit = self.stream_max_bytes
+        throttle = TokenBucket(self.stream_max_rate, self.stream_max_rate)
+        sent = 0
+        captured = {'stdout': [], 'stderr': []}
+        
+        def forward(stream, text):
+            nonlocal sent
+            data = text.encode('utf-8')
+            if sent + len(data) > limit:
+                data = data[:limit - sent]
+                self.send_event(stream, data.decode('utf-8', 'ignore'))
+                raise OutputLimitExceeded(limit)
+            sent += len(data)
+            # Sleeping here backs up the child's pipe, which slows the
+            # program down instead of buffering its output.
+            delay = throttle.reserve(len(data))
+            if delay:
+                time.sleep(delay)
+            self.send_event(stream, text)
+            if cache_key is not None:
+                captured[stream].append(text)
+        
+        try:
+            result = self.server.runner.run(code, timeout=10, on_output=forward)
+            if cache_key is not None:
+                run_cache.put(cache_key, ''.join(captured['stdout']), ''.join(captured['stderr']))
+            self.send_done({'status': 'ok'}, getattr(result, 'usage', None))
+        except OutputLimitExceeded as e:
+            self.send_done({'status': 'truncated', 'message': str(e)}, e.usage)
+        except ResourceLimitExceeded as e:
+            self.send_done({'status': 'limit', 'message': str(e)}, e.usage)
+        except subprocess.TimeoutExpired as e:
+            self.send_done({'status': 'timeout', 'message': 'Code execution timed out'},
+                           getattr(e, 'usage', None))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; the runner has already killed the program.
+            self.close_connection = True
+            return
         except Exception as e:
-            return f"Error: {str(e)}"
+            self.send_event('done', {'status': 'error', 'message': f'Error: {str(e)}'})
+        self.end_stream()
+
+    def begin_stream(self):
+        # HTTP/1.1 clients get chunked framing and keep their connection;
+        # HTTP/1.0 clients read until the connection is closed.
+        self.chunked = self.request_version != 'HTTP/1.0'
+        if self.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def write_stream(self, data):
+        self.bytes_sent += len(data)
+        if self.chunked:
+            data = b'%x\r\n%s\r\n' % (len(data), data)
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def end_stream(self):
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def send_done(self, data, usage):
+        if usage is not None:
+            data['usage'] = usage
+        self.send_event('done', data)
+
+    def send_event(self, event, data):
+        self.write_stream(f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode())
             
-    def get_html(self):
+    @staticmethod
+    def get_html():
         return '''<!DOCTYPE html>
 <html>
 <head>
@@ -318,11 +3636,12 @@ class RequestHandler(BaseHTTPRequestHandler):
             <div id="snippets" class="tab-content">
                 <div class="snippet-controls">
                     <select id="language-select" onchange="updateSnippets()">
-                        <option value="Python">Python</option>
-                        <option value="JavaScript">JavaScript</option>
+                        <option value="">All languages</option>
                     </select>
+                    <input id="snippet-search" type="search" placeholder="Search snippets..." oninput="searchSnippets()">
                 </div>
                 <div id="snippets-list"></div>
+                <button id="snippets-more" onclick="loadMoreSnippets()" style="display: none">More</button>
             </div>
             
             <div id="output" class="tab-content">
@@ -335,7 +3654,8 @@ class RequestHandler(BaseHTTPRequestHandler):
 </body>
 </html>'''
 
-    def get_css(self):
+    @staticmethod
+    def get_css():
         return '''
 body {
     font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
@@ -482,6 +3802,14 @@ button:hover {
     white-space: pre-wrap;
 }
 
+#output-display .stderr {
+    color: #f48771;
+}
+
+#output-display .status {
+    color: #808080;
+}
+
 .message {
     margin-bottom: 15px;
     padding: 10px;
@@ -505,7 +3833,7 @@ button:hover {
     margin-bottom: 15px;
 }
 
-#language-select {
+#language-select, #snippet-search {
     padding: 8px;
     background: #2d2d2d;
     color: #d4d4d4;
@@ -540,6 +3868,7 @@ button:hover {
     padding: 8px;
     border-radius: 3px;
     overflow-x: auto;
+    white-space: pre;
 }
 
 pre {
@@ -558,30 +3887,67 @@ code {
 }
 '''
 
-    def get_js(self):
+    @staticmethod
+    def get_js():
         return '''
-const snippets = {
-    "Python": {
-        "Function": "def function_name(param1, param2):\\n    \\\"\\\"\\\"Description\\\"\\\"\\\"\\n    return result",
-        "Class": "class ClassName:\\n    def __init__(self, param):\\n        self.param = param\\n    \\n    def method(self):\\n        pass",
-        "Try-Except": "try:\\n    # Code here\\n    pass\\nexcept Exception as e:\\n    print(f'Error: {e}')",
-        "File Reading": "with open('filename.txt', 'r') as file:\\n    content = file.read()",
-        "API Request": "import requests\\nresponse = requests.get('https://api.example.com/data')\\ndata = response.json()"
-    },
-    "JavaScript": {
-        "Function": "function functionName(param1, param2) {\\n    return result;\\n}",
-        "Arrow Function": "const functionName = (param1, param2) => {\\n    return result;\\n};",
-        "Class": "class ClassName {\\n    constructor(param) {\\n        this.param = param;\\n    }\\n    \\n    method() {\\n        return this.param;\\n    }\\n}",
-        "Async Function": "async function fetchData() {\\n    try {\\n        const response = await fetch('url');\\n        const data = await response.json();\\n        return data;\\n    } catch (error) {\\n        console.error('Error:', error);\\n    }\\n}"
-    }
-};
-
 function showTab(tabName) {
     document.querySelectorAll('.tab').forEach(tab => tab.classList.remove('active'));
     document.querySelectorAll('.tab-content').forEach(content => content.classList.remove('active'));
     
     document.querySelector(`[onclick="showTab('${tabName}')"]`).classList.add('active');
     document.getElementById(tabName).classList.add('active');
+    
+    // The snippet library is fetched the first time it is opened.
+    if (tabName === 'snippets' && !snippetsLoaded) {
+        updateSnippets();
+    }
+}
+
+// Editor lines and version of the server's copy of the document; /chat
+// sends only the lines that changed since.
+let syncedLines = null;
+let syncedVersion = null;
+
+function chatRequest(message, lines) {
+    if (syncedLines === null) {
+        return {message: message, code: lines.join('\\n'), sync: true};
+    }
+    let start = 0;
+    const common = Math.min(lines.length, syncedLines.length);
+    while (start < common && lines[start] === syncedLines[start]) start++;
+    let oldEnd = syncedLines.length;
+    let newEnd = lines.length;
+    while (oldEnd > start && newEnd > start && lines[newEnd - 1] === syncedLines[oldEnd - 1]) {
+        oldEnd--;
+        newEnd--;
+    }
+    return {
+        message: message,
+        delta: {base: syncedVersion, start: start, end: oldEnd, lines: lines.slice(start, newEnd)}
+    };
+}
+
+function postChat(message, lines) {
+    return fetch('/chat', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(chatRequest(message, lines))
+    })
+    .then(async response => {
+        const data = await response.json();
+        if (response.status === 409 && syncedLines !== null) {
+            // The server lost or moved past our copy; send the full text.
+            syncedLines = null;
+            return postChat(message, lines);
+        }
+        if (data.version !== undefined) {
+            syncedLines = lines;
+            syncedVersion = data.version;
+        }
+        return data;
+    });
 }
 
 function sendMessage() {
@@ -593,19 +3959,9 @@ function sendMessage() {
     addMessage('user', message);
     userInput.value = '';
     
-    const code = document.getElementById('code-editor').value;
+    const lines = document.getElementById('code-editor').value.split('\\n');
     
-    fetch('/chat', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            message: message,
-            code: code
-        })
-    })
-    .then(response => response.json())
+    postChat(message, lines)
     .then(data => {
         addMessage('assistant', data.response);
     })
@@ -633,17 +3989,54 @@ function addMessage(sender, message) {
 
 function runCode() {
     const code = document.getElementById('code-editor').value;
+    const display = document.getElementById('output-display');
     
     if (!code.trim()) {
-        document.getElementById('output-display').textContent = 'No code to run';
+        display.textContent = 'No code to run';
         showTab('output');
         return;
     }
     
-    document.getElementById('output-display').textContent = 'Running code...';
+    display.textContent = 'Running code...';
     showTab('output');
     
-    fetch('/run', {
+    let received = false;
+    let hasError = false;
+    
+    function append(text, className) {
+        if (!received) {
+            display.textContent = '';
+            received = true;
+        }
+        const span = document.createElement('span');
+        if (className) span.className = className;
+        span.textContent = text;
+        display.appendChild(span);
+        display.scrollTop = display.scrollHeight;
+    }
+    
+    function handleEvent(name, data) {
+        if (name === 'stdout') {
+            append(data);
+        } else if (name === 'stderr') {
+            hasError = true;
+            append(data, 'stderr');
+        } else if (name === 'done') {
+            if (data.status === 'ok') {
+                if (!received) append('Code executed successfully (no output)', 'status');
+            } else if (data.status === 'empty') {
+                display.textContent = data.message;
+            } else {
+                append((received ? '\\n' : '') + data.message, hasError ? 'stderr' : 'status');
+            }
+            if (data.usage) {
+                const megabytes = (data.usage.max_rss_bytes / 1048576).toFixed(1);
+                append(`\\n[${data.usage.cpu_seconds}s CPU, ${megabytes} MB peak memory]`, 'status');
+            }
+        }
+    }
+    
+    fetch('/run/stream', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
@@ -652,12 +4045,36 @@ function runCode() {
             code: code
         })
     })
-    .then(response => response.json())
-    .then(data => {
-        document.getElementById('output-display').textContent = data.output;
+    .then(async response => {
+        if (!response.ok || !response.body) {
+            const data = await response.json();
+            display.textContent = data.output;
+            return;
+        }
+        // Parse the Server-Sent Events stream as it arrives.
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const {done, value} = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, {stream: true});
+            let boundary;
+            while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                const block = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let name = 'message';
+                let data = '';
+                for (const line of block.split('\\n')) {
+                    if (line.startsWith('event: ')) name = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                }
+                handleEvent(name, JSON.parse(data));
+            }
+        }
     })
     .catch(error => {
-        document.getElementById('output-display').textContent = 'Error running code';
+        append('Error running code', 'stderr');
     });
 }
 
@@ -665,26 +4082,73 @@ function clearEditor() {
     document.getElementById('code-editor').value = '';
 }
 
+// Snippets come from /snippets one page at a time.  `snippetsRequest`
+// numbers the requests so a slow answer to an old search is ignored.
+let snippetsLoaded = false;
+let snippetsPage = 0;
+let snippetsRequest = 0;
+let snippetsSearchTimer = null;
+
 function updateSnippets() {
-    const language = document.getElementById('language-select').value;
-    const snippetsList = document.getElementById('snippets-list');
-    
-    snippetsList.innerHTML = '';
-    
-    const languageSnippets = snippets[language];
+    snippetsLoaded = true;
+    document.getElementById('snippets-list').innerHTML = '';
+    fetchSnippets(1);
+}
+
+function searchSnippets() {
+    clearTimeout(snippetsSearchTimer);
+    snippetsSearchTimer = setTimeout(updateSnippets, 200);
+}
+
+function loadMoreSnippets() {
+    fetchSnippets(snippetsPage + 1);
+}
+
+function fetchSnippets(page) {
+    const select = document.getElementById('language-select');
+    const params = new URLSearchParams({
+        lang: select.value,
+        q: document.getElementById('snippet-search').value,
+        page: page
+    });
+    const request = ++snippetsRequest;
     
-    for (const [title, code] of Object.entries(languageSnippets)) {
-        const snippetDiv = document.createElement('div');
-        snippetDiv.className = 'snippet-item';
-        snippetDiv.onclick = () => insertSnippet(code);
-        
-        snippetDiv.innerHTML = `
-            <div class="snippet-title">${title}</div>
-            <div class="snippet-code">${code}</div>
-        `;
+    fetch('/snippets?' + params)
+    .then(response => response.json())
+    .then(data => {
+        if (request !== snippetsRequest) {
+            return;
+        }
+        if (select.options.length === 1) {
+            for (const language of data.languages) {
+                select.add(new Option(language, language));
+            }
+        }
+        snippetsPage = data.page;
         
-        snippetsList.appendChild(snippetDiv);
-    }
+        const snippetsList = document.getElementById('snippets-list');
+        for (const snippet of data.snippets) {
+            const snippetDiv = document.createElement('div');
+            snippetDiv.className = 'snippet-item';
+            snippetDiv.onclick = () => insertSnippet(snippet.code);
+            
+            const title = document.createElement('div');
+            title.className = 'snippet-title';
+            title.textContent = select.value ? snippet.title : `${snippet.title} (${snippet.language})`;
+            const code = document.createElement('div');
+            code.className = 'snippet-code';
+            code.textContent = snippet.code;
+            
+            snippetDiv.append(title, code);
+            snippetsList.appendChild(snippetDiv);
+        }
+        document.getElementById('snippets-more').style.display = data.page < data.pages ? '' : 'none';
+    })
+    .catch(error => {
+        if (request === snippetsRequest) {
+            snippetsLoaded = false;
+        }
+    });
 }
 
 function insertSnippet(code) {
@@ -699,8 +4163,6 @@ function insertSnippet(code) {
 
 // Initialize
 document.addEventListener('DOMContentLoaded', function() {
-    updateSnippets();
-    
     // Add welcome message
     addMessage('assistant', 'Welcome to AI Coding Assistant!\\n\\nI can help you with:\\n• Code explanations and debugging\\n• Writing functions and algorithms\\n• Best practices and optimization\\n• Code review and suggestions\\n\\nType your question and click Send!');
     
@@ -713,7 +4175,882 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 '''
 
+def parse_accept_encoding(header):
+    # Maps each listed content-coding to its q-value.
+    codings = {}
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+def json_chunks(data, large=64 * 1024):
+    # The JSON text of `data` as a list of str chunks.  json.dumps is the
+    # fastest, but its encoder joins everything into one string at the end,
+    # briefly doubling the size of a response carrying megabytes of program
+    # output.  The pure Python encoder yields such a string as a chunk of
+    # its own; it is only worth its slower pace for those.
+    if isinstance(data, dict) and any(isinstance(value, str) and len(value) >= large
+                                      for value in data.values()):
+        return list(json.JSONEncoder().iterencode(data))
+    return [json.dumps(data)]
+
+def choose_encoding(header, available):
+    # Picks the first of `available` (in preference order) the client accepts.
+    codings = parse_accept_encoding(header)
+    wildcard = codings.get('*', 0.0)
+    for coding in available:
+        if codings.get(coding, wildcard) > 0:
+            return coding
+    return 'identity'
+
+
+class StaticAsset:
+    # An asset encoded once at startup, plus precompressed variants that
+    # are kept only when they are actually smaller.
+    def __init__(self, content_type, text):
+        self.content_type = content_type
+        body = text.encode()
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        self.variants = {'identity': (body, f'"{digest}"')}
+        compressed = []
+        if brotli is not None:
+            compressed.append(('br', brotli.compress(body)))
+        compressed.append(('gzip', gzip.compress(body, 9, mtime=0)))
+        compressed.append(('deflate', zlib.compress(body, 9)))
+        for encoding, data in compressed:
+            if len(data) < len(body):
+                self.variants[encoding] = (data, f'"{digest}-{encoding}"')
+        self.encodings = [encoding for encoding in self.variants if encoding != 'identity']
+        self.etags = {etag for _, etag in self.variants.values()}
+
+    def negotiate(self, accept_encoding):
+        if not accept_encoding:
+            return 'identity'
+        return choose_encoding(accept_encoding, self.encodings)
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or tag.removeprefix('W/') in self.etags:
+                return True
+        return False
+
+
+def build_static_assets():
+    return {
+        '/': StaticAsset('text/html', RequestHandler.get_html()),
+        '/style.css': StaticAsset('text/css', RequestHandler.get_css()),
+        '/script.js': StaticAsset('application/javascript', RequestHandler.get_js()),
+    }
+
+static_assets = build_static_assets()
+
+
+class GracefulServerMixIn:
+    # Listening options and graceful shutdown for the socketserver-based
+    # servers.  `reuse_port` sets SO_REUSEPORT so a new process can bind
+    # the same port while this one drains; `listen_fd` adopts a listening
+    # socket inherited from the process being replaced instead of binding.
+    # drain() stops accepting, closes connections idle between requests,
+    # makes the rest close after their current response, and waits.  The
+    # listening socket is non-blocking: with --workers every process
+    # selects on it, and all but the one that wins the connection would
+    # otherwise block in accept() and never see shutdown().
+    draining = False
+
+    def __init__(self, server_address, handler_class, reuse_port=False, listen_fd=None):
+        super().__init__(server_address, handler_class, bind_and_activate=False)
+        self.handlers = set()
+        self._handlers_changed = threading.Condition()
+        try:
+            if listen_fd is not None:
+                self.socket.close()
+                self.socket = socket.socket(fileno=listen_fd)
+                self.server_address = self.socket.getsockname()[:2]
+                self.server_name = socket.getfqdn(self.server_address[0])
+                self.server_port = self.server_address[1]
+            else:
+                if reuse_port:
+                    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                self.server_bind()
+                self.server_activate()
+            self.socket.setblocking(False)
+        except BaseException:
+            self.server_close()
+            raise
+
+    def track(self, handler):
+        with self._handlers_changed:
+            self.handlers.add(handler)
+
+    def untrack(self, handler):
+        with self._handlers_changed:
+            self.handlers.discard(handler)
+            self._handlers_changed.notify_all()
+
+    def mark_idle(self, handler):
+        # False once draining: the connection is closed rather than waiting
+        # for another request.
+        with self._handlers_changed:
+            if self.draining:
+                return False
+            handler.idle = True
+            return True
+
+    def close_idle(self):
+        with self._handlers_changed:
+            self.draining = True
+            idle = [handler for handler in self.handlers if handler.idle]
+        for handler in idle:
+            self.wake_idle(handler)
+
+    def close_idle_connection(self):
+        # Closes one keep-alive connection waiting for its next request.
+        with self._handlers_changed:
+            idle = [handler for handler in self.handlers if handler.idle]
+        return any(self.wake_idle(handler) for handler in idle)
+
+    @staticmethod
+    def wake_idle(handler):
+        # Wakes the handler's blocking read with EOF.  A connection with
+        # bytes waiting already has its next request (or its EOF) on the
+        # way and is left to the handler, which answers with Connection:
+        # close if draining.  A request that arrives at the same moment
+        # still sees the connection close, as it would at the keep-alive
+        # timeout.
+        try:
+            if select.select([handler.connection], [], [], 0)[0]:
+                return False
+            handler.connection.shutdown(socket.SHUT_RD)
+            return True
+        except OSError:
+            return False
+
+    def drain(self, timeout):
+        # Single mode serves connections on the serve_forever thread, so
+        # idle ones are closed before shutdown() waits for it.  Returns
+        # False if requests were still running after `timeout` seconds.
+        self.close_idle()
+        self.shutdown()
+        self.close_idle()
+        return self.wait_drained(timeout)
+
+    def wait_drained(self, timeout):
+        with self._handlers_changed:
+            return self._handlers_changed.wait_for(lambda: not self.handlers, timeout)
+
+
+class GracefulHTTPServer(GracefulServerMixIn, HTTPServer):
+    pass
+
+
+class BoundedThreadingHTTPServer(GracefulServerMixIn, ThreadingHTTPServer):
+    # One thread per connection, at most max_connections of them, of which
+    # at most max_in_flight are handling a request at a time; the rest wait
+    # for a slot with their request read.  Keep-alive connections between
+    # requests hold a thread but no slot.  With every connection taken,
+    # an idle keep-alive connection is closed to make room; if none is
+    # idle the accept loop blocks and new clients wait in the backlog.
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_in_flight=64, max_connections=1024,
+                 **options):
+        super().__init__(server_address, handler_class, **options)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.connections = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        if not self.connections.acquire(blocking=False):
+            self.close_idle_connection()
+            self.connections.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.connections.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.connections.release()
+
+
+class AsyncHTTPServer:
+    # Connections are accepted and read on an asyncio event loop; complete
+    # requests are then handed to RequestHandler on a thread pool.  /run and
+    # /batch get their own pool, sized for every run the scheduler admits or
+    # queues, so executions never sit in front of /chat or static assets.
+    max_header_bytes = 64 * 1024
+    draining = False
+
+    def __init__(self, server_address, handler_class, max_in_flight=64, max_runs=48,
+                 reuse_port=False, listen_fd=None):
+        self.server_address = server_address
+        self.RequestHandlerClass = handler_class
+        self.workers = ThreadPoolExecutor(max_in_flight, thread_name_prefix='http')
+        self.run_workers = ThreadPoolExecutor(max_runs, thread_name_prefix='run')
+        self.reuse_port = reuse_port
+        self.listen_fd = listen_fd
+        self._loop = None
+        self._server = None
+        self._connections = {}
+        self._busy = set()
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self._serve())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.workers.shutdown(wait=False)
+            self.run_workers.shutdown(wait=False)
+            self._stopped.set()
+
+    def fileno(self):
+        self._started.wait()
+        return self._server.sockets[0].fileno()
+
+    def drain(self, timeout):
+        # Closing the server stops accepting; serve_forever then returns
+        # once the requests in progress have been answered.
+        self.draining = True
+        if not self._stopped.is_set():
+            self.shutdown()
+        return self.wait_drained(timeout)
+
+    def wait_drained(self, timeout):
+        return self._stopped.wait(timeout)
+
+    def shutdown(self):
+        self._started.wait()
+        self._loop.call_soon_threadsafe(self._server.close)
+
+    def server_close(self):
+        pass
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        if self.listen_fd is not None:
+            self._server = await asyncio.start_server(
+                self._handle_connection, sock=socket.socket(fileno=self.listen_fd),
+                limit=self.max_header_bytes, backlog=128)
+        else:
+            host, port = self.server_address
+            self._server = await asyncio.start_server(
+                self._handle_connection, host, port, reuse_port=self.reuse_port or None,
+                limit=self.max_header_bytes, backlog=128)
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+        self._started.set()
+        try:
+            await self._server.serve_forever()
+        finally:
+            # Closing the transports wakes idle keep-alive connections with
+            # EOF; requests already being handled are allowed to finish and
+            # their connections close after the response.
+            self.draining = True
+            for task, writer in self._connections.items():
+                if task not in self._busy:
+                    writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def _handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        idle_timeout = self.RequestHandlerClass.timeout
+        requests_handled = 0
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                # Idle keep-alive connections wait here on the event loop
+                # without holding a worker thread.
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    return
+                self._busy.add(task)
+                length = self._content_length(head)
+                # An oversized or invalid body is left unread; the handler
+                # answers 413 or 400 and closes the connection.
+                if not 0 <= length <= self.RequestHandlerClass.max_body_bytes:
+                    body = b''
+                else:
+                    body = await asyncio.wait_for(reader.readexactly(length), idle_timeout)
+                path = head.split(b' ', 2)[1] if head.count(b' ') >= 2 else b''
+                pool = self.run_workers if path.startswith((b'/run', b'/batch')) else self.workers
+                close_connection = await self._loop.run_in_executor(
+                    pool, self._dispatch, head, body, client_address,
+                    LoopWriter(self._loop, writer), requests_handled)
+                requests_handled += 1
+                self._busy.discard(task)
+                if close_connection or self.draining:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            self._busy.discard(task)
+            writer.close()
+
+    @staticmethod
+    def _content_length(head):
+        for line in head.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                value = value.strip()
+                return int(value) if value.isdigit() else -1
+        return 0
+
+    def _dispatch(self, head, body, client_address, wfile, requests_handled):
+        # Drive the regular handler against an in-memory request, skipping
+        # BaseRequestHandler.__init__ which would try to use a socket.
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.server = self
+        handler.request = None
+        handler.client_address = client_address
+        handler.rfile = RequestReader(head, body)
+        handler.wfile = wfile
+        handler.close_connection = True
+        handler.requests_handled = requests_handled
+        try:
+            handler.handle_one_request()
+            # Errors raised while parsing the request return without the
+            # flush handle_one_request does after a handler method.
+            wfile.flush()
+        except Exception:
+            self.handle_error(None, client_address)
+            return True
+        return handler.close_connection
+
+    handle_error = socketserver.BaseServer.handle_error
+
+
+class RequestReader:
+    # rfile for handlers running under AsyncHTTPServer: the request head,
+    # then the body, without copying them into one buffer.
+    def __init__(self, head, body):
+        self.head = io.BytesIO(head)
+        self.body = io.BytesIO(body)
+
+    def readline(self, limit=-1):
+        return self.head.readline(limit) or self.body.readline(limit)
+
+    def read(self, size=-1):
+        data = self.head.read(size)
+        if size < 0 or len(data) < size:
+            data += self.body.read(-1 if size < 0 else size - len(data))
+        return data
+
+
+class LoopWriter:
+    # wfile for handlers running under AsyncHTTPServer.  Writes collect in
+    # the handler thread and flush() hands them to the event loop, waiting
+    # for the transport to drain so streaming responses get backpressure.
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            # The transport gets the buffer itself, not a copy; this writer
+            # starts a new one.
+            data, self.buffer = self.buffer, bytearray()
+            asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result()
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+def make_server(mode, server_address, max_in_flight=64, max_runs=16, runner=None, scheduler=None,
+                jobs=None, reuse_port=False, listen_fd=None, max_connections=1024):
+    if scheduler is None:
+        scheduler = ExecutionScheduler(max_running=max_runs)
+    options = {'reuse_port': reuse_port, 'listen_fd': listen_fd}
+    if mode == 'single':
+        server = GracefulHTTPServer(server_address, RequestHandler, **options)
+    elif mode == 'async':
+        server = AsyncHTTPServer(server_address, RequestHandler, max_in_flight=max_in_flight,
+                                 max_runs=scheduler.max_running + scheduler.max_queued, **options)
+    else:
+        server = BoundedThreadingHTTPServer(server_address, RequestHandler,
+                                            max_in_flight=max_in_flight,
+                                            max_connections=max_connections, **options)
+    server.runner = runner if runner is not None else SubprocessRunner()
+    server.scheduler = scheduler
+    server.jobs = jobs if jobs is not None else JobManager(server.runner, scheduler)
+    # Batch items hold a scheduler slot each, so more threads than slots
+    # would only queue.
+    server.batch_workers = ThreadPoolExecutor(scheduler.max_running, thread_name_prefix='batch')
+    return server
+
+def drain_server(server, timeout, grace=5):
+    # Graceful stop: no new connections, and requests in progress get
+    # `timeout` seconds to finish.  After that the programs they are
+    # waiting on are killed, so they answer with an error and close.
+    if server.drain(timeout):
+        return True
+    killed = children.kill_all()
+    print(f'Requests still running after {timeout} s; killed {killed} child processes',
+          file=sys.stderr)
+    return server.wait_drained(grace)
+
+def server_argv(overrides):
+    # This process's command line with each option in `overrides` set to
+    # the given value, whether or not it was there before.
+    argv = [sys.executable, os.path.abspath(sys.argv[0])]
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg in overrides:
+            skip = True
+        elif arg.split('=', 1)[0] not in overrides:
+            argv.append(arg)
+    for option, value in overrides.items():
+        argv += [option, str(value)]
+    return argv
+
+def restart_server(server, timeout=30):
+    # Starts a new server process on this one's listening socket and
+    # returns once it is serving, or False if it did not come up.  The
+    # socket stays open throughout, so connections waiting in its backlog
+    # are accepted by the new process instead of being refused.
+    listen_fd = server.fileno()
+    ready_read, ready_write = os.pipe()
+    argv = server_argv({'--listen-fd': listen_fd, '--ready-fd': ready_write})
+    try:
+        process = subprocess.Popen(argv, pass_fds=(listen_fd, ready_write))
+    except OSError as e:
+        print(f'Restart failed: {e}', file=sys.stderr)
+        os.close(ready_read)
+        os.close(ready_write)
+        return False
+    os.close(ready_write)
+    try:
+        ready, _, _ = select.select([ready_read], [], [], timeout)
+        if ready and os.read(ready_read, 1):
+            print(f'Replacement server started (pid {process.pid}); draining', file=sys.stderr)
+            return True
+    finally:
+        os.close(ready_read)
+    print('Replacement server did not start; still serving', file=sys.stderr)
+    if process.poll() is None:
+        process.kill()
+    process.wait()
+    return False
+
+class Supervisor:
+    # --workers mode.  This process only holds the listening socket; the
+    # workers are complete servers started on it with --listen-fd, and the
+    # kernel hands each new connection to whichever of them accepts first,
+    # so /chat analysis runs on as many cores as there are workers.
+    #
+    # Each worker keeps its own caches, session documents, rate limits,
+    # metrics and profiler, and --max-runs and the other limits apply per
+    # worker.  Chat history and jobs are only seen by every worker when
+    # they share a --db.
+    #
+    # A worker that exits is started again, after a delay that doubles
+    # while it keeps dying young.  SIGTERM or SIGINT drains every worker;
+    # SIGHUP replaces them one at a time, each only once its replacement
+    # is serving.
+    max_restart_delay = 30
+
+    def __init__(self, sock, workers, drain_timeout=30, start_timeout=30):
+        self.sock = sock
+        self.drain_timeout = drain_timeout
+        self.start_timeout = start_timeout
+        self.processes = [None] * workers
+        self.started = [0.0] * workers
+        self.delays = [0] * workers
+        self.restart_at = [0.0] * workers
+        self.retiring = []
+        self.stop_requested = False
+        self.restart_requested = False
+        self.restarts = 0
+
+    def launch(self, slot):
+        listen_fd = self.sock.fileno()
+        ready_read, ready_write = os.pipe()
+        argv = server_argv({'--workers': 1, '--worker-id': slot, '--listen-fd': listen_fd,
+                            '--ready-fd': ready_write})
+        try:
+            process = subprocess.Popen(argv, pass_fds=(listen_fd, ready_write))
+        except OSError as e:
+            print(f'Worker {slot} did not start: {e}', file=sys.stderr)
+            os.close(ready_read)
+            return None
+        finally:
+            os.close(ready_write)
+        return process, ready_read
+
+    def wait_ready(self, launched):
+        # Takes {slot: launch(slot)} and returns {slot: process} for the
+        # workers serving within start_timeout; the others are killed.
+        pending = {launch[1]: (slot, launch[0]) for slot, launch in launched.items()
+                   if launch is not None}
+        ready = {}
+        deadline = time.monotonic() + self.start_timeout
+        try:
+            while pending and not self.stop_requested:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select(list(pending), [], [], min(remaining, 0.5))
+                for fd in readable:
+                    slot, process = pending.pop(fd)
+                    # EOF instead of a byte: the worker exited while starting.
+                    if os.read(fd, 1):
+                        ready[slot] = process
+                    else:
+                        process.wait()
+                    os.close(fd)
+        finally:
+            for fd, (slot, process) in pending.items():
+                os.close(fd)
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+        return ready
+
+    def start(self, slots):
+        now = time.monotonic()
+        ready = self.wait_ready({slot: self.launch(slot) for slot in slots})
+        for slot in slots:
+            if slot in ready:
+                self.processes[slot] = ready[slot]
+                self.started[slot] = now
+            else:
+                self.failed(slot, 'did not start')
+
+    def failed(self, slot, reason):
+        # Restarted at once after a long life, otherwise after a delay
+        # that doubles up to max_restart_delay.
+        process = self.processes[slot]
+        self.processes[slot] = None
+        now = time.monotonic()
+        if process is not None and now - self.started[slot] > self.max_restart_delay:
+            self.delays[slot] = 0
+        else:
+            self.delays[slot] = min(max(self.delays[slot] * 2, 1), self.max_restart_delay)
+        self.restart_at[slot] = now + self.delays[slot]
+        pid = f' (pid {process.pid})' if process is not None else ''
+        print(f'Worker {slot}{pid} {reason}; restarting in {self.delays[slot]} s', file=sys.stderr)
+
+    def replace_all(self):
+        # One worker at a time, so the others keep serving throughout.
+        for slot in range(len(self.processes)):
+            old = self.processes[slot]
+            if old is None:
+                continue
+            launched = self.launch(slot)
+            new = self.wait_ready({slot: launched}).get(slot) if launched is not None else None
+            if self.stop_requested:
+                if new is not None:
+                    self.retiring.append(new)
+                return
+            if new is None:
+                print(f'Replacement for worker {slot} did not start; stopping the restart',
+                      file=sys.stderr)
+                return
+            old.terminate()
+            self.retiring.append(old)
+            self.processes[slot] = new
+            self.started[slot] = time.monotonic()
+            self.restarts += 1
+        print('Replaced all workers', file=sys.stderr)
+
+    def stop(self):
+        processes = [process for process in self.processes if process is not None] + self.retiring
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        # Workers kill their own stragglers at drain_timeout; this is for
+        # workers that hang anyway.
+        deadline = time.monotonic() + self.drain_timeout + 10
+        for process in processes:
+            try:
+                process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                print(f'Worker (pid {process.pid}) did not stop; killing it', file=sys.stderr)
+                process.kill()
+                process.wait()
+
+    def serve(self):
+        def on_stop(signum, frame):
+            self.stop_requested = True
+
+        def on_restart(signum, frame):
+            self.restart_requested = True
+
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, on_restart)
+        self.start(range(len(self.processes)))
+        while not self.stop_requested:
+            if self.restart_requested:
+                self.restart_requested = False
+                self.replace_all()
+            self.retiring = [process for process in self.retiring if process.poll() is None]
+            for slot, process in enumerate(self.processes):
+                if process is not None and process.poll() is not None:
+                    self.failed(slot, f'exited with status {process.returncode}')
+            due = [slot for slot, process in enumerate(self.processes)
+                   if process is None and self.restart_at[slot] <= time.monotonic()]
+            if due:
+                self.start(due)
+            else:
+                time.sleep(0.2)
+        self.stop()
+
+def listening_socket(args):
+    if args.listen_fd is not None:
+        sock = socket.socket(fileno=args.listen_fd)
+    else:
+        sock = socket.create_server((args.host, args.port), backlog=128,
+                                    reuse_port=args.reuse_port)
+    sock.setblocking(False)
+    return sock
+
+def make_runner(args):
+    if args.executor == 'pool':
+        return InterpreterPool(size=args.pool_size, max_runs_per_worker=args.pool_recycle)
+    if args.executor == 'sandbox':
+        return SandboxRunner(cpu_seconds=args.sandbox_cpu, memory_bytes=args.sandbox_memory,
+                             max_open_files=args.sandbox_files, max_processes=args.sandbox_procs,
+                             max_output_bytes=args.sandbox_output)
+    return SubprocessRunner()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='AI Coding Assistant web server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--mode', choices=['threaded', 'async', 'single'], default='threaded',
+                        help='threaded: bounded thread per connection; async: asyncio front end with '
+                             'worker pools; single: one request at a time')
+    parser.add_argument('--max-in-flight', type=int, default=64,
+                        help='maximum number of requests handled concurrently')
+    parser.add_argument('--max-connections', type=int, default=1024,
+                        help='open connections served in threaded mode; when all are taken an '
+                             'idle keep-alive connection is closed to make room')
+    parser.add_argument('--max-runs', type=int, default=16,
+                        help='maximum number of concurrent /run executions')
+    parser.add_argument('--run-queue', type=int, default=32,
+                        help='executions allowed to wait for a slot once --max-runs are running')
+    parser.add_argument('--run-queue-timeout', type=float, default=5.0,
+                        help='seconds an execution may wait in the queue before getting 503')
+    parser.add_argument('--client-run-rate', type=float, default=1.0,
+                        help='executions per second allowed per client address (0 disables the limit)')
+    parser.add_argument('--client-run-burst', type=int, default=5,
+                        help='executions a client may start back to back before --client-run-rate applies; '
+                             'also the most runs one /batch may hold')
+    parser.add_argument('--trusted-run-client', action='append', default=[], metavar='ADDRESS',
+                        help='client address exempt from --client-run-rate and --client-run-burst, '
+                             'such as a CI host posting large /batch runs; may be repeated')
+    parser.add_argument('--job-workers', type=int, default=4,
+                        help='background threads running /jobs submissions')
+    parser.add_argument('--job-timeout', type=float, default=60,
+                        help='seconds a /jobs submission may run (/run allows 10)')
+    parser.add_argument('--max-jobs', type=int, default=256,
+                        help='jobs kept in the job table, queued, running or finished')
+    parser.add_argument('--job-ttl', type=float, default=300,
+                        help='seconds the result of a finished job is kept')
+    parser.add_argument('--max-batch-items', type=int, default=RequestHandler.max_batch_items,
+                        help='operations accepted in one /batch request')
+    parser.add_argument('--executor', choices=['pool', 'spawn', 'sandbox'], default='pool',
+                        help='pool: reuse pre-started interpreters; spawn: new interpreter per run; '
+                             'sandbox: new interpreter per run under resource limits')
+    parser.add_argument('--pool-size', type=int, default=4,
+                        help='number of idle interpreters kept warm by the pool executor')
+    parser.add_argument('--pool-recycle', type=int, default=50,
+                        help='replace a pool interpreter after this many runs')
+    parser.add_argument('--sandbox-cpu', type=int, default=5,
+                        help='CPU seconds a sandboxed program may use')
+    parser.add_argument('--sandbox-memory', type=int, default=512 * 1024 * 1024,
+                        help='address space limit for a sandboxed program, in bytes')
+    parser.add_argument('--sandbox-files', type=int, default=64,
+                        help='open file limit for a sandboxed program')
+    parser.add_argument('--sandbox-procs', type=int, default=64,
+                        help='process limit for the sandbox (counted per user by the kernel)')
+    parser.add_argument('--sandbox-output', type=int, default=1024 * 1024,
+                        help='output a sandboxed program may produce before it is killed, in bytes')
+    parser.add_argument('--stream-max-bytes', type=int, default=RequestHandler.stream_max_bytes,
+                        help='output cap for /run/stream, in bytes')
+    parser.add_argument('--stream-max-rate', type=int, default=RequestHandler.stream_max_rate,
+                        help='output rate cap for /run/stream, in bytes per second')
+    parser.add_argument('--max-body-bytes', type=int, default=RequestHandler.max_body_bytes,
+                        help='largest request body accepted; bigger ones get 413')
+    parser.add_argument('--compress-min-bytes', type=int, default=RequestHandler.compress_min_bytes,
+                        help='gzip JSON responses of at least this many bytes for clients that '
+                             'accept it (0 disables)')
+    parser.add_argument('--keepalive-timeout', type=float, default=RequestHandler.timeout,
+                        help='seconds an idle persistent connection is kept open')
+    parser.add_argument('--keepalive-requests', type=int, default=RequestHandler.max_keepalive_requests,
+                        help='requests served on one connection before it is closed')
+    parser.add_argument('--response-cache-size', type=int, default=1024,
+                        help='number of /chat answers kept in the response cache (0 disables it)')
+    parser.add_argument('--response-cache-ttl', type=float, default=300,
+                        help='seconds a cached /chat answer stays valid')
+    parser.add_argument('--run-cache-size', type=int, default=256,
+                        help='number of /run results kept for identical submissions (0 disables it)')
+    parser.add_argument('--run-cache-bytes', type=int, default=16 * 1024 * 1024,
+                        help='total output size the /run result cache may hold')
+    parser.add_argument('--run-cache-ttl', type=float, default=600,
+                        help='seconds a cached /run result stays valid')
+    parser.add_argument('--history-messages', type=int, default=20,
+                        help='recent /chat messages kept per session (0 disables history)')
+    parser.add_argument('--history-bytes', type=int, default=32 * 1024 * 1024,
+                        help='memory all session histories together may use')
+    parser.add_argument('--session-idle-ttl', type=float, default=1800,
+                        help='seconds after which an idle session history is dropped')
+    parser.add_argument('--db', metavar='PATH',
+                        help='SQLite database for chat history and /run results (default: memory only)')
+    parser.add_argument('--db-retention', type=float, default=7 * 24 * 3600,
+                        help='seconds stored messages and results are kept in the database')
+    parser.add_argument('--snippets-file', metavar='PATH',
+                        help='JSON list of {"language", "title", "code", "tags"} snippets to add to the library')
+    parser.add_argument('--no-metrics', action='store_true',
+                        help='stop recording the counters and histograms served on /metrics')
+    parser.add_argument('--profile-dir', metavar='DIR',
+                        help='enable /admin/profile and SIGUSR1 profiling, writing results to DIR')
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='seconds requests in progress get to finish on SIGTERM before the '
+                             'programs they are running are killed')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='set SO_REUSEPORT so a new server can bind the port while this one drains')
+    parser.add_argument('--listen-fd', type=int, metavar='FD',
+                        help='serve on an inherited listening socket instead of binding '
+                             '(set by SIGHUP restarts)')
+    parser.add_argument('--ready-fd', type=int, metavar='FD',
+                        help='write a byte to this pipe once serving (set by SIGHUP restarts)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server processes sharing the listening socket, restarted if they die '
+                             '(0: one per CPU).  Caches, documents, rate limits and metrics are per '
+                             'worker; use --db to share chat history and jobs')
+    parser.add_argument('--worker-id', type=int, metavar='N',
+                        help='this process is worker N under --workers (set by the supervisor)')
+    parser.add_argument('--max-documents', type=int, default=256,
+                        help='number of session documents kept for incremental /chat analysis')
+    parser.add_argument('--documents-bytes', type=int, default=64 * 1024 * 1024,
+                        help='memory all session documents together may use (estimated)')
+    parser.add_argument('--max-document-chars', type=int, default=4 * 1024 * 1024,
+                        help='larger /chat documents are analyzed whole on every message instead '
+                             'of being kept')
+    parser.add_argument('--max-document-lines', type=int, default=100000,
+                        help='/chat documents with more lines are analyzed whole on every message '
+                             'instead of being kept')
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
-    server = HTTPServer(('localhost', 8000), RequestHandler)
-    print("AI Coding Assistant running at http://localhost:8000")
-    server.serve_forever()
\ No newline at end of file
+    args = parse_args()
+    if args.workers != 1:
+        workers = args.workers or os.cpu_count() or 1
+        listener = listening_socket(args)
+        if not args.db:
+            print('Warning: without --db each worker has its own chat history and jobs',
+                  file=sys.stderr)
+        print(f"AI Coding Assistant running at http://{args.host}:{args.port} "
+              f"with {workers} workers (pid {os.getpid()})")
+        Supervisor(listener, workers, args.drain_timeout).serve()
+        listener.close()
+        sys.exit(0)
+    worker_id = args.worker_id
+    RequestHandler.stream_max_bytes = args.stream_max_bytes
+    RequestHandler.stream_max_rate = args.stream_max_rate
+    RequestHandler.max_body_bytes = args.max_body_bytes
+    RequestHandler.compress_min_bytes = args.compress_min_bytes
+    RequestHandler.timeout = args.keepalive_timeout
+    RequestHandler.max_keepalive_requests = args.keepalive_requests
+    RequestHandler.max_batch_items = args.max_batch_items
+    assistant = CodeAssistant(cache_size=args.response_cache_size,
+                              cache_ttl=args.response_cache_ttl)
+    documents = DocumentStore(args.max_documents, max_bytes=args.documents_bytes,
+                              max_chars=args.max_document_chars, max_lines=args.max_document_lines)
+    metrics.enabled = not args.no_metrics
+    profiler.directory = args.profile_dir
+    if args.profile_dir and hasattr(signal, 'SIGUSR1'):
+        # Stopping writes files; keep that off whatever the main thread was
+        # doing when the signal arrived.
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+            target=profiler.toggle, daemon=True).start())
+    if args.snippets_file:
+        snippets.load(args.snippets_file)
+    db = SQLiteStore(args.db, retention=args.db_retention) if args.db else None
+    sessions = SessionStore(args.history_messages, args.session_idle_ttl, args.history_bytes, db=db,
+                            shared=worker_id is not None)
+    run_cache = RunCache(args.run_cache_size, args.run_cache_ttl, args.run_cache_bytes, db=db)
+    runner = make_runner(args)
+    scheduler = ExecutionScheduler(max_running=args.max_runs, max_queued=args.run_queue,
+                                   max_wait=args.run_queue_timeout,
+                                   client_rate=args.client_run_rate,
+                                   client_burst=args.client_run_burst,
+                                   trusted_clients=args.trusted_run_client)
+    jobs = JobManager(runner, scheduler, workers=args.job_workers, max_jobs=args.max_jobs,
+                      ttl=args.job_ttl, timeout=args.job_timeout, db=db)
+    server = make_server(args.mode, (args.host, args.port),
+                         max_in_flight=args.max_in_flight, max_connections=args.max_connections,
+                         runner=runner, scheduler=scheduler,
+                         jobs=jobs, reuse_port=args.reuse_port, listen_fd=args.listen_fd)
+    
+    # SIGTERM drains and exits; SIGHUP starts a replacement on the same
+    # socket first.  Both run on a thread of their own since shutdown()
+    # waits for the serve_forever loop the main thread is in.
+    stopping = []
+    
+    def stop(restart):
+        if restart and not restart_server(server, args.drain_timeout):
+            stopping.clear()
+            return
+        drain_server(server, args.drain_timeout)
+    
+    def on_signal(signum, frame):
+        if not stopping:
+            stopping.append(threading.Thread(target=stop, args=(signum == signal.SIGHUP,)))
+            stopping[0].start()
+    
+    signal.signal(signal.SIGTERM, on_signal)
+    if worker_id is not None:
+        # The supervisor replaces workers itself; a hangup of the terminal
+        # it was started from must not stop them.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    elif hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, on_signal)
+    if args.ready_fd is not None:
+        os.write(args.ready_fd, b'1')
+        os.close(args.ready_fd)
+    if worker_id is None:
+        print(f"AI Coding Assistant running at http://{args.host}:{args.port} (pid {os.getpid()})")
+    try:
+        server.serve_forever()
+    finally:
+        if stopping:
+            stopping[0].join()
+        else:
+            drain_server(server, args.drain_timeout)
+        server.server_close()
+        jobs.close()
+        runner.close()
+        if db is not None:
+            db.close()